@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from loci.models import Place
+from loci.models import GeocodeResult, Place
 
 
 admin.site.register(Place)
+admin.site.register(GeocodeResult)
@@ -0,0 +1,110 @@
+"""
+Asynchronous Lookups
+====================
+
+Non-blocking versions of the lookups in :mod:`loci.utils` and the
+proximity queries in :mod:`loci.models`, for callers that must not
+wait on the geocoder or the database themselves, e.g. an event loop.
+The synchronous functions are unchanged.
+
+Each function starts the work in a shared pool of
+``LOCI_ASYNC_THREADS`` threads (default 10) and returns at once with a
+:class:`multiprocessing.pool.AsyncResult`. Call its ``get(timeout)`` to
+wait for the result, or pass ``callback``, which is called with the
+result in the pool thread when the work succeeds. An event loop can
+hand that result back to its own thread, e.g. with asyncio's
+``loop.call_soon_threadsafe``.
+
+The work is done by the synchronous functions, so lookups go through
+the same cache, coalescing of concurrent misses, stale-while-revalidate
+and geocode store. Each call closes the database connection its pool
+thread opened once it is done.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from loci.utils import geocode, get_geo, geolocate_request
+
+
+THREADS = getattr(settings, 'LOCI_ASYNC_THREADS', 10)
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    with _pool_lock:
+        if not _pool:
+            _pool.append(ThreadPool(THREADS))
+        return _pool[0]
+
+
+def _call(func, args):
+    try:
+        return func(*args)
+    finally:
+        # each pool thread has its own connection; don't leave it open
+        connection.close()
+
+
+def _start(func, args, callback=None):
+    return _get_pool().apply_async(_call, (func, args), callback=callback)
+
+
+def _queryset(queryset):
+    if queryset is None:
+        # import here to prevent circular import
+        from loci.models import Place
+        return Place.objects.all()
+    return queryset
+
+
+def ageocode(address, callback=None):
+    """
+    Starts :func:`loci.utils.geocode` for an address.
+
+    """
+    return _start(geocode, (address,), callback)
+
+
+def aget_geo(location, callback=None):
+    """
+    Starts :func:`loci.utils.get_geo` for a (lat, lon) tuple.
+
+    """
+    return _start(get_geo, (location,), callback)
+
+
+def ageolocate_request(request, default_dist=None, callback=None):
+    """
+    Starts :func:`loci.utils.geolocate_request`. The request's session
+    is read and written in the pool thread, so the session backend's
+    database or cache access does not block the caller either; the
+    request should not be used elsewhere until the result is ready.
+
+    """
+    return _start(geolocate_request, (request, default_dist), callback)
+
+
+def anear(location, distance=None, queryset=None, callback=None):
+    """
+    Starts :meth:`loci.models.PlaceQuerySet.near` on ``queryset`` (all
+    places by default).
+
+    """
+    return _start(_queryset(queryset).near, (location, distance), callback)
+
+
+def anearest(location, k, max_distance=None, queryset=None, callback=None):
+    """
+    Starts :meth:`loci.models.PlaceQuerySet.nearest` on ``queryset``
+    (all places by default).
+
+    """
+    return _start(
+        _queryset(queryset).nearest, (location, k, max_distance), callback)
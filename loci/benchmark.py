@@ -0,0 +1,385 @@
+"""
+Benchmarks
+==========
+
+Timings of the proximity queries, the geocoding path and template
+rendering against seeded synthetic data, run by the ``loci_benchmark``
+management command. Results are returned as a dictionary ready to be
+written as JSON, so runs on different commits can be compared.
+
+Places are generated around "towns" whose sizes follow a power law,
+with a share spread uniformly over the continental United States, so
+the data has both dense clusters and empty areas. The same seed always
+gives the same places and query origins.
+
+Geocoding uses :class:`StubGeocoder`, which answers every query from a
+hash of it, optionally after a fixed delay standing in for a network
+round trip; no remote service is called. Its results, and the place
+generation (see :mod:`loci.generation`), are kept in a private
+in-memory cache that is emptied afterwards, so a run does not touch
+the site's cache or invalidate its cached results.
+
+The proximity and map caches are switched off while timing, so that
+every call does the full work. The in-memory spatial index is allowed
+to grow as large as the data; rows record whether it was in use.
+
+"""
+
+from contextlib import contextmanager
+import hashlib
+import platform
+import random
+import sys
+import time
+from timeit import default_timer
+
+import django
+from django.core.cache import get_cache
+from django.db import transaction
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from loci.geocache import GeocodeCache, make_key
+from loci.geocoders import BaseGeocoder
+from loci.models import Place
+from loci.templatetags import loci_tags
+from loci.utils import geocode, get_geo, geolocate_request
+import loci.distance
+import loci.generation
+import loci.geohash
+import loci.geostore
+import loci.models
+import loci.spatialindex
+import loci.utils
+
+
+# (latitude range, longitude range) of the continental United States
+BOUNDS = ((25.0, 49.0), (-124.0, -67.0))
+
+# share of places outside any town
+RURAL_SHARE = 0.1
+
+INSERT_BATCH_SIZE = 5000
+
+
+class StubGeocoder(BaseGeocoder):
+    """
+    Answers every lookup with made-up but stable data derived from the
+    query. :attr:`latency` seconds are slept first.
+
+    """
+
+    name = 'stub'
+    latency = 0
+
+    def _point(self, text):
+        digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+        (lat_range, lon_range) = BOUNDS
+        return (
+            lat_range[0] + int(digest[:8], 16) % 10000 / 10000.0
+            * (lat_range[1] - lat_range[0]),
+            lon_range[0] + int(digest[8:16], 16) % 10000 / 10000.0
+            * (lon_range[1] - lon_range[0]),
+        )
+
+    def geocode(self, address):
+        if self.latency:
+            time.sleep(self.latency)
+        return (self._point(address), (address, 'Springfield', 'WI', '54403'))
+
+    def reverse(self, location):
+        if self.latency:
+            time.sleep(self.latency)
+        return (tuple(location), (None, 'Springfield', 'WI', '54403'))
+
+
+def synthetic_points(count, seed=0):
+    """
+    Returns ``count`` clustered (lat, lon) points and the centers of
+    the towns they are clustered around.
+
+    """
+    rand = random.Random(seed)
+    (lat_range, lon_range) = BOUNDS
+    towns = []
+    for i in range(max(1, count // 200)):
+        center = (rand.uniform(*lat_range), rand.uniform(*lon_range))
+        # a few large towns and many small ones
+        weight = rand.paretovariate(1.2)
+        spread = rand.uniform(0.02, 0.3)
+        towns.append((center, weight, spread))
+    total = sum(weight for (center, weight, spread) in towns)
+
+    points = []
+    for (center, weight, spread) in towns:
+        size = int(count * (1 - RURAL_SHARE) * weight / total)
+        for j in range(size):
+            points.append((
+                min(max(rand.gauss(center[0], spread), -90.0), 90.0),
+                rand.gauss(center[1], spread),
+            ))
+    while len(points) < count:
+        points.append((rand.uniform(*lat_range), rand.uniform(*lon_range)))
+    return (points, [center for (center, weight, spread) in towns])
+
+
+def load_places(points):
+    batch = []
+    for (i, (latitude, longitude)) in enumerate(points):
+        batch.append(Place(
+            name='Place %d' % i,
+            latitude=latitude,
+            longitude=longitude,
+            geohash=loci.geohash.encode(latitude, longitude),
+        ))
+        if len(batch) >= INSERT_BATCH_SIZE:
+            Place.objects.bulk_create(batch)
+            batch = []
+    Place.objects.bulk_create(batch)
+    loci.generation.bump()
+
+
+def summarize(times):
+    """
+    Returns statistics, in milliseconds, of a list of durations in
+    seconds.
+
+    """
+    times = sorted(times)
+    count = len(times)
+    return {
+        'count': count,
+        'min': times[0] * 1000,
+        'median': times[count // 2] * 1000,
+        'mean': sum(times) / count * 1000,
+        'p95': times[min(count - 1, int(count * 0.95))] * 1000,
+        'max': times[-1] * 1000,
+    }
+
+
+def timed(func, args_list):
+    """
+    Calls ``func`` with each argument tuple in turn. Returns the
+    statistics of the call times and the results.
+
+    """
+    times = []
+    results = []
+    for args in args_list:
+        started = default_timer()
+        results.append(func(*args))
+        times.append(default_timer() - started)
+    return (summarize(times), results)
+
+
+@contextmanager
+def _patched(obj, name, value):
+    old = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, old)
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """
+    Runs a block in a transaction that is always rolled back.
+
+    """
+    try:
+        with transaction.atomic():
+            yield
+            raise _Rollback
+    except _Rollback:
+        pass
+    finally:
+        loci.generation.bump()
+
+
+def bench_near(size, radii, repeat, seed):
+    (points, towns) = synthetic_points(size, seed)
+    rand = random.Random(seed + 1)
+    origins = {
+        'dense': [rand.choice(towns) for i in range(repeat)],
+        'sparse': [
+            (rand.uniform(*BOUNDS[0]), rand.uniform(*BOUNDS[1]))
+            for i in range(repeat)
+        ],
+    }
+    results = []
+    with rolled_back():
+        load_places(points)
+        # let the index hold every place, however large the run
+        max_bytes = max(
+            loci.spatialindex.MAX_BYTES,
+            size * loci.spatialindex.BYTES_PER_PLACE)
+        for use_index in (False, True):
+            with _patched(loci.spatialindex, 'ENABLED', use_index), \
+                    _patched(loci.spatialindex, 'MAX_BYTES', max_bytes):
+                loci.spatialindex.invalidate()
+                # build it outside the timings
+                index = loci.spatialindex.get_index() is not None
+                for (density, density_origins) in sorted(origins.items()):
+                    for radius in radii:
+                        (stats, found) = timed(
+                            Place.objects.near,
+                            [(origin, radius) for origin in density_origins]
+                        )
+                        results.append({
+                            'name': 'near',
+                            'size': size,
+                            'radius': radius,
+                            'density': density,
+                            'spatial_index': index,
+                            'ms': stats,
+                            'mean_results': sum(len(r) for r in found)
+                                / float(len(found)),
+                            'mean_candidates': sum(r.candidates for r in found)
+                                / float(len(found)),
+                        })
+                    (stats, found) = timed(
+                        Place.objects.nearest,
+                        [(origin, 10) for origin in density_origins]
+                    )
+                    results.append({
+                        'name': 'nearest',
+                        'size': size,
+                        'k': 10,
+                        'density': density,
+                        'spatial_index': index,
+                        'ms': stats,
+                    })
+        loci.spatialindex.invalidate()
+
+        page = Place.objects.distance_page(towns[0], 50)[0]
+        results.extend(bench_templates(size, page, towns[0]))
+    return results
+
+
+def bench_templates(size, places, origin):
+    results = []
+    (latitude, longitude) = origin
+    templates = [
+        ('distance_tag', Template(
+            '{% load loci_tags %}{% for p in places %}'
+            '{% distance from p to latitude longitude as d %}{{ d.miles }}'
+            '{% endfor %}')),
+        ('distances_tag', Template(
+            '{% load loci_tags %}'
+            '{% distances from places to latitude longitude as located %}'
+            '{% for p in located %}{{ p.exact_distance.miles }}{% endfor %}')),
+        ('google_map_tag', Template(
+            '{% load loci_tags %}'
+            '{% google_map for places and latitude longitude %}')),
+    ]
+    context = {'places': places, 'latitude': latitude, 'longitude': longitude}
+    with _patched(loci_tags, 'MAP_CACHE_TIMEOUT', 0):
+        for (name, template) in templates:
+            (stats, output) = timed(
+                lambda: template.render(Context(context)), [()] * 20)
+            results.append({
+                'name': name, 'size': size, 'places': len(places), 'ms': stats})
+
+        request_location = Place(location=origin)
+        (stats, output) = timed(
+            lambda: render_to_string('loci/home.html', {
+                'request_location': request_location,
+                'places': places,
+            }),
+            [()] * 20
+        )
+    results.append({
+        'name': 'home_template', 'size': size, 'places': len(places),
+        'ms': stats})
+    return results
+
+
+def bench_geocoding(repeat, latency, backend):
+    results = []
+    factory = RequestFactory()
+    addresses = ['%d Benchmark Street' % i for i in range(repeat)]
+    geocode_cache = GeocodeCache(backend=backend)
+    with override_settings(LOCI_GEOCODER='loci.benchmark.StubGeocoder'), \
+            _patched(StubGeocoder, 'latency', latency), \
+            _patched(loci.utils, 'geocode_cache', geocode_cache), \
+            rolled_back():
+        try:
+            (stats, found) = timed(geocode, [(a,) for a in addresses])
+            results.append({
+                'name': 'geocode_miss', 'latency': latency, 'ms': stats})
+            (stats, found) = timed(geocode, [(a,) for a in addresses])
+            results.append({
+                'name': 'geocode_hit', 'latency': latency, 'ms': stats})
+            # answered by the Django cache rather than the LRU
+            geocode_cache.clear()
+            (stats, found) = timed(geocode, [(a,) for a in addresses])
+            results.append({
+                'name': 'geocode_backend_hit', 'latency': latency,
+                'ms': stats})
+            if loci.geostore.ENABLED:
+                # answered by the geocode store after a cache flush
+                for address in addresses:
+                    geocode_cache.delete(make_key(address, 'address'))
+                (stats, found) = timed(geocode, [(a,) for a in addresses])
+                results.append({
+                    'name': 'geocode_store_hit', 'latency': latency,
+                    'ms': stats})
+            (stats, found) = timed(get_geo, [(found[0].location,)] * repeat)
+            results.append({
+                'name': 'reverse_hit', 'latency': latency, 'ms': stats})
+
+            def locate(address):
+                request = factory.get('/', {'geo': address})
+                request.session = {}
+                return geolocate_request(request)
+            (stats, found) = timed(locate, [(a,) for a in addresses])
+            results.append({
+                'name': 'geolocate_request', 'latency': latency,
+                'ms': stats})
+        finally:
+            geocode_cache.clear()
+    return results
+
+
+def run(sizes, radii, repeat=20, seed=0, latency=0):
+    """
+    Runs every benchmark and returns the results. Data is generated in
+    transactions that are rolled back, so nothing is left behind.
+
+    """
+    results = []
+    backend = get_cache(
+        'django.core.cache.backends.locmem.LocMemCache',
+        LOCATION='loci-benchmark')
+    # the generation is kept in the private cache too, so that loading
+    # and rolling back the benchmark data does not invalidate the site's
+    # cached results and ETags
+    with _patched(loci.models, 'PROXIMITY_CACHE_TIMEOUT', 0), \
+            _patched(loci.generation, 'cache', backend):
+        try:
+            results.extend(bench_geocoding(repeat, latency, backend))
+            for size in sizes:
+                results.extend(bench_near(size, radii, repeat, seed))
+        finally:
+            loci.spatialindex.invalidate()
+            backend.clear()
+    return {
+        'meta': {
+            'seed': seed,
+            'repeat': repeat,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'numpy': loci.distance.numpy is not None,
+            'platform': sys.platform,
+        },
+        'results': results,
+    }
@@ -0,0 +1,114 @@
+"""
+Deferred Geocoding
+==================
+
+With ``LOCI_DEFERRED_GEOCODING`` set, :meth:`loci.models.Place.save`
+does not wait for the geocoder. The place is stored at once with
+``geocode_pending`` set and is left out of proximity queries until a
+worker has looked its address up, written the location and missing
+address parts back, and sent :data:`loci.signals.place_geocoded`.
+Saving the place with coordinates set before then cancels the lookup.
+
+``LOCI_DEFERRED_GEOCODING = 'thread'``
+    Look places up in a pool of ``LOCI_GEOCODE_THREADS`` (default 2)
+    background threads in the same process.
+
+``LOCI_DEFERRED_GEOCODING = 'queue'``
+    Leave pending places in the database for the ``loci_geocode_worker``
+    management command to pick up.
+
+Pending places are also picked up by the management command in thread
+mode, e.g. ones left behind by a restart, or saved inside a
+transaction that had not committed when the thread looked for them.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.loading import get_model
+
+from loci.signals import place_geocoded
+from loci.utils import geocode
+import loci.spatialindex
+
+
+MODE = getattr(settings, 'LOCI_DEFERRED_GEOCODING', False)
+
+THREADS = getattr(settings, 'LOCI_GEOCODE_THREADS', 2)
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    with _pool_lock:
+        if not _pool:
+            _pool.append(ThreadPool(THREADS))
+        return _pool[0]
+
+
+def enqueue(place):
+    """
+    Schedules a lookup for a place saved with ``geocode_pending`` set.
+
+    """
+    if MODE == 'thread':
+        _get_pool().apply_async(_process_in_thread, (place.pk,))
+
+
+def _process_in_thread(pk):
+    try:
+        process(pk)
+    finally:
+        # each pool thread has its own connection; don't leave it open
+        connection.close()
+
+
+def process(pk):
+    """
+    Looks up the address of a pending place, writes the result back and
+    sends :data:`loci.signals.place_geocoded`. Returns the place, or
+    ``None`` if it no longer exists or is no longer pending, including
+    when that changed while its address was being looked up.
+
+    """
+    Place = get_model('loci', 'place')
+    try:
+        place = Place.objects.get(pk=pk, geocode_pending=True)
+    except Place.DoesNotExist:
+        return None
+
+    geoloc = geocode(place.full_address)
+    success = geoloc.latitude is not None
+    if success:
+        place.location = geoloc.location
+        if not place.city:
+            place.city = geoloc.city or ''
+        if not place.state:
+            place.state = geoloc.state or ''
+        if not place.zip_code:
+            place.zip_code = geoloc.zip_code or ''
+    place.update_geohash()
+    place.geocode_pending = False
+
+    # only write the geocoded fields, and only if nobody has changed the
+    # place back to pending in the meantime
+    updated = Place.objects.filter(pk=pk, geocode_pending=True).update(
+        latitude=place.latitude,
+        longitude=place.longitude,
+        geohash=place.geohash,
+        city=place.city,
+        state=place.state,
+        zip_code=place.zip_code,
+        geocode_pending=False
+    )
+    if not updated:
+        # saved with coordinates or deleted during the lookup; the
+        # result was not used
+        return None
+    loci.spatialindex.place_saved(place)
+    place_geocoded.send(sender=Place, place=place, success=success)
+    return place
@@ -0,0 +1,231 @@
+"""
+Distance
+========
+
+Batch great-circle distance calculations used by the proximity queries
+in :mod:`loci.models`.
+
+Distances are computed with the haversine formula on a sphere of the
+mean Earth radius. Compared to the ellipsoidal (Vincenty) result of
+:func:`geopy.distance.distance` the relative error is at most
+:data:`TOLERANCE` (about 0.6%, worst case for long north-south paths;
+typically well under 0.3%). :func:`within` uses that bound to decide
+clear hits and misses from the batch result and only falls back to
+geopy for the few candidates that lie inside the tolerance band around
+the search radius, so the set of matches is the same as with geopy.
+
+NumPy is used when it is installed; otherwise a pure-Python loop over
+the same formula is used.
+
+"""
+
+from math import pi, radians, degrees, sin, cos, asin, sqrt, floor
+
+import geopy.distance
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EARTH_RADIUS_MILES = 3958.7613
+
+# no two points on the globe are further apart than this
+MAX_DISTANCE = pi * EARTH_RADIUS_MILES
+
+TOLERANCE = 0.006
+
+
+def batch_distances(origin, latitudes, longitudes):
+    """
+    Returns the distances in miles from ``origin`` (a (lat, lon) tuple)
+    to each of the points given by the parallel ``latitudes`` and
+    ``longitudes`` sequences.
+
+    The result is a NumPy array when NumPy is available and a list
+    otherwise.
+
+    """
+    (latitude, longitude) = origin
+    if numpy is not None:
+        return _numpy_distances(latitude, longitude, latitudes, longitudes)
+    return _python_distances(latitude, longitude, latitudes, longitudes)
+
+
+def _numpy_distances(latitude, longitude, latitudes, longitudes):
+    lat1 = numpy.radians(latitude)
+    lat2 = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    dlat = lat2 - lat1
+    dlon = numpy.radians(numpy.asarray(longitudes, dtype=float) - longitude)
+    a = (
+        numpy.sin(dlat / 2) ** 2
+        + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * numpy.arcsin(
+        numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def _python_distances(latitude, longitude, latitudes, longitudes):
+    lat1 = radians(latitude)
+    cos_lat1 = cos(lat1)
+    distances = []
+    for (lat, lon) in zip(latitudes, longitudes):
+        lat2 = radians(lat)
+        a = (
+            sin((lat2 - lat1) / 2) ** 2
+            + cos_lat1 * cos(lat2) * sin(radians(lon - longitude) / 2) ** 2
+        )
+        distances.append(2 * EARTH_RADIUS_MILES * asin(sqrt(min(a, 1.0))))
+    return distances
+
+
+def within(origin, rows, distance):
+    """
+    Filters ``rows`` of ``(key, latitude, longitude)`` down to those
+    within ``distance`` miles of ``origin``.
+
+    Returns a list of ``(key, miles)`` pairs in the order of ``rows``.
+    Candidates whose batch distance is within :data:`TOLERANCE` of the
+    radius are re-checked with :func:`geopy.distance.distance`, and the
+    geopy figure is returned for them.
+
+    """
+    rows = [row for row in rows if row[1] is not None and row[2] is not None]
+    if not rows:
+        return []
+    (keys, latitudes, longitudes) = zip(*rows)
+    miles = batch_distances(origin, latitudes, longitudes)
+
+    inner = distance * (1 - TOLERANCE)
+    outer = distance * (1 + TOLERANCE)
+    if numpy is not None:
+        indexes = numpy.nonzero(miles <= outer)[0].tolist()
+        miles = miles.tolist()
+    else:
+        indexes = [i for (i, d) in enumerate(miles) if d <= outer]
+
+    matches = []
+    for i in indexes:
+        d = miles[i]
+        if d > inner:
+            d = geopy.distance.distance(
+                origin, (latitudes[i], longitudes[i])).miles
+            if d > distance:
+                continue
+        matches.append((keys[i], d))
+    return matches
+
+
+def as_distance(miles):
+    """
+    Wraps a figure in miles in a :class:`geopy.distance.Distance`, the
+    type previously attached as ``exact_distance``.
+
+    """
+    return geopy.distance.Distance(miles=miles)
+
+
+def bounding_box(origin, distance):
+    """
+    Returns ``(latitude_range, longitude_ranges)`` for a box around
+    ``origin`` that holds every point within ``distance`` miles.
+
+    The longitude window widens with ``1 / cos(latitude)``. When it
+    crosses the antimeridian it is split into two ranges, and when the
+    circle reaches a pole it covers all longitudes. The box is padded
+    by :data:`TOLERANCE` so it also holds everything within range by
+    geopy's ellipsoidal distance.
+
+    """
+    (latitude, longitude) = origin
+    angle = min(distance * (1 + TOLERANCE) / EARTH_RADIUS_MILES, pi)
+    delta_lat = degrees(angle)
+    lat_min = latitude - delta_lat
+    lat_max = latitude + delta_lat
+    if lat_max >= 90 or lat_min <= -90:
+        return ((max(lat_min, -90.0), min(lat_max, 90.0)), [(-180.0, 180.0)])
+
+    delta_lon = degrees(asin(min(sin(angle) / cos(radians(latitude)), 1.0)))
+    lon_min = longitude - delta_lon
+    lon_max = longitude + delta_lon
+    if lon_max - lon_min >= 360:
+        lon_ranges = [(-180.0, 180.0)]
+    elif lon_min < -180:
+        lon_ranges = [(lon_min + 360, 180.0), (-180.0, lon_max)]
+    elif lon_max > 180:
+        lon_ranges = [(lon_min, 180.0), (-180.0, lon_max - 360)]
+    else:
+        lon_ranges = [(lon_min, lon_max)]
+    return ((lat_min, lat_max), lon_ranges)
+
+
+def viewport_box(southwest, northeast):
+    """
+    Returns ``(latitude_range, longitude_ranges)`` for the rectangle
+    between two (lat, lon) corners, in the form :func:`bounding_box`
+    uses. A viewport whose west edge lies east of its east edge crosses
+    the antimeridian and is split in two.
+
+    """
+    (south, west) = southwest
+    (north, east) = northeast
+    if west <= east:
+        lon_ranges = [(west, east)]
+    else:
+        lon_ranges = [(west, 180.0), (-180.0, east)]
+    return ((south, north), lon_ranges)
+
+
+def distance_sql(latitude_column, longitude_column, origin):
+    """
+    Returns ``(sql, params)`` for a haversine expression giving the
+    distance in miles from ``origin`` to the point stored in the given
+    (quoted) columns.
+
+    """
+    (latitude, longitude) = origin
+    sql = (
+        '(2 * %%s * ASIN(SQRT('
+        'POWER(SIN(RADIANS(%(lat)s - %%s) / 2), 2)'
+        ' + COS(RADIANS(%%s)) * COS(RADIANS(%(lat)s))'
+        ' * POWER(SIN(RADIANS(%(lon)s - %%s) / 2), 2)'
+        ')))'
+    ) % {'lat': latitude_column, 'lon': longitude_column}
+    return (sql, [EARTH_RADIUS_MILES, latitude, latitude, longitude])
+
+
+SQL_FUNCTIONS = {
+    'asin': (1, asin),
+    'sqrt': (1, sqrt),
+    'power': (2, pow),
+    'sin': (1, sin),
+    'cos': (1, cos),
+    'radians': (1, radians),
+    'floor': (1, floor),
+}
+
+
+def register_sql_functions(sender, connection, **kwargs):
+    """
+    Adds the math functions used by :func:`distance_sql` and viewport
+    clustering to SQLite connections, which do not have them built in.
+    Connected to :data:`django.db.backends.signals.connection_created`.
+
+    """
+    if connection.vendor != 'sqlite':
+        return
+    for (name, (num_args, func)) in SQL_FUNCTIONS.items():
+        connection.connection.create_function(
+            name, num_args, _null_safe(func))
+
+
+def _null_safe(func):
+    def wrapper(*args):
+        if None in args:
+            return None
+        try:
+            return func(*args)
+        except ValueError:
+            return None
+    return wrapper
@@ -0,0 +1,173 @@
+"""
+Formats
+=======
+
+Streaming readers and writers for place data in CSV and GeoJSON, used
+by the ``loci_import`` and ``loci_export`` commands. Readers yield one
+row dictionary at a time and writers take any iterable of rows, so
+neither holds a whole file in memory.
+
+A row has the keys in :data:`FIELDS`. ``latitude`` and ``longitude``
+are floats, or ``None`` if the place has not been located.
+
+CSV files have a header naming some or all of :data:`FIELDS`. GeoJSON
+files are FeatureCollections of Point features, with the other fields
+as properties.
+
+"""
+
+import csv
+import io
+import json
+import re
+
+from django.utils import six
+from django.utils.encoding import force_text
+
+
+FIELDS = ['name', 'address', 'city', 'state', 'zip_code', 'latitude', 'longitude']
+
+ADDRESS_FIELDS = ['name', 'address', 'city', 'state', 'zip_code']
+
+CHUNK_SIZE = 64 * 1024
+
+FEATURES_RE = re.compile(r'"features"\s*:\s*\[')
+
+
+def _float(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def _row(data, latitude, longitude):
+    row = dict(
+        (field, force_text(data.get(field) or '').strip())
+        for field in ADDRESS_FIELDS
+    )
+    row['latitude'] = _float(latitude)
+    row['longitude'] = _float(longitude)
+    return row
+
+
+def guess_format(path):
+    if path.lower().endswith(('.json', '.geojson')):
+        return 'geojson'
+    return 'csv'
+
+
+def open_file(path, format, mode='r'):
+    """
+    Opens a file for reading or writing in the given format. CSV files
+    are opened as bytes on Python 2, where the csv module does not
+    handle text.
+
+    """
+    if format == 'csv':
+        if six.PY3:
+            return io.open(path, mode, newline='', encoding='utf-8')
+        return open(path, mode + 'b')
+    return io.open(path, mode, encoding='utf-8')
+
+
+def read_csv(f):
+    for data in csv.DictReader(f):
+        if not six.PY3:
+            data = dict(
+                (key, value.decode('utf-8') if value else value)
+                for (key, value) in data.items()
+            )
+        yield _row(data, data.get('latitude'), data.get('longitude'))
+
+
+def iter_features(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the members of the ``features`` array of a GeoJSON
+    FeatureCollection one at a time, reading ``f`` in chunks.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    while True:
+        match = FEATURES_RE.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        chunk = force_text(f.read(chunk_size))
+        if not chunk:
+            raise ValueError('No "features" array found.')
+        buf += chunk
+
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+        if buf:
+            try:
+                (feature, end) = decoder.raw_decode(buf)
+            except ValueError:
+                # the feature continues in the next chunk
+                pass
+            else:
+                yield feature
+                buf = buf[end:]
+                continue
+        chunk = force_text(f.read(chunk_size))
+        if not chunk:
+            raise ValueError('The "features" array is not closed.')
+        buf += chunk
+
+
+def read_geojson(f):
+    for feature in iter_features(f):
+        geometry = feature.get('geometry') or {}
+        coordinates = geometry.get('coordinates') or [None, None]
+        yield _row(
+            feature.get('properties') or {}, coordinates[1], coordinates[0])
+
+
+def read(f, format):
+    if format == 'geojson':
+        return read_geojson(f)
+    return read_csv(f)
+
+
+def write_csv(f, rows):
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    for row in rows:
+        values = ['' if row[field] is None else row[field] for field in FIELDS]
+        if not six.PY3:
+            values = [
+                value.encode('utf-8') if isinstance(value, six.text_type)
+                else value
+                for value in values
+            ]
+        writer.writerow(values)
+
+
+def write_geojson(f, rows):
+    f.write(u'{"type": "FeatureCollection", "features": [')
+    for (i, row) in enumerate(rows):
+        if row['latitude'] is None or row['longitude'] is None:
+            geometry = None
+        else:
+            geometry = {
+                'type': 'Point',
+                'coordinates': [row['longitude'], row['latitude']],
+            }
+        feature = json.dumps({
+            'type': 'Feature',
+            'geometry': geometry,
+            'properties': dict(
+                (field, row[field]) for field in ADDRESS_FIELDS),
+        })
+        f.write(force_text((',\n' if i else '\n') + feature))
+    f.write(u'\n]}\n')
+
+
+def write(f, format, rows):
+    if format == 'geojson':
+        write_geojson(f, rows)
+    else:
+        write_csv(f, rows)
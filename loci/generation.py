@@ -0,0 +1,65 @@
+"""
+Generation
+==========
+
+A counter, shared between processes through the Django cache, that is
+bumped whenever a :class:`loci.models.Place` is saved or deleted.
+Anything derived from the place table (in-memory indexes, cached query
+results) can record the generation it was built from and compare it to
+:func:`current` to tell whether it is stale.
+
+"""
+
+import time
+
+from django.core.cache import cache
+
+
+CACHE_KEY = 'loci:place-generation'
+MODIFIED_CACHE_KEY = 'loci:place-modified'
+
+
+def _initial():
+    # a value no earlier generation can have had, in case the cache was
+    # flushed while other processes still hold old numbers
+    return int(time.time() * 1000)
+
+
+def current():
+    """
+    Returns the current generation number.
+
+    """
+    generation = cache.get(CACHE_KEY)
+    if generation is None:
+        cache.add(CACHE_KEY, _initial(), None)
+        generation = cache.get(CACHE_KEY)
+    return generation
+
+
+def last_modified():
+    """
+    Returns the time (a Unix timestamp) of the last change to the
+    places, or of the first time the generation was read if nothing has
+    changed since the cache was emptied.
+
+    """
+    modified = cache.get(MODIFIED_CACHE_KEY)
+    if modified is None:
+        cache.add(MODIFIED_CACHE_KEY, time.time(), None)
+        modified = cache.get(MODIFIED_CACHE_KEY)
+    return modified
+
+
+def bump():
+    """
+    Advances the generation and returns the new number.
+
+    """
+    cache.set(MODIFIED_CACHE_KEY, time.time(), None)
+    try:
+        return cache.incr(CACHE_KEY)
+    except ValueError:
+        generation = _initial()
+        cache.set(CACHE_KEY, generation, None)
+        return generation
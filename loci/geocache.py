@@ -0,0 +1,394 @@
+"""
+Geocode Cache
+=============
+
+The cache in front of the geocoder: a small in-process LRU backed by
+the Django cache. Keys are built from a canonical form of the query,
+so differently punctuated or capitalised spellings of an address, and
+coordinates that differ only past ``LOCI_GEOCODE_COORD_PRECISION``
+decimal places (default 4, about 10m), share an entry.
+
+Lookups that find nothing, or fail, are cached too, for the shorter
+``LOCI_GEOCODE_NEGATIVE_TIMEOUT`` (default 600 seconds), so a bad
+address does not cost a remote call on every page view.
+
+Settings:
+
+``LOCI_GEOCODE_TIMEOUT``
+    Seconds to keep results (default 86400).
+
+``LOCI_GEOCODE_LRU_SIZE``
+    Number of entries kept in process memory (default 1000, 0 to
+    disable).
+
+``LOCI_GEOCODE_STALE_TIMEOUT``
+    Seconds past ``LOCI_GEOCODE_TIMEOUT`` for which an expired result
+    is still served while it is refreshed in the background (default
+    3600).
+
+``LOCI_GEOCODE_DISTRIBUTED_LOCK``
+    If true, concurrent misses are coalesced across processes with a
+    lock in the Django cache, not only within each process (default
+    False). ``LOCI_GEOCODE_LOCK_TIMEOUT`` bounds how long callers wait
+    for another lookup (default 10 seconds).
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.encoding import force_text
+
+
+TIMEOUT = getattr(settings, 'LOCI_GEOCODE_TIMEOUT', 86400)
+
+NEGATIVE_TIMEOUT = getattr(settings, 'LOCI_GEOCODE_NEGATIVE_TIMEOUT', 600)
+
+LRU_SIZE = getattr(settings, 'LOCI_GEOCODE_LRU_SIZE', 1000)
+
+COORD_PRECISION = getattr(settings, 'LOCI_GEOCODE_COORD_PRECISION', 4)
+
+STALE_TIMEOUT = getattr(settings, 'LOCI_GEOCODE_STALE_TIMEOUT', 3600)
+
+LOCK_TIMEOUT = getattr(settings, 'LOCI_GEOCODE_LOCK_TIMEOUT', 10)
+
+DISTRIBUTED_LOCK = getattr(settings, 'LOCI_GEOCODE_DISTRIBUTED_LOCK', False)
+
+LOCK_POLL_INTERVAL = 0.05
+
+# stored in place of a result for lookups that found nothing
+NEGATIVE = 'loci:negative'
+
+ABBREVIATIONS = {
+    'street': 'st',
+    'avenue': 'ave',
+    'road': 'rd',
+    'drive': 'dr',
+    'boulevard': 'blvd',
+    'lane': 'ln',
+    'court': 'ct',
+    'place': 'pl',
+    'highway': 'hwy',
+    'parkway': 'pkwy',
+    'north': 'n',
+    'south': 's',
+    'east': 'e',
+    'west': 'w',
+    'suite': 'ste',
+}
+
+PUNCTUATION_RE = re.compile(r'[^\w\s-]+', re.UNICODE)
+
+
+def normalize_address(address):
+    """
+    Returns a canonical form of an address: lower case, without
+    punctuation, with single spaces and common street words
+    abbreviated.
+
+    """
+    words = PUNCTUATION_RE.sub(' ', force_text(address).lower()).split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def round_location(location):
+    """
+    Returns a (lat, lon) tuple rounded to ``COORD_PRECISION`` places.
+
+    """
+    return tuple(round(float(value), COORD_PRECISION) for value in location)
+
+
+def normalize_query(query, query_type=None):
+    """
+    Returns the canonical text of an address or (lat, lon) query.
+
+    """
+    if query_type == 'address':
+        return 'address:' + normalize_address(query)
+    return 'latlng:%.*f,%.*f' % (
+        COORD_PRECISION, query[0], COORD_PRECISION, query[1])
+
+
+def query_digest(query, query_type=None):
+    normalized = normalize_query(query, query_type)
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()
+
+
+def make_key(query, query_type=None):
+    return 'loci:geo:' + query_digest(query, query_type)
+
+
+class _Flight(object):
+    """
+    A lookup in progress, which other callers for the same key wait on.
+
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.value = None
+
+
+class GeocodeCache(object):
+    """
+    A bounded in-process LRU in front of the Django cache, with hit and
+    miss counters.
+
+    :meth:`get_or_lookup` also coalesces concurrent misses for a key
+    into a single lookup, and serves entries past their timeout for up
+    to ``stale_timeout`` more seconds while one background lookup
+    refreshes them.
+
+    """
+
+    def __init__(self, lru_size=LRU_SIZE, timeout=TIMEOUT,
+            negative_timeout=NEGATIVE_TIMEOUT, stale_timeout=STALE_TIMEOUT,
+            lock_timeout=LOCK_TIMEOUT, distributed_lock=DISTRIBUTED_LOCK,
+            backend=cache):
+        self.lru_size = lru_size
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.distributed_lock = distributed_lock
+        self.backend = backend
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.refreshing = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'lru_hits': 0,
+            'hits': 0,
+            'negative_hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+        }
+
+    def _lru_get(self, key):
+        with self.lock:
+            entry = self.lru.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            # re-insert to mark it most recently used
+            self.lru[key] = entry
+            return entry[1]
+
+    def _lru_set(self, key, entry, timeout):
+        if not self.lru_size:
+            return
+        with self.lock:
+            self.lru.pop(key, None)
+            self.lru[key] = (time.time() + timeout, entry)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def _read(self, key):
+        """
+        Returns the stored ``(fresh_until, value)`` entry for a key, or
+        ``None``.
+
+        """
+        entry = self._lru_get(key)
+        if entry is not None:
+            self.stats['lru_hits'] += 1
+            return entry
+        entry = self.backend.get(key)
+        if entry is not None:
+            self._lru_set(key, entry, self._hard_timeout(entry[1]))
+        return entry
+
+    def _hard_timeout(self, value):
+        if value == NEGATIVE:
+            return self.negative_timeout
+        return self.timeout + self.stale_timeout
+
+    def _result(self, value):
+        if value == NEGATIVE:
+            self.stats['negative_hits'] += 1
+            return None
+        self.stats['hits'] += 1
+        return value
+
+    def get(self, key):
+        """
+        Returns ``(found, value)``. ``value`` is ``None`` for a cached
+        negative result.
+
+        """
+        entry = self._read(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return (False, None)
+        return (True, self._result(entry[1]))
+
+    def set(self, key, value):
+        """
+        Stores a result, or a negative entry if ``value`` is ``None``.
+
+        """
+        if value is None:
+            (value, timeout) = (NEGATIVE, self.negative_timeout)
+        else:
+            timeout = self.timeout
+        entry = (time.time() + timeout, value)
+        self.backend.set(key, entry, self._hard_timeout(value))
+        self._lru_set(key, entry, self._hard_timeout(value))
+
+    def set_many(self, values):
+        """
+        Stores many results from a ``{key: value}`` dictionary in the
+        Django cache at once, without filling the in-process LRU.
+
+        """
+        now = time.time()
+        entries = dict(
+            (key, (now + self.timeout, value)) for (key, value) in values.items())
+        self.backend.set_many(entries, self.timeout + self.stale_timeout)
+
+    def delete(self, key):
+        with self.lock:
+            self.lru.pop(key, None)
+        self.backend.delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+
+    def get_or_lookup(self, key, lookup, refresh=None):
+        """
+        Returns the cached value for ``key``, calling ``lookup()`` to
+        find and store it if it is missing. ``lookup`` returns ``None``
+        when nothing is found, which is cached as a negative entry.
+        Stale entries are refreshed with ``refresh()`` if it is given,
+        otherwise with ``lookup()``.
+
+        Returns ``(value, outcome)``, where ``outcome`` says how the
+        value was found: ``'hit'``, ``'negative_hit'``, ``'stale_hit'``,
+        ``'miss'`` if ``lookup()`` was called, or ``'coalesced'`` if a
+        lookup already running in this or another process was waited
+        for.
+
+        """
+        entry = self._read(key)
+        if entry is not None:
+            (fresh_until, value) = entry
+            if fresh_until < time.time():
+                self.stats['stale_hits'] += 1
+                self._refresh(key, refresh or lookup)
+                return (self._result(value), 'stale_hit')
+            if value == NEGATIVE:
+                return (self._result(value), 'negative_hit')
+            return (self._result(value), 'hit')
+        self.stats['misses'] += 1
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            # the same lookup is already running in this process
+            self.stats['coalesced'] += 1
+            flight.event.wait(self.lock_timeout)
+            if flight.done:
+                return (flight.value, 'coalesced')
+            return self._lookup(key, lookup)
+
+        try:
+            (flight.value, outcome) = self._lookup(key, lookup)
+            flight.done = True
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return (flight.value, outcome)
+
+    def _lookup(self, key, lookup):
+        if not self.distributed_lock:
+            value = lookup()
+            self.set(key, value)
+            return (value, 'miss')
+
+        lock_key = key + ':lock'
+        locked = self.backend.add(lock_key, 1, self.lock_timeout)
+        if not locked:
+            # another process is looking it up; wait for its result
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self._lru_set(key, entry, self._hard_timeout(entry[1]))
+                    return (self._result(entry[1]), 'coalesced')
+        try:
+            value = lookup()
+            self.set(key, value)
+        finally:
+            # after a timed out wait the lock is still another process's
+            if locked:
+                self.backend.delete(lock_key)
+        return (value, 'miss')
+
+    def _refresh(self, key, lookup):
+        """
+        Starts a background lookup to replace a stale entry, unless one
+        is already running.
+
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        if self.distributed_lock and not self.backend.add(
+                key + ':refresh', 1, self.lock_timeout):
+            with self.lock:
+                self.refreshing.discard(key)
+            return
+
+        def run():
+            try:
+                value = lookup()
+                if value is not None:
+                    # keep serving the stale result if the refresh fails
+                    self.set(key, value)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+                if self.distributed_lock:
+                    self.backend.delete(key + ':refresh')
+                # the thread has its own connection; don't leave it open
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+geocode_cache = GeocodeCache()
+
+
+def stats():
+    """
+    Returns the hit and miss counts of this process's geocode cache.
+    ``hits`` and ``negative_hits`` count every cache hit; ``lru_hits``
+    counts those answered from process memory and ``stale_hits`` those
+    served while being refreshed. ``coalesced`` counts misses that
+    waited for a lookup already in progress.
+
+    """
+    return dict(geocode_cache.stats)
@@ -0,0 +1,285 @@
+"""
+Geocoders
+=========
+
+Backends used by :mod:`loci.utils` to turn addresses into coordinates
+and coordinates into addresses.
+
+A backend has ``geocode(address)`` and ``reverse(location)`` methods.
+Both return ``(location, (street_address, city, state, zip_code))``,
+or ``None`` if nothing was found, and raise :class:`GeocoderError` if
+the lookup could not be made at all (results of failed lookups are not
+cached).
+
+The backend is chosen with the ``LOCI_GEOCODER`` setting: the dotted
+path of a backend class, or a list of them to try in order. For
+example, to answer ZIP code and city lookups from a local table and
+only ask Google for the rest::
+
+    LOCI_GEOCODER = [
+        'loci.geocoders.LocalGeocoder',
+        'loci.geocoders.GoogleGeocoder',
+    ]
+
+"""
+
+import csv
+import json
+import re
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils import six
+from django.utils.module_loading import import_by_path
+
+from loci.spatialindex import GridIndex
+from loci.transport import get_transport, TransportError
+import loci.metrics
+
+
+DEFAULT_GEOCODER = 'loci.geocoders.GoogleGeocoder'
+
+
+class GeocoderError(Exception):
+    pass
+
+
+class BaseGeocoder(object):
+    name = None
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+    def reverse(self, location):
+        raise NotImplementedError
+
+    def lookup(self, method, query):
+        """
+        Calls the ``'geocode'`` or ``'reverse'`` method with ``query``
+        and reports the time it took as the ``geocode.lookup`` metric.
+        Returns the result and the name of the backend that gave it.
+
+        """
+        started = default_timer()
+        outcome = 'error'
+        try:
+            result = getattr(self, method)(query)
+            if result is None or result[0] == (None, None):
+                outcome = 'not_found'
+            else:
+                outcome = 'found'
+        finally:
+            loci.metrics.emit(
+                'geocode.lookup',
+                default_timer() - started,
+                provider=_name(self),
+                query_type='address' if method == 'geocode' else 'location',
+                outcome=outcome
+            )
+        return (result, _name(self))
+
+
+def _name(backend):
+    return backend.name or backend.__class__.__name__
+
+
+class GoogleGeocoder(BaseGeocoder):
+    """
+    Looks places up with the Google Maps geocoding API.
+
+    """
+
+    name = 'google'
+    api_url = 'http://maps.googleapis.com/maps/api/geocode/json?'
+
+    def __init__(self, transport=None):
+        self.transport = transport or get_transport()
+
+    def geocode(self, address):
+        return self.query('address=%s' % address)
+
+    def reverse(self, location):
+        return self.query('latlng=%s,%s' % tuple(location))
+
+    def url(self, params):
+        return self.api_url + params + '&sensor=false'
+
+    def query(self, params):
+        try:
+            resp = self.transport.get(self.url(params))
+        except TransportError as e:
+            raise GeocoderError(e)
+        if resp.status_code != 200:
+            raise GeocoderError('HTTP status %s' % resp.status_code)
+        return self.parse(json.loads(resp.text))
+
+    def parse(self, data):
+        # for now, we only need coords and address, but more is available
+        results = data.get('results', [])
+        if not results:
+            return None
+        result = results[0]
+
+        latlon = result.get('geometry', {}).get('location', {})
+        location = (latlon.get('lat'), latlon.get('lng'))
+
+        street_address = city = state = zip_code = None
+        number = route = ''
+        acomps = result.get('address_components', [])
+        for comp in acomps:
+            if 'street_number' in comp['types']:
+                number = comp['long_name']
+            if 'route' in comp['types']:
+                route = comp['long_name']
+            if 'locality' in comp['types']:
+                city = comp['long_name']
+            if 'administrative_area_level_1' in comp['types']:
+                state = comp['short_name']
+            if 'postal_code' in comp['types']:
+                zip_code = comp['long_name']
+        if number or route:
+            street_address = number + ' ' + route
+
+        return (location, (street_address, city, state, zip_code))
+
+
+ZIP_RE = re.compile(r'^\s*(\d{5})(?:-\d{4})?\s*$')
+CITY_STATE_RE = re.compile(r'^\s*([^,\d]+?)\s*,?\s+([A-Za-z]{2})\s*$')
+
+
+class LocalGeocoder(BaseGeocoder):
+    """
+    Answers ZIP code and "City, ST" lookups, and reverse lookups of the
+    nearest ZIP code, from a table of ZIP code centroids held in memory.
+    Street addresses are left to the next backend.
+
+    The table is a CSV file with ``zip_code``, ``city``, ``state``,
+    ``latitude`` and ``longitude`` columns, named by the
+    ``LOCI_ZIP_CENTROIDS`` setting. Reverse lookups only answer within
+    ``LOCI_LOCAL_GEOCODER_MAX_DISTANCE`` miles (default 25) of a ZIP
+    centroid.
+
+    """
+
+    name = 'local'
+
+    def __init__(self, path=None, rows=None, max_distance=None):
+        if rows is None:
+            path = path or getattr(settings, 'LOCI_ZIP_CENTROIDS', None)
+            if not path:
+                raise GeocoderError('LOCI_ZIP_CENTROIDS is not set.')
+            rows = self.read(path)
+        if max_distance is None:
+            max_distance = getattr(
+                settings, 'LOCI_LOCAL_GEOCODER_MAX_DISTANCE', 25)
+        self.max_distance = max_distance
+
+        self.zip_codes = []
+        self.by_zip = {}
+        self.by_city = {}
+        self.index = GridIndex()
+        for row in rows:
+            entry = (
+                (float(row['latitude']), float(row['longitude'])),
+                row['city'],
+                row['state'].upper(),
+                row['zip_code'],
+            )
+            key = len(self.zip_codes)
+            self.zip_codes.append(entry)
+            self.by_zip[entry[3]] = entry
+            self.by_city.setdefault(
+                (entry[1].lower(), entry[2]), []).append(entry)
+            self.index.add(key, *entry[0])
+
+    def read(self, path):
+        with open(path) as f:
+            return list(csv.DictReader(f))
+
+    def geocode(self, address):
+        match = ZIP_RE.match(address)
+        if match:
+            entry = self.by_zip.get(match.group(1))
+            if entry is None:
+                return None
+            (location, city, state, zip_code) = entry
+            return (location, (None, city, state, zip_code))
+
+        match = CITY_STATE_RE.match(address)
+        if match:
+            entries = self.by_city.get(
+                (match.group(1).lower(), match.group(2).upper()))
+            if not entries:
+                return None
+            location = (
+                sum(e[0][0] for e in entries) / len(entries),
+                sum(e[0][1] for e in entries) / len(entries),
+            )
+            return (location, (None, entries[0][1], entries[0][2], None))
+        return None
+
+    def reverse(self, location):
+        location = tuple(location)
+        found = self.index.nearest(location, 1, self.max_distance)
+        if not found:
+            return None
+        (centroid, city, state, zip_code) = self.zip_codes[found[0][0]]
+        return (location, (None, city, state, zip_code))
+
+
+class ChainGeocoder(BaseGeocoder):
+    """
+    Tries each of a list of backends in turn and returns the first
+    result found. If none finds anything and one of them failed, the
+    failure is raised. Each backend tried reports its own
+    ``geocode.lookup`` metric.
+
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    @property
+    def name(self):
+        return '+'.join(_name(b) for b in self.backends)
+
+    def geocode(self, address):
+        return self.lookup('geocode', address)[0]
+
+    def reverse(self, location):
+        return self.lookup('reverse', location)[0]
+
+    def lookup(self, method, query):
+        error = None
+        for backend in self.backends:
+            try:
+                (result, provider) = backend.lookup(method, query)
+            except GeocoderError as e:
+                error = e
+                continue
+            if result is not None:
+                return (result, provider)
+        if error is not None:
+            raise error
+        return (None, self.name)
+
+
+_geocoders = {}
+
+
+def get_geocoder():
+    """
+    Returns the backend configured by ``LOCI_GEOCODER``.
+
+    """
+    paths = getattr(settings, 'LOCI_GEOCODER', DEFAULT_GEOCODER)
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    key = tuple(paths)
+    if key not in _geocoders:
+        backends = [import_by_path(path)() for path in paths]
+        if len(backends) == 1:
+            _geocoders[key] = backends[0]
+        else:
+            _geocoders[key] = ChainGeocoder(backends)
+    return _geocoders[key]
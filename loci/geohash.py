@@ -0,0 +1,113 @@
+"""
+Geohash
+=======
+
+Encoding of coordinates as geohashes, and the set of geohash prefixes
+covering a bounding box. Points that are close together share long
+geohash prefixes, so a proximity search can be answered with a few
+range scans over an ordinary indexed string column.
+
+"""
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+PRECISION = 12
+
+# sorts after every geohash character, so [prefix, prefix + END) is the
+# range of all geohashes starting with prefix
+END = '~'
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """
+    Returns the geohash of the given point at the given precision.
+
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            (value, interval) = (longitude, lon_range)
+        else:
+            (value, interval) = (latitude, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            interval[0] = mid
+        else:
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """
+    Returns the ``(height, width)`` in degrees of a geohash cell at the
+    given precision.
+
+    """
+    lon_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return (180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits)
+
+
+def cover(lat_range, lon_ranges, max_cells=16):
+    """
+    Returns a list of geohash prefixes whose cells together cover the
+    box given by ``lat_range`` and the list of ``lon_ranges`` (as
+    returned by :func:`loci.distance.bounding_box`).
+
+    The longest prefixes that need no more than ``max_cells`` cells are
+    used; an empty list means the box is too large to be worth
+    covering.
+
+    """
+    best = []
+    for precision in range(1, PRECISION + 1):
+        cells = _cells(lat_range, lon_ranges, precision, max_cells)
+        if cells is None:
+            break
+        best = cells
+    return best
+
+
+def _cells(lat_range, lon_ranges, precision, max_cells):
+    (height, width) = cell_size(precision)
+    lat_steps = _steps(lat_range, height, -90.0, 90.0)
+    count = 0
+    lon_steps = []
+    for lon_range in lon_ranges:
+        steps = _steps(lon_range, width, -180.0, 180.0)
+        lon_steps.extend(steps)
+        count += len(steps) * len(lat_steps)
+        if count > max_cells:
+            return None
+
+    cells = set()
+    for lat in lat_steps:
+        for lon in lon_steps:
+            cells.add(encode(lat, lon, precision))
+    return sorted(cells)
+
+
+def _steps(value_range, size, low, high):
+    """
+    Returns the centres of the cells of the given size that overlap
+    ``value_range``, clamped to [low, high].
+
+    """
+    start = max(value_range[0], low)
+    stop = min(value_range[1], high)
+    first = int((start - low) // size)
+    last = min(int((stop - low) // size), int(round((high - low) / size)) - 1)
+    return [low + (i + 0.5) * size for i in range(first, last + 1)]
@@ -0,0 +1,119 @@
+"""
+Geocode Store
+=============
+
+A table of geocoder results (:class:`loci.models.GeocodeResult`)
+behind the geocode cache. Lookups that miss the cache are answered from
+the table before the geocoder is asked, so results survive cache
+flushes, evictions and deploys. Every successful lookup is stored,
+with the name of the backend that answered it; lookups that find
+nothing are only cached. Background refreshes of stale cache entries
+always ask the geocoder.
+
+Settings:
+
+``LOCI_GEOCODE_STORE``
+    Whether to use the table (default False). Run the migration that
+    creates it before turning this on.
+
+``LOCI_GEOCODE_STORE_MAX_AGE``
+    Seconds after which a stored result is looked up again (default
+    ``None``, never). If that lookup fails or finds nothing, the stored
+    result is still used.
+
+The ``loci_geocode_prewarm`` command copies the table, and the
+addresses of geocoded places, into the cache.
+
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models.loading import get_model
+from django.utils import timezone
+
+from loci.geocache import normalize_query, query_digest
+
+
+ENABLED = getattr(settings, 'LOCI_GEOCODE_STORE', False)
+
+MAX_AGE = getattr(settings, 'LOCI_GEOCODE_STORE_MAX_AGE', None)
+
+
+def _model():
+    # get the model here to prevent circular import
+    return get_model('loci', 'geocoderesult')
+
+
+def get(query, query_type=None):
+    """
+    Returns the stored :class:`GeocodeResult` for a query, or ``None``.
+
+    """
+    if not ENABLED:
+        return None
+    try:
+        return _model().objects.get(key=query_digest(query, query_type))
+    except _model().DoesNotExist:
+        return None
+
+
+def is_fresh(result):
+    if MAX_AGE is None:
+        return True
+    return result.fetched_at >= timezone.now() - timedelta(seconds=MAX_AGE)
+
+
+def save(query, query_type, location_data, provider=''):
+    """
+    Stores a ``(location, address_data)`` result, replacing any earlier
+    one for the query.
+
+    """
+    if not ENABLED or location_data is None:
+        return
+    ((latitude, longitude), (address, city, state, zip_code)) = location_data
+    values = {
+        'query': normalize_query(query, query_type),
+        'latitude': latitude,
+        'longitude': longitude,
+        'address': address or '',
+        'city': city or '',
+        'state': state or '',
+        'zip_code': zip_code or '',
+        'provider': provider or '',
+        'fetched_at': timezone.now(),
+    }
+    key = query_digest(query, query_type)
+    GeocodeResult = _model()
+    try:
+        with transaction.atomic():
+            updated = GeocodeResult.objects.filter(key=key).update(**values)
+            if not updated:
+                GeocodeResult.objects.create(key=key, **values)
+    except IntegrityError:
+        # stored by a concurrent lookup in the meantime
+        pass
+
+
+def lookup(query, query_type, lookup, refresh=False):
+    """
+    Returns the stored result for a query if it is fresh. Otherwise
+    calls ``lookup()``, which returns ``(location_data, provider)``,
+    stores what it finds and returns it, falling back to the stale
+    stored result if it finds nothing.
+
+    With ``refresh`` set the stored result is not read, so the lookup
+    is always made, and ``None`` is returned if it finds nothing.
+
+    """
+    stored = None if refresh else get(query, query_type)
+    if stored is not None and is_fresh(stored):
+        return stored.location_data
+    (location_data, provider) = lookup()
+    if location_data is not None:
+        save(query, query_type, location_data, provider)
+    elif stored is not None:
+        return stored.location_data
+    return location_data
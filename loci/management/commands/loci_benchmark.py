@@ -0,0 +1,69 @@
+from optparse import make_option
+import json
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+import loci.benchmark
+
+
+def _numbers(value, type):
+    try:
+        return [type(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise CommandError('Expected a comma separated list: %s' % value)
+
+
+class Command(NoArgsCommand):
+    help = ('Times proximity queries, geocoding and template rendering on '
+            'synthetic data and prints the results as JSON.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes',
+            dest='sizes',
+            default='1000,10000,100000,1000000',
+            help='Comma separated numbers of places to test with. The '
+                 'largest default size takes several minutes to load.'),
+        make_option('--radii',
+            dest='radii',
+            default='1,10,50',
+            help='Comma separated search radii in miles.'),
+        make_option('--repeat',
+            type='int',
+            dest='repeat',
+            default=20,
+            help='Number of timed calls per benchmark.'),
+        make_option('--seed',
+            type='int',
+            dest='seed',
+            default=0,
+            help='Seed for the synthetic data.'),
+        make_option('--latency',
+            type='float',
+            dest='latency',
+            default=0,
+            help='Seconds the stub geocoder waits per lookup.'),
+        make_option('--label',
+            dest='label',
+            default=None,
+            help='Stored with the results, e.g. a commit id.'),
+        make_option('--output',
+            dest='output',
+            default=None,
+            help='File to write the results to instead of standard output.'),
+    )
+
+    def handle_noargs(self, **options):
+        results = loci.benchmark.run(
+            _numbers(options['sizes'], int),
+            _numbers(options['radii'], float),
+            repeat=options['repeat'],
+            seed=options['seed'],
+            latency=options['latency']
+        )
+        results['meta']['label'] = options['label']
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
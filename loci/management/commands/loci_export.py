@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from loci.models import Place
+import loci.formats
+
+
+class Command(BaseCommand):
+    args = '[<path>]'
+    help = ('Exports places to a CSV or GeoJSON file, or to standard '
+            'output.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+            dest='format',
+            default=None,
+            choices=['csv', 'geojson'],
+            help='File format; guessed from the file name, or CSV.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Give at most one path to export to.')
+        path = args[0] if args else '-'
+        if path == '-':
+            format = options['format'] or 'csv'
+        else:
+            format = options['format'] or loci.formats.guess_format(path)
+
+        rows = (
+            dict(zip(loci.formats.FIELDS, values))
+            for values in Place.objects.order_by('pk')
+            .values_list(*loci.formats.FIELDS).iterator()
+        )
+        if path == '-':
+            # the writers end their own lines
+            self.stdout.ending = ''
+            loci.formats.write(self.stdout, format, rows)
+        else:
+            with loci.formats.open_file(path, format, 'w') as f:
+                loci.formats.write(f, format, rows)
@@ -0,0 +1,97 @@
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Q
+
+from loci.models import Place
+from loci.utils import geocode_many
+import loci.generation
+import loci.geohash
+
+
+class Command(NoArgsCommand):
+    help = 'Geocodes places that have an address but no coordinates.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=500,
+            help='Number of places to geocode and update per batch.'),
+        make_option('--threads',
+            type='int',
+            dest='threads',
+            default=None,
+            help='Number of lookups to run at once.'),
+        make_option('--checkpoint',
+            dest='checkpoint',
+            default=None,
+            help='File recording the last processed id, so an interrupted '
+                 'run can resume where it stopped.'),
+        make_option('--start-after',
+            type='int',
+            dest='start_after',
+            default=None,
+            help='Only process places with a greater id.'),
+    )
+
+    def handle_noargs(self, **options):
+        checkpoint = options['checkpoint']
+        last_pk = options['start_after']
+        if last_pk is None and checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_pk = int(f.read().strip() or 0)
+        last_pk = last_pk or 0
+
+        queryset = Place.objects.filter(
+            Q(latitude__isnull=True) | Q(longitude__isnull=True)
+        ).exclude(
+            address='', city='', state='', zip_code=''
+        ).order_by('pk')
+        total = queryset.filter(pk__gt=last_pk).count()
+        processed = found = 0
+        started = time.time()
+
+        while True:
+            places = list(
+                queryset.filter(pk__gt=last_pk)
+                .only('address', 'city', 'state', 'zip_code')
+                [:options['batch_size']]
+            )
+            if not places:
+                break
+            results = geocode_many(
+                [place.full_address for place in places],
+                threads=options['threads']
+            )
+
+            with transaction.atomic():
+                for place in places:
+                    geoloc = results[place.full_address]
+                    if geoloc.latitude is None:
+                        continue
+                    found += 1
+                    Place.objects.filter(pk=place.pk).update(
+                        latitude=geoloc.latitude,
+                        longitude=geoloc.longitude,
+                        geohash=loci.geohash.encode(*geoloc.location),
+                        city=place.city or geoloc.city or '',
+                        state=place.state or geoloc.state or '',
+                        zip_code=place.zip_code or geoloc.zip_code or '',
+                        geocode_pending=False
+                    )
+            loci.generation.bump()
+
+            processed += len(places)
+            last_pk = places[-1].pk
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(last_pk))
+
+            elapsed = time.time() - started
+            self.stdout.write(
+                '%d/%d places processed, %d found (%.1f places/s)' % (
+                    processed, total, found, processed / max(elapsed, 0.001)))
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from loci.geocache import geocode_cache, make_key
+from loci.models import GeocodeResult, Place
+
+
+class Command(NoArgsCommand):
+    help = ('Fills the geocode cache from stored geocode results and the '
+            'addresses of geocoded places.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--skip-places',
+            action='store_true',
+            dest='skip_places',
+            default=False,
+            help='Only load stored geocode results.'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of entries to write to the cache at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        batch = {}
+        count = 0
+
+        def flush():
+            geocode_cache.set_many(batch)
+            batch.clear()
+
+        if not options['skip_places']:
+            places = Place.objects.filter(
+                latitude__isnull=False,
+                longitude__isnull=False,
+                geocode_pending=False
+            ).values_list(
+                'address', 'city', 'state', 'zip_code', 'latitude', 'longitude')
+            for (address, city, state, zip_code, latitude, longitude) in (
+                    places.iterator()):
+                query = Place(
+                    address=address, city=city, state=state, zip_code=zip_code,
+                ).full_address
+                if not query:
+                    continue
+                batch[make_key(query, 'address')] = (
+                    (latitude, longitude),
+                    (address or None, city or None, state or None,
+                        zip_code or None),
+                )
+                count += 1
+                if len(batch) >= batch_size:
+                    flush()
+
+        # stored results are written last, so they win over places with
+        # the same address
+        for result in GeocodeResult.objects.iterator():
+            batch['loci:geo:' + result.key] = result.location_data
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+
+        self.stdout.write('Loaded %d geocode cache entries.' % count)
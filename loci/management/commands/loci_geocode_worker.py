@@ -0,0 +1,48 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from loci.models import Place
+import loci.deferred
+
+
+class Command(NoArgsCommand):
+    help = 'Geocodes places saved with LOCI_DEFERRED_GEOCODING.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Exit when no pending places are left.'),
+        make_option('--interval',
+            type='float',
+            dest='interval',
+            default=5,
+            help='Seconds to wait between polls for pending places.'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=100,
+            help='Number of pending places to fetch per poll.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        while True:
+            pks = list(
+                Place.objects.filter(geocode_pending=True)
+                .order_by('pk')
+                .values_list('pk', flat=True)
+                [:options['batch_size']]
+            )
+            for pk in pks:
+                place = loci.deferred.process(pk)
+                if place is not None and verbosity > 1:
+                    self.stdout.write('Geocoded %s: %s, %s' % (
+                        pk, place.latitude, place.longitude))
+            if not pks:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
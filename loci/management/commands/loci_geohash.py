@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from loci.models import Place
+import loci.geohash
+
+
+class Command(NoArgsCommand):
+    help = 'Fills in the geohash of places that have coordinates.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Recompute every geohash, not only missing ones.'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of places to update per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        queryset = Place.objects.filter(
+            latitude__isnull=False,
+            longitude__isnull=False
+        )
+        if not options['all']:
+            queryset = queryset.filter(geohash='')
+        batch_size = options['batch_size']
+
+        updated = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                queryset.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', 'latitude', 'longitude', 'geohash')
+                [:batch_size]
+            )
+            if not rows:
+                break
+            with transaction.atomic():
+                for (pk, latitude, longitude, old_hash) in rows:
+                    new_hash = loci.geohash.encode(latitude, longitude)
+                    if new_hash != old_hash:
+                        Place.objects.filter(pk=pk).update(geohash=new_hash)
+                        updated += 1
+            last_pk = rows[-1][0]
+
+        self.stdout.write('Updated %d geohashes.' % updated)
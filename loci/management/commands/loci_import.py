@@ -0,0 +1,103 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from loci.models import Place
+from loci.utils import geocode_many
+import loci.formats
+import loci.generation
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = ('Imports places from a CSV or GeoJSON file. Rows without '
+            'coordinates are geocoded first, each address once, and all '
+            'rows are inserted in one transaction.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+            dest='format',
+            default=None,
+            choices=['csv', 'geojson'],
+            help='File format; guessed from the file name by default.'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of places to insert per query.'),
+        make_option('--no-geocode',
+            action='store_false',
+            dest='geocode',
+            default=True,
+            help='Leave rows without coordinates unlocated.'),
+        make_option('--threads',
+            type='int',
+            dest='threads',
+            default=None,
+            help='Number of lookups to run at once.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the file to import.')
+        path = args[0]
+        format = options['format'] or loci.formats.guess_format(path)
+        batch_size = options['batch_size']
+
+        results = {}
+        if options['geocode']:
+            addresses = set(
+                place.full_address for place in self.read(path, format)
+                if place.latitude is None and place.full_address
+            )
+            if addresses:
+                results = geocode_many(addresses, threads=options['threads'])
+
+        imported = 0
+        located = 0
+        batch = []
+        with transaction.atomic():
+            for place in self.read(path, format):
+                geoloc = None
+                if place.latitude is None and place.full_address:
+                    geoloc = results.get(place.full_address)
+                if geoloc is not None and geoloc.latitude is not None:
+                    self.locate(place, geoloc)
+                    located += 1
+                place.update_geohash()
+                batch.append(place)
+                if len(batch) >= batch_size:
+                    Place.objects.bulk_create(batch)
+                    imported += len(batch)
+                    batch = []
+            Place.objects.bulk_create(batch)
+            imported += len(batch)
+        loci.generation.bump()
+        self.stdout.write('Imported %d places.' % imported)
+        if results:
+            self.stdout.write('Geocoded %d addresses, locating %d places.' % (
+                len(results), located))
+
+    def read(self, path, format):
+        """
+        Yields an unsaved place for each row of the file. The file is
+        read twice, once for the addresses to geocode and once to
+        insert the rows, so neither pass holds it in memory.
+
+        """
+        with loci.formats.open_file(path, format) as f:
+            try:
+                for row in loci.formats.read(f, format):
+                    place = Place(**row)
+                    if place.latitude is None or place.longitude is None:
+                        place.location = (None, None)
+                    yield place
+            except (ValueError, KeyError) as e:
+                raise CommandError('Could not read %s: %s' % (path, e))
+
+    def locate(self, place, geoloc):
+        place.location = geoloc.location
+        place.city = place.city or geoloc.city or ''
+        place.state = place.state or geoloc.state or ''
+        place.zip_code = place.zip_code or geoloc.zip_code or ''
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from loci.models import Place
+import loci.spatial
+
+
+class Command(NoArgsCommand):
+    help = ('Adds the indexed point column used by LOCI_SPATIAL_BACKEND '
+            'to the place table.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database',
+            action='store',
+            dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='Database to set up. Defaults to the "default" database.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not loci.spatial.ENABLED:
+            raise CommandError('LOCI_SPATIAL_BACKEND is not enabled.')
+        connection = connections[options['database']]
+        kind = loci.spatial.spatial_kind(connection)
+        if kind is None:
+            raise CommandError(
+                'The %s database has no PostGIS or SpatiaLite support.'
+                % options['database'])
+        table = Place._meta.db_table
+        loci.spatial.reset()
+        if loci.spatial.is_ready(connection, table):
+            self.stdout.write('The spatial index is already set up.')
+            return
+
+        statements = loci.spatial.setup_sql(
+            kind, table, Place._meta.pk.column)
+        with transaction.atomic(using=options['database']):
+            cursor = connection.cursor()
+            if kind == loci.spatial.SPATIALITE:
+                cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'geometry_columns'")
+                if cursor.fetchone() is None:
+                    cursor.execute('SELECT InitSpatialMetaData()')
+            for statement in statements:
+                cursor.execute(statement)
+        loci.spatial.reset()
+        self.stdout.write('Set up the %s spatial index on %s.' % (kind, table))
@@ -0,0 +1,158 @@
+"""
+Metrics
+=======
+
+Measurements reported by the geocoding path, :meth:`Place.save` and
+the proximity queries. Each one has a name, a value (a duration in
+seconds or a count) and a dictionary of tags, and is:
+
+* sent as the :data:`loci.signals.metric` signal,
+* passed to the callable named by ``LOCI_METRICS_CALLBACK``, if set,
+  as ``callback(name, value, tags)``, e.g. to forward it to statsd,
+* logged to the ``loci.metrics`` logger if ``LOCI_METRICS_LOGGING`` is
+  true,
+* added to the summary of the current request, if
+  :class:`MetricsMiddleware` is installed.
+
+Reported metrics:
+
+``geocode.cache``
+    1 per :func:`loci.utils.geocode` or :func:`loci.utils.get_geo`
+    call, tagged with ``result`` (``hit``, ``negative_hit``,
+    ``stale_hit``, ``miss`` or ``coalesced``, see
+    :meth:`loci.geocache.GeocodeCache.get_or_lookup`) and
+    ``query_type``.
+
+``geocode.lookup``
+    Seconds spent asking a geocoder backend, tagged with ``provider``,
+    ``query_type`` and ``outcome`` (``found``, ``not_found`` or
+    ``error``). With several backends configured, each one tried
+    reports its own.
+
+``geocode.reverse_fallback``
+    1 per address lookup that needed a reverse lookup to fill in
+    missing address parts.
+
+``place.save``
+    Seconds spent in :meth:`Place.save`, tagged with whether it
+    ``geocoded`` or ``deferred`` the lookup.
+
+``near.sql``, ``near.math``
+    Seconds :meth:`PlaceQuerySet.near` spent in the database, fetching
+    candidates and loading the places in range, and checking the
+    candidates' distances, tagged with ``source`` (``database`` or
+    ``index``).
+
+``near.candidates``, ``near.results``
+    Numbers of candidates the bounding box let through and of places
+    in range.
+
+The ``near`` metrics are not reported for results served from the
+proximity cache.
+
+"""
+
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.utils.module_loading import import_by_path
+
+from loci.signals import metric
+
+
+LOGGING = getattr(settings, 'LOCI_METRICS_LOGGING', False)
+
+logger = logging.getLogger('loci.metrics')
+
+_callbacks = {}
+
+_local = threading.local()
+
+
+def _callback():
+    path = getattr(settings, 'LOCI_METRICS_CALLBACK', None)
+    if not path:
+        return None
+    if path not in _callbacks:
+        _callbacks[path] = import_by_path(path)
+    return _callbacks[path]
+
+
+def emit(name, value, **tags):
+    """
+    Reports a measurement.
+
+    """
+    summary = getattr(_local, 'summary', None)
+    if summary is not None:
+        key = ' '.join(
+            [name] + ['%s=%s' % item for item in sorted(tags.items())])
+        entry = summary.setdefault(key, {'count': 0, 'total': 0})
+        entry['count'] += 1
+        entry['total'] += value
+
+    metric.send(sender=None, name=name, value=value, tags=tags)
+    callback = _callback()
+    if callback is not None:
+        callback(name, value, tags)
+    if LOGGING:
+        logger.info('%s %s %s', name, value, json.dumps(tags, sort_keys=True),
+            extra={'metric': name, 'value': value, 'tags': tags})
+
+
+def start_summary():
+    """
+    Starts collecting a summary of the metrics reported in this thread.
+
+    """
+    _local.summary = {}
+
+
+def stop_summary():
+    """
+    Stops collecting and returns the summary: a dictionary mapping each
+    metric name and tag combination, e.g. ``'geocode.cache
+    query_type=address result=hit'``, to its ``count`` and ``total``.
+
+    """
+    summary = getattr(_local, 'summary', None)
+    _local.summary = None
+    return summary or {}
+
+
+def _discard_summary(**kwargs):
+    _local.summary = None
+
+
+class MetricsMiddleware(object):
+    """
+    Collects a summary of the metrics reported while handling each
+    request and sets it as ``request.loci_metrics``, for the debug
+    toolbar panel (:class:`loci.panels.MetricsPanel`) or other code
+    that runs late in the response. It is logged too when
+    ``LOCI_METRICS_LOGGING`` is set.
+
+    The summary is started afresh for every request and dropped when
+    the request finishes, even if an error kept
+    :meth:`process_response` from running, so metrics never carry over
+    to the next request handled by the thread.
+
+    """
+
+    def process_request(self, request):
+        # replaces anything left over in this thread
+        start_summary()
+
+    def process_response(self, request, response):
+        summary = stop_summary()
+        request.loci_metrics = summary
+        if LOGGING and summary:
+            logger.info('%s %s', request.path, json.dumps(summary, sort_keys=True),
+                extra={'path': request.path, 'summary': summary})
+        return response
+
+
+request_finished.connect(_discard_summary)
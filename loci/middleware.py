@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from loci.utils import geolocate_request, default_location
+
+
+class GeolocationMiddleware(object):
+    """
+    Adds ``request.geolocation``, the result of
+    :func:`loci.utils.geolocate_request`. It is only looked up when
+    first used, so pages that never read it pay nothing.
+
+    The default ZIP code's location is looked up once, when the
+    middleware is loaded.
+
+    """
+
+    def __init__(self):
+        zip_code = getattr(settings, 'DEFAULT_ZIP_CODE', None)
+        if zip_code:
+            default_location(zip_code)
+
+    def process_request(self, request):
+        request.geolocation = SimpleLazyObject(
+            lambda: geolocate_request(request))
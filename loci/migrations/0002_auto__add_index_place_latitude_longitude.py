@@ -0,0 +1,35 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding index on 'Place', fields ['latitude', 'longitude']
+        db.create_index('loci_place', ['latitude', 'longitude'])
+
+
+    def backwards(self, orm):
+        
+        # Removing index on 'Place', fields ['latitude', 'longitude']
+        db.delete_index('loci_place', ['latitude', 'longitude'])
+
+
+    models = {
+        'loci.place': {
+            'Meta': {'object_name': 'Place', 'index_together': "[['latitude', 'longitude']]"},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '180', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'longitude': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2', 'blank': 'True'}),
+            'zip_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['loci']
@@ -0,0 +1,64 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'GeocodeResult'
+        db.create_table('loci_geocoderesult', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('key', self.gf('django.db.models.fields.CharField')(unique=True, max_length=32)),
+            ('query', self.gf('django.db.models.fields.TextField')()),
+            ('latitude', self.gf('django.db.models.fields.FloatField')()),
+            ('longitude', self.gf('django.db.models.fields.FloatField')()),
+            ('address', self.gf('django.db.models.fields.CharField')(default='', max_length=180, blank=True)),
+            ('city', self.gf('django.db.models.fields.CharField')(default='', max_length=50, blank=True)),
+            ('state', self.gf('django.contrib.localflavor.us.models.USStateField')(max_length=2, blank=True)),
+            ('zip_code', self.gf('django.db.models.fields.CharField')(default='', max_length=10, blank=True)),
+            ('provider', self.gf('django.db.models.fields.CharField')(default='', max_length=50, blank=True)),
+            ('fetched_at', self.gf('django.db.models.fields.DateTimeField')(db_index=True)),
+        ))
+        db.send_create_signal('loci', ['GeocodeResult'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'GeocodeResult'
+        db.delete_table('loci_geocoderesult')
+
+
+    models = {
+        'loci.geocoderesult': {
+            'Meta': {'object_name': 'GeocodeResult'},
+            'address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '180', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'blank': 'True'}),
+            'fetched_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '32'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {}),
+            'longitude': ('django.db.models.fields.FloatField', [], {}),
+            'provider': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'blank': 'True'}),
+            'query': ('django.db.models.fields.TextField', [], {}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2', 'blank': 'True'}),
+            'zip_code': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'blank': 'True'})
+        },
+        'loci.place': {
+            'Meta': {'object_name': 'Place', 'index_together': "[['latitude', 'longitude']]"},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '180', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'geocode_pending': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'geohash': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '12', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'longitude': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2', 'blank': 'True'}),
+            'zip_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['loci']
@@ -7,22 +7,89 @@ The :class:`Place` model and its associated :class:`Manager` and
 
 """
 
-from django.db import models
+from collections import OrderedDict
+from functools import reduce
+import hashlib
+from math import floor, sqrt
+import operator
+from timeit import default_timer
+
+from django.db import models, connections
+from django.db.models import Avg, Count, Q
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
 from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.conf import settings
+from django.core.cache import cache
 
 from localflavor.us.models import USStateField
-from geopy.units import nautical, degrees
 import geopy.distance
 
 from loci.utils import geocode
+import loci.deferred
+import loci.distance
+import loci.generation
+import loci.geohash
+import loci.metrics
+import loci.spatial
+import loci.spatialindex
+
+
+IN_BULK_BATCH_SIZE = 500
+
+NEAR_MANY_CHUNK_SIZE = 20
+
+NEAREST_INITIAL_DISTANCE = getattr(
+    settings, 'LOCI_NEAREST_INITIAL_DISTANCE', 10)
+
+GEOHASH_LOOKUPS = getattr(settings, 'LOCI_GEOHASH_LOOKUPS', False)
+
+VIEWPORT_MAX_PLACES = getattr(settings, 'LOCI_VIEWPORT_MAX_PLACES', 500)
+
+VIEWPORT_GRID = getattr(settings, 'LOCI_VIEWPORT_GRID', 16)
+
+# distance_page() keys distances in millionths of a mile
+DISTANCE_KEY_SCALE = 1000000
+
+PROXIMITY_CACHE_TIMEOUT = getattr(settings, 'LOCI_PROXIMITY_CACHE_TIMEOUT', 0)
+
+PROXIMITY_CACHE_PRECISION = getattr(
+    settings, 'LOCI_PROXIMITY_CACHE_PRECISION', 3)
+
+
+class ProximityResult(list):
+    """
+    The list of places returned by :meth:`PlaceQuerySet.near` and
+    :meth:`PlaceQuerySet.nearest`.
+
+    ``candidates`` is the number of rows the bounding box prefilter
+    let through; comparing it to the length of the list shows how well
+    the prefilter prunes.
+
+    """
+
+    def __init__(self, iterable=(), candidates=0):
+        super(ProximityResult, self).__init__(iterable)
+        self.candidates = candidates
+
+    @property
+    def pruning_ratio(self):
+        """
+        The number of candidates checked per returned place.
+
+        """
+        if not self:
+            return float(self.candidates)
+        return float(self.candidates) / len(self)
 
 
 class PlaceManager(models.Manager):
     """
     A :class:`Manager` designed for the :class:`Place` model.
 
-    Returns a :class:`PlaceQuerySet` and proxies the :method:`near` method.
+    Returns a :class:`PlaceQuerySet` and proxies its proximity query
+    methods.
 
     """
 
@@ -32,13 +99,100 @@ class PlaceManager(models.Manager):
     def near(self, *args, **kwargs):
         return self.get_query_set().near(*args, **kwargs)
 
+    def within(self, *args, **kwargs):
+        return self.get_query_set().within(*args, **kwargs)
+
+    def distance_page(self, *args, **kwargs):
+        return self.get_query_set().distance_page(*args, **kwargs)
+
+    def nearest(self, *args, **kwargs):
+        return self.get_query_set().nearest(*args, **kwargs)
+
+    def within_bounds(self, *args, **kwargs):
+        return self.get_query_set().within_bounds(*args, **kwargs)
+
+    def viewport(self, *args, **kwargs):
+        return self.get_query_set().viewport(*args, **kwargs)
+
+    def near_many(self, *args, **kwargs):
+        return self.get_query_set().near_many(*args, **kwargs)
+
+    def iter_near_many(self, *args, **kwargs):
+        return self.get_query_set().iter_near_many(*args, **kwargs)
+
+
+def _coordinates(location):
+    """
+    Returns the ``(latitude, longitude)`` of a :class:`Place` or tuple,
+    or ``None`` if it has no coordinates.
+
+    """
+    # figure out if we received an object or tuple and get the location
+    try:
+        (latitude, longitude) = location.location
+    except AttributeError:
+        (latitude, longitude) = location
+
+    # make sure we have a valid location; 0 is a valid coordinate
+    if latitude is None or longitude is None:
+        return None
+    return (latitude, longitude)
+
+
+def _resolve_location(location, distance):
+    """
+    Returns ``(latitude, longitude, distance)`` for the location and
+    distance arguments accepted by the proximity queries, or ``None``
+    if the location has no coordinates.
+
+    """
+    coordinates = _coordinates(location)
+    if coordinates is None:
+        return None
+
+    # get the passed distance or attached to Place
+    if distance == None:
+        try:
+            distance = location.nearby_distance
+        except AttributeError:
+            raise ValueError('Distance must be attached or passed explicitly.')
+    return coordinates + (distance,)
+
+
+def _rounding_slack(precision):
+    """
+    Returns the most miles a point can be from the point with its
+    coordinates rounded to ``precision`` decimal places.
+
+    """
+    # half a unit in each coordinate; no degree is longer than 69.5 miles
+    return 10 ** -precision * 69.5
+
+
+def _k_nearest(origin, rows, k, max_distance=None):
+    """
+    Returns ``(pk, miles)`` pairs for the ``k`` of the ``(pk, latitude,
+    longitude)`` rows nearest to ``origin``, nearest first.
+
+    """
+    if not rows:
+        return []
+    (pks, latitudes, longitudes) = zip(*rows)
+    miles = loci.distance.batch_distances(origin, latitudes, longitudes)
+    candidates = [
+        (pk, float(d)) for (pk, d) in zip(pks, miles)
+        if max_distance is None or d <= max_distance
+    ]
+    candidates.sort(key=lambda candidate: (candidate[1], candidate[0]))
+    return candidates[:k]
+
 
 class PlaceQuerySet(QuerySet):
     def near(self, location, distance=None):
         """
         Returns a list of items in the :class:`QuerySet` which are
         within the given distance of the given location. Does NOT return
-        a :class:`QuerySet`.
+        a :class:`QuerySet`; see :meth:`within` for that.
 
         Accepts either a :class:`Place` instance or a (lat, lon) tuple
         for location. Also accepts a Place instance with a
@@ -47,45 +201,589 @@ class PlaceQuerySet(QuerySet):
         need not be explicitly passed.
         
         """
-        
-        # figure out if we received an object or tuple and get the location
-        try:
-            (latitude, longitude) = location.location
-        except AttributeError:
-            (latitude, longitude) = location
+        resolved = _resolve_location(location, distance)
+        if resolved is None:
+            return ProximityResult()
+        (latitude, longitude, distance) = resolved
+        origin = (latitude, longitude)
+        if PROXIMITY_CACHE_TIMEOUT:
+            (rows, candidates) = self._cached(self._near_rows, origin, distance)
+            return self._load(
+                loci.distance.within(origin, rows, distance), candidates)
+        return self._near_places(origin, distance)
 
-        # make sure we have a valid location
-        if not (latitude and longitude):
-            return []
-        
-        # get the passed distance or attached to Place
-        if distance == None:
-            try:
-                distance = location.nearby_distance
-            except AttributeError:
-                raise ValueError('Distance must be attached or passed explicitly.')
-
-        # prune down the set of places before checking precisely
-        #deg_lat = Decimal(str(degrees(arcminutes=nautical(miles=distance))))
-        deg_lat = degrees(arcminutes=nautical(miles=distance))
-        lat_range = (latitude - deg_lat, latitude + deg_lat)
-        long_range = (longitude - deg_lat * 2, longitude + deg_lat * 2)
-        queryset = self.filter(
-            latitude__range=lat_range,
-            longitude__range=long_range
+    def _near_places(self, origin, distance):
+        started = default_timer()
+        (source, rows) = self._candidate_rows(origin, distance)
+        fetched = default_timer()
+        # check the candidate coordinates in one batch, then load only
+        # the places that are actually in range
+        matches = loci.distance.within(origin, rows, distance)
+        checked = default_timer()
+        places = self._load(matches, len(rows))
+        loaded = default_timer()
+
+        loci.metrics.emit(
+            'near.sql', (fetched - started) + (loaded - checked), source=source)
+        loci.metrics.emit('near.math', checked - fetched, source=source)
+        loci.metrics.emit('near.candidates', len(rows), source=source)
+        loci.metrics.emit('near.results', len(matches), source=source)
+        return places
+
+    def _near_rows(self, origin, slack, distance):
+        """
+        Returns the ``(pk, latitude, longitude)`` rows within ``distance``
+        plus ``slack`` miles of ``origin``, and the number of candidates
+        checked, for :meth:`_cached`.
+
+        """
+        (source, rows) = self._candidate_rows(origin, distance + slack)
+        matched = set(pk for (pk, miles) in loci.distance.within(
+            origin, rows, distance + slack))
+        return ([row for row in rows if row[0] in matched], len(rows))
+
+    def _candidate_rows(self, origin, distance, use_index=True):
+        """
+        Returns the source (``'index'`` or ``'database'``) and the
+        ``(pk, latitude, longitude)`` rows of the bounding box prefilter
+        for a search of ``distance`` miles around ``origin``.
+
+        """
+        index = loci.spatialindex.get_index() if use_index else None
+        if index is not None:
+            # the in-memory index knows every place; the queryset's own
+            # filters are applied when the matches are loaded
+            rows = index.rows_in_box(
+                *loci.distance.bounding_box(origin, distance))
+            rows.sort()
+            return ('index', rows)
+        queryset = self._bounding_box(origin[0], origin[1], distance)
+        return (
+            'database',
+            list(queryset.values_list('pk', 'latitude', 'longitude'))
         )
-        
-        locations = []
-        for location in queryset:
-            if location.latitude and location.longitude:
-                location.exact_distance = geopy.distance.distance(
-                    (latitude, longitude),
-                    (location.latitude, location.longitude)
+
+    def within(self, location, distance=None):
+        """
+        Returns a :class:`QuerySet` of the items within the given
+        distance of the given location, annotated with a ``distance``
+        attribute (in miles) that is calculated by the database.
+
+        Takes the same arguments as :meth:`near`. The result can be
+        filtered further, ordered with ``order_by('distance')`` and
+        sliced, so the database does the work of pruning and limiting.
+
+        """
+        resolved = _resolve_location(location, distance)
+        if resolved is None:
+            return self.none()
+        (latitude, longitude, distance) = resolved
+
+        (sql, params) = loci.distance.distance_sql(
+            self._column('latitude'),
+            self._column('longitude'),
+            (latitude, longitude),
+        )
+        return self._bounding_box(latitude, longitude, distance).extra(
+            select={'distance': sql},
+            select_params=params,
+            where=['%s <= %%s' % sql],
+            params=params + [distance],
+        )
+
+    def distance_page(self, location, distance=None, after=None, size=20,
+            unlocated=False):
+        """
+        Returns one page of the items of :meth:`within`, ordered by
+        distance and then primary key, as ``(places, next_key)``.
+
+        Pages are found by their position rather than an offset: pass
+        the ``next_key`` of a page as ``after`` to get the following
+        one, so the database can start from there instead of counting
+        through the earlier rows. ``next_key`` is ``None`` on the last
+        page. Keys compare distances in whole millionths of a mile, so
+        a page ends in the same place however the database rounds the
+        distances it recomputes.
+
+        The search circle reaches only a little beyond the previous
+        page and widens until the page is full, so distances are
+        computed and sorted for the places out to about where the page
+        ends rather than for the whole table.
+
+        With ``unlocated``, the items without coordinates (or waiting
+        for the deferred geocoder) follow the others, by primary key,
+        with ``distance`` set to ``None``. If the location has no
+        coordinates, all items are paged by primary key that way.
+
+        """
+        pk = self.model._meta.pk.name
+        resolved = _resolve_location(location, distance)
+        places = []
+        if resolved is not None and (after is None or after[0] is not None):
+            places = self._distance_page(resolved, after, size + 1)
+            for place in places:
+                place.page_key = (place.distance_key, place.pk)
+
+        if (resolved is None or unlocated) and len(places) <= size:
+            queryset = self.order_by(pk)
+            if resolved is not None:
+                queryset = queryset.filter(
+                    Q(latitude__isnull=True)
+                    | Q(longitude__isnull=True)
+                    | Q(geocode_pending=True)
+                )
+            if after is not None and (resolved is None or after[0] is None):
+                queryset = queryset.filter(pk__gt=after[1])
+            for place in queryset[:size + 1 - len(places)]:
+                place.distance = None
+                place.page_key = (None, place.pk)
+                places.append(place)
+
+        next_key = None
+        if len(places) > size:
+            places = places[:size]
+            next_key = places[-1].page_key
+        return (places, next_key)
+
+    def _distance_page(self, resolved, after, limit):
+        """
+        Returns up to ``limit`` items within ``distance`` of the
+        location, ordered by distance key and primary key, following
+        the ``after`` key if it is given.
+
+        """
+        (latitude, longitude, distance) = resolved
+        pk = self.model._meta.pk.name
+        (sql, params) = loci.distance.distance_sql(
+            self._column('latitude'),
+            self._column('longitude'),
+            (latitude, longitude),
+        )
+        key_sql = 'FLOOR(%s * %s)' % (sql, DISTANCE_KEY_SCALE)
+
+        start = 0.0
+        if after is not None:
+            start = after[0] / float(DISTANCE_KEY_SCALE)
+        radius = start + NEAREST_INITIAL_DISTANCE
+        while True:
+            radius = min(radius, distance)
+            queryset = self.within((latitude, longitude), radius).extra(
+                select={'distance_key': key_sql},
+                select_params=params,
+            ).order_by('distance_key', pk)
+            if after is not None:
+                queryset = queryset.extra(
+                    where=['(%s > %%s OR (%s = %%s AND %s > %%s))' % (
+                        key_sql, key_sql, self._column(pk))],
+                    params=params + [after[0]] + params + list(after),
+                )
+            places = list(queryset[:limit])
+            if len(places) >= limit or radius >= distance:
+                return places
+            # widen the ring beyond the previous page
+            radius = start + (radius - start) * 4
+
+    def within_bounds(self, southwest, northeast):
+        """
+        Returns a :class:`QuerySet` of the items inside the rectangle
+        between two (lat, lon) corners, e.g. a map viewport. If the
+        west edge lies east of the east edge, the rectangle crosses the
+        antimeridian.
+
+        This is a plain range lookup on the indexed coordinates; no
+        distances are calculated.
+
+        """
+        return self._boxes(
+            [loci.distance.viewport_box(southwest, northeast)])
+
+    def viewport(self, southwest, northeast, max_places=VIEWPORT_MAX_PLACES,
+            grid=VIEWPORT_GRID):
+        """
+        Returns ``(places, clusters)`` for a map viewport: the items of
+        :meth:`within_bounds` if there are at most ``max_places`` of
+        them, and otherwise one cluster for each occupied cell of a
+        ``grid`` by ``grid`` division of the viewport, counted and
+        averaged by the database. The other list is empty.
+
+        Each cluster is a dictionary with the ``count`` of items in the
+        cell and their mean ``latitude`` and ``longitude``.
+
+        """
+        queryset = self.within_bounds(southwest, northeast)
+        places = list(queryset[:max_places + 1])
+        if len(places) <= max_places:
+            return (places, [])
+        return ([], self._clusters(southwest, northeast, grid))
+
+    def _clusters(self, southwest, northeast, grid):
+        (south, west) = southwest
+        (north, east) = northeast
+        width = (east - west) % 360 or 360
+        cell_height = max(north - south, 1e-9) / grid
+        cell_width = float(width) / grid
+        (lat_range, long_ranges) = loci.distance.viewport_box(
+            southwest, northeast)
+
+        cells = {}
+        for long_range in long_ranges:
+            # the part east of the antimeridian is shifted a turn east,
+            # so that columns and means continue across it
+            shift = 360 if long_range[1] < west else 0
+            rows = self._boxes([(lat_range, [long_range])]).extra(
+                # ordered, to line the parameters up with the columns
+                select=OrderedDict([
+                    ('cell_row', 'FLOOR((%s - %%s) / %%s)' % (
+                        self._column('latitude'))),
+                    ('cell_col', 'FLOOR((%s + %%s - %%s) / %%s)' % (
+                        self._column('longitude'))),
+                ]),
+                select_params=[south, cell_height, shift, west, cell_width],
+            ).order_by().values('cell_row', 'cell_col').annotate(
+                count=Count('pk'),
+                mean_latitude=Avg('latitude'),
+                mean_longitude=Avg('longitude'),
+            )
+            for row in rows:
+                # the north and east edges belong to the last cells
+                key = (
+                    min(int(row['cell_row']), grid - 1),
+                    min(int(row['cell_col']), grid - 1),
                 )
-                if location.exact_distance.miles <= distance:
-                    locations.append(location)
+                cell = cells.setdefault(key, [0, 0.0, 0.0])
+                cell[0] += row['count']
+                cell[1] += row['mean_latitude'] * row['count']
+                cell[2] += (row['mean_longitude'] + shift) * row['count']
+
+        clusters = []
+        for key in sorted(cells):
+            (count, latitude, longitude) = cells[key]
+            longitude /= count
+            if longitude > 180:
+                longitude -= 360
+            clusters.append({
+                'count': count,
+                'latitude': latitude / count,
+                'longitude': longitude,
+            })
+        return clusters
+
+    def nearest(self, location, k, max_distance=None):
+        """
+        Returns a list of the ``k`` items in the :class:`QuerySet`
+        closest to the given location, nearest first, each with an
+        ``exact_distance`` attached. If ``max_distance`` is given,
+        items further away than that are left out, so fewer than ``k``
+        items may be returned.
+
+        The search starts with a small box around the location and
+        widens it, fetching only the new ring of candidates each time,
+        until ``k`` candidates lie within the circle the box encloses;
+        nothing outside the box can be closer than those.
+
+        """
+        coordinates = _coordinates(location)
+        if coordinates is None or k < 1:
+            return ProximityResult()
+        if PROXIMITY_CACHE_TIMEOUT:
+            (rows, candidates) = self._cached(
+                self._nearest_rows, coordinates, k, max_distance)
+            return self._load(
+                _k_nearest(coordinates, rows, k, max_distance), candidates)
+        return self._load(*self._nearest_matches(coordinates, k, max_distance))
+
+    def _nearest_matches(self, coordinates, k, max_distance):
+        (latitude, longitude) = coordinates
+        index = loci.spatialindex.get_index()
+        if index is not None and self.model is Place and not self.query.where:
+            # the index holds exactly the rows of an unfiltered queryset
+            candidates = index.nearest(coordinates, k, max_distance)
+            return (candidates, len(candidates))
+
+        radius = NEAREST_INITIAL_DISTANCE
+        if max_distance is not None:
+            radius = min(radius, max_distance)
+        candidates = []
+        searched = None
+        while True:
+            box = loci.distance.bounding_box(coordinates, radius)
+            ring = self._boxes([box])
+            if searched is not None:
+                ring = ring.exclude(searched)
+            rows = list(ring.values_list('pk', 'latitude', 'longitude'))
+            if rows:
+                (pks, latitudes, longitudes) = zip(*rows)
+                miles = loci.distance.batch_distances(
+                    coordinates, latitudes, longitudes)
+                candidates.extend(zip(pks, [float(d) for d in miles]))
+            searched = self._box_q(*box)
+
+            inside = len([pk for (pk, d) in candidates if d <= radius])
+            if (
+                inside >= k
+                or radius >= loci.distance.MAX_DISTANCE
+                or (max_distance is not None and radius >= max_distance)
+            ):
+                break
+
+            # grow the box by the area the current density suggests
+            if inside:
+                factor = max(2.0, sqrt(float(k) / inside) * 1.25)
+            else:
+                factor = 4.0
+            radius *= factor
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+
+        searched_count = len(candidates)
+        if max_distance is not None:
+            candidates = [(pk, d) for (pk, d) in candidates if d <= max_distance]
+        candidates.sort(key=lambda candidate: (candidate[1], candidate[0]))
+        return (candidates[:k], searched_count)
+
+    def _nearest_rows(self, origin, slack, k, max_distance):
+        """
+        Returns rows holding the ``k`` items nearest to any point within
+        ``slack`` miles of ``origin``, and the number of candidates
+        checked, for :meth:`_cached`.
+
+        """
+        if max_distance is not None:
+            max_distance += slack
+        (matches, candidates) = self._nearest_matches(origin, k, max_distance)
+        if len(matches) < k:
+            # everything in reach was found
+            if max_distance is None:
+                radius = loci.distance.MAX_DISTANCE
+            else:
+                radius = max_distance
+        else:
+            # the k nearest to a point up to slack miles away are no
+            # further from it than the kth match here plus slack
+            radius = matches[-1][1] + 2 * slack
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+        (source, rows) = self._candidate_rows(
+            origin,
+            radius * (1 + loci.distance.TOLERANCE),
+            use_index=self.model is Place and not self.query.where
+        )
+        return (rows, candidates)
+
+    def _cached(self, compute, origin, *args):
+        """
+        Returns ``compute(rounded_origin, slack, *args)`` from the
+        proximity result cache, which is enabled with
+        ``LOCI_PROXIMITY_CACHE_TIMEOUT``.
+
+        The origin is rounded to ``LOCI_PROXIMITY_CACHE_PRECISION``
+        decimal places (default 3, about 100m), so nearby origins share
+        entries. ``compute`` returns ``(rows, candidates)``, where
+        ``rows`` hold every place the query could return for any origin
+        within ``slack`` miles of the rounded one; callers filter and
+        measure them against their exact origin, so results are the
+        same as without the cache.
+
+        Keys include the queryset's SQL and the place generation, which
+        every save or delete advances, so results are never served for
+        outdated data.
+
+        """
+        rounded = tuple(
+            round(value, PROXIMITY_CACHE_PRECISION) for value in origin)
+        try:
+            sql = str(self.query)
+        except EmptyResultSet:
+            return ([], 0)
+        key = 'loci:proximity:%s' % hashlib.md5(repr((
+            compute.__name__,
+            rounded,
+            args,
+            self.model._meta.db_table,
+            sql,
+            loci.generation.current(),
+        )).encode('utf-8')).hexdigest()
+
+        result = cache.get(key)
+        if result is None:
+            result = compute(
+                rounded, _rounding_slack(PROXIMITY_CACHE_PRECISION), *args)
+            cache.set(key, result, PROXIMITY_CACHE_TIMEOUT)
+        return result
+
+    def near_many(self, origins, distance):
+        """
+        Finds the items within ``distance`` miles of each of many
+        origins (:class:`Place` instances or (lat, lon) tuples).
+
+        Returns a dictionary mapping each origin's (lat, lon) tuple to a
+        list of ``(place, distance)`` pairs, nearest first; a place near
+        several origins is the same object in each list. Origins without
+        coordinates are left out. See :meth:`iter_near_many` to process
+        the results as they are found.
+
+        """
+        return dict(self.iter_near_many(origins, distance))
+
+    def iter_near_many(self, origins, distance):
+        """
+        Like :meth:`near_many`, but yields ``((lat, lon), matches)``
+        pairs, so only a few groups of origins are held in memory.
+
+        Origins are bucketed into grid cells about the size of the
+        search circle. The candidates for a chunk of
+        ``NEAR_MANY_CHUNK_SIZE`` buckets are fetched in one query, and
+        the distances from each origin to the candidates near its
+        bucket are computed in one batch.
+
+        """
+        cell_size = max(distance / 69.0, 0.01)
+        buckets = {}
+        for origin in origins:
+            coordinates = _coordinates(origin)
+            if coordinates is None:
+                continue
+            cell = (
+                int(floor(coordinates[0] / cell_size)),
+                int(floor(coordinates[1] / cell_size)),
+            )
+            buckets.setdefault(cell, set()).add(coordinates)
+
+        cells = sorted(buckets)
+        for start in range(0, len(cells), NEAR_MANY_CHUNK_SIZE):
+            chunk = cells[start:start + NEAR_MANY_CHUNK_SIZE]
+
+            # one box per bucket, big enough for all its origins
+            boxes = []
+            for cell in chunk:
+                center = ((cell[0] + 0.5) * cell_size, (cell[1] + 0.5) * cell_size)
+                corners = [
+                    (cell[0] * cell_size, cell[1] * cell_size),
+                    ((cell[0] + 1) * cell_size, (cell[1] + 1) * cell_size),
+                ]
+                spread = max(loci.distance.batch_distances(
+                    center,
+                    [c[0] for c in corners],
+                    [c[1] for c in corners]
+                ))
+                boxes.append((cell, center, distance + float(spread)))
+
+            index = loci.spatialindex.GridIndex(cell_size)
+            rows = self._boxes([
+                loci.distance.bounding_box(center, radius)
+                for (cell, center, radius) in boxes
+            ]).values_list('pk', 'latitude', 'longitude')
+            for (pk, latitude, longitude) in rows:
+                index.add(pk, latitude, longitude)
+
+            results = []
+            for (cell, center, radius) in boxes:
+                (lat_range, long_ranges) = loci.distance.bounding_box(
+                    center, radius)
+                candidates = index.rows_in_box(lat_range, long_ranges)
+                for origin in sorted(buckets[cell]):
+                    matches = loci.distance.within(origin, candidates, distance)
+                    matches.sort(key=lambda match: (match[1], match[0]))
+                    results.append((origin, matches))
+
+            places = self._in_bulk(list(set(
+                pk for (origin, matches) in results for (pk, miles) in matches
+            )))
+            for (origin, matches) in results:
+                yield (origin, [
+                    (places[pk], loci.distance.as_distance(miles))
+                    for (pk, miles) in matches
+                    if pk in places
+                ])
+
+    def _bounding_box(self, latitude, longitude, distance):
+        """
+        Returns the items in a box around the given coordinates which
+        is large enough to hold everything within the given distance.
+
+        """
+        return self._boxes([loci.distance.bounding_box(
+            (latitude, longitude), distance)])
+
+    def _boxes(self, boxes):
+        """
+        Returns the items in any of the given ``(latitude_range,
+        longitude_ranges)`` boxes, also checked against the spatial
+        index when one is set up (see :mod:`loci.spatial`).
+
+        """
+        queryset = self.filter(reduce(operator.or_, [
+            self._box_q(lat_range, long_ranges)
+            for (lat_range, long_ranges) in boxes
+        ]))
+        field = self.model._meta.get_field('latitude')
+        spatial = loci.spatial.box_sql(
+            connections[self.db],
+            field.model._meta.db_table,
+            field.model._meta.pk.column,
+            boxes
+        )
+        if spatial is not None:
+            queryset = queryset.extra(where=[spatial[0]], params=spatial[1])
+        return queryset
+
+    def _box_q(self, lat_range, long_ranges):
+        long_q = reduce(operator.or_, [
+            Q(longitude__range=long_range) for long_range in long_ranges
+        ])
+        # places waiting for the deferred geocoder may have outdated
+        # coordinates
+        box_q = Q(latitude__range=lat_range, geocode_pending=False) & long_q
+
+        if GEOHASH_LOOKUPS:
+            # fetch candidates with range scans on the geohash index,
+            # one per cell of the geohash grid overlapping the box
+            prefixes = loci.geohash.cover(lat_range, long_ranges)
+            if prefixes:
+                box_q &= reduce(operator.or_, [
+                    Q(geohash__gte=prefix,
+                      geohash__lt=prefix + loci.geohash.END)
+                    for prefix in prefixes
+                ])
+        return box_q
+
+    def _column(self, name):
+        """
+        Returns the quoted, table-qualified column for a :class:`Place`
+        field, for use in raw SQL fragments.
+
+        """
+        field = self.model._meta.get_field(name)
+        qn = connections[self.db].ops.quote_name
+        return '%s.%s' % (qn(field.model._meta.db_table), qn(field.column))
+
+    def _load(self, matches, candidates):
+        """
+        Loads the places for a list of ``(pk, miles)`` pairs, keeping
+        their order and attaching ``exact_distance``, and returns them
+        as a :class:`ProximityResult`.
+
+        """
+        places = self._in_bulk([pk for (pk, miles) in matches])
+        locations = ProximityResult(candidates=candidates)
+        for (pk, miles) in matches:
+            place = places.get(pk)
+            if place is not None:
+                place.exact_distance = loci.distance.as_distance(miles)
+                locations.append(place)
         return locations
 
+    def _in_bulk(self, ids):
+        """
+        Like :meth:`in_bulk`, but splits long id lists into several
+        queries to stay below database parameter limits.
+
+        """
+        places = {}
+        for start in range(0, len(ids), IN_BULK_BATCH_SIZE):
+            places.update(self.in_bulk(ids[start:start + IN_BULK_BATCH_SIZE]))
+        return places
+
 
 class Place(models.Model):
     """
@@ -101,13 +799,30 @@ class Place(models.Model):
     
     latitude = models.FloatField(null=True, blank=True, default=None)
     longitude = models.FloatField(null=True, blank=True, default=None)
+    geohash = models.CharField(
+        max_length=loci.geohash.PRECISION,
+        blank=True,
+        default='',
+        db_index=True,
+        editable=False
+    )
+    geocode_pending = models.BooleanField(
+        default=False,
+        db_index=True,
+        editable=False
+    )
     
     objects = PlaceManager()
+
+    class Meta:
+        index_together = [['latitude', 'longitude']]
     
     def __unicode__(self):
         return u'%s (%s, %s)' % (self.name, self.latitude, self.longitude)
     
     def save(self, *args, **kwargs):
+        started = default_timer()
+        deferred = geocoded = False
         if (
             self.full_address
             and (
@@ -115,15 +830,47 @@ class Place(models.Model):
                 or getattr(settings, 'LOCI_ALWAYS_SET_LOCATION', False)
             )
         ):
-            geoloc = geocode(self.full_address)
-            self.location = geoloc.location
-            if not self.city:
-                self.city = geoloc.city
-            if not self.state:
-                self.state = geoloc.state
-            if not self.zip_code:
-                self.zip_code = geoloc.zip_code
+            if loci.deferred.MODE:
+                # store the place now and let a worker look it up
+                self.geocode_pending = deferred = True
+            else:
+                geoloc = geocode(self.full_address)
+                geocoded = True
+                self.geocode_pending = False
+                self.location = geoloc.location
+                if not self.city:
+                    self.city = geoloc.city
+                if not self.state:
+                    self.state = geoloc.state
+                if not self.zip_code:
+                    self.zip_code = geoloc.zip_code
+        elif self.location != (None, None):
+            # coordinates set by the caller replace any pending lookup,
+            # which would otherwise overwrite them
+            self.geocode_pending = False
+        self.update_geohash()
         super(Place, self).save(*args, **kwargs)
+        if deferred:
+            loci.deferred.enqueue(self)
+        loci.metrics.emit(
+            'place.save',
+            default_timer() - started,
+            geocoded=geocoded,
+            deferred=deferred
+        )
+
+    def update_geohash(self):
+        """
+        Sets :attr:`geohash` from the current coordinates. Called by
+        :meth:`save`; rows changed in other ways (e.g. with
+        ``QuerySet.update``) can be fixed with the ``loci_geohash``
+        management command.
+
+        """
+        if self.latitude is None or self.longitude is None:
+            self.geohash = ''
+        else:
+            self.geohash = loci.geohash.encode(self.latitude, self.longitude)
     
     def distance_to(self, latitude, longitude):
         return geopy.distance.distance(
@@ -151,3 +898,66 @@ class Place(models.Model):
     @location.setter
     def location(self, point):
         (self.latitude, self.longitude) = point
+
+
+class GeocodeResult(models.Model):
+    """
+    A stored geocoder answer, kept in the database so it outlives the
+    cache (see :mod:`loci.geostore`).
+
+    ``key`` is the digest of the normalized ``query`` that the geocode
+    cache uses too.
+
+    """
+
+    key = models.CharField(max_length=32, unique=True)
+    query = models.TextField()
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    address = models.CharField(max_length=180, blank=True, default='')
+    city = models.CharField(max_length=50, blank=True, default='')
+    state = USStateField(blank=True)
+    zip_code = models.CharField(max_length=10, blank=True, default='')
+    provider = models.CharField(max_length=50, blank=True, default='')
+    fetched_at = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return u'%s (%s, %s)' % (self.query, self.latitude, self.longitude)
+
+    @property
+    def location_data(self):
+        """
+        The result in the ``(location, address_data)`` form used by
+        :mod:`loci.utils`.
+
+        """
+        return (
+            (self.latitude, self.longitude),
+            (
+                self.address or None,
+                self.city or None,
+                self.state or None,
+                self.zip_code or None,
+            ),
+        )
+
+
+connection_created.connect(loci.distance.register_sql_functions)
+connection_created.connect(loci.spatial.load_spatialite)
+
+
+def place_saved(sender, instance, **kwargs):
+    if issubclass(sender, Place):
+        loci.spatialindex.place_saved(instance)
+
+
+def place_deleted(sender, instance, **kwargs):
+    if issubclass(sender, Place):
+        loci.spatialindex.place_deleted(instance)
+
+
+# signals are sent for the saved class only, so subclasses of Place are
+# matched here rather than with sender=Place; saves of other models must
+# not invalidate cached proximity results
+post_save.connect(place_saved)
+post_delete.connect(place_deleted)
@@ -0,0 +1,27 @@
+"""
+Debug Toolbar Panel
+===================
+
+Shows the :mod:`loci.metrics` summary of a request in
+django-debug-toolbar. Add ``'loci.panels.MetricsPanel'`` to
+``DEBUG_TOOLBAR_PANELS`` and ``'loci.metrics.MetricsMiddleware'`` to
+``MIDDLEWARE_CLASSES``, after the toolbar's middleware.
+
+"""
+
+from debug_toolbar.panels import Panel
+
+
+class MetricsPanel(Panel):
+    title = 'Loci'
+    template = 'loci/debug_toolbar_panel.html'
+
+    @property
+    def nav_subtitle(self):
+        metrics = self.get_stats().get('metrics', [])
+        return '%d measurements' % sum(entry['count'] for (key, entry) in metrics)
+
+    def process_response(self, request, response):
+        self.record_stats({
+            'metrics': sorted(getattr(request, 'loci_metrics', {}).items()),
+        })
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+# sent by the deferred geocoding worker when it has looked up a place
+# saved with LOCI_DEFERRED_GEOCODING; success is False if the address
+# could not be found
+place_geocoded = Signal(providing_args=['place', 'success'])
+
+# sent for each measurement reported through loci.metrics.emit
+metric = Signal(providing_args=['name', 'value', 'tags'])
@@ -0,0 +1,205 @@
+"""
+Spatial Backend
+===============
+
+Optional use of a spatial database's index for the candidate prefilter
+of the proximity and viewport queries in :mod:`loci.models`.
+
+With ``LOCI_SPATIAL_BACKEND = True`` and the ``loci_spatial`` command
+run once, the place table gets a ``loci_point`` geometry column that
+triggers keep in step with ``latitude`` and ``longitude``, and an
+R-tree (SpatiaLite) or GiST (PostGIS) index on it. Bounding box
+lookups then also test the box against that index, so the database can
+find candidates without scanning a range of the coordinate index.
+
+Only the prefilter changes: the same boxes are searched and distances
+are still checked by :mod:`loci.distance`, so results are identical to
+those of the plain float columns. Other databases, and databases where
+the column has not been set up, keep using the float columns alone.
+
+Settings:
+
+``LOCI_SPATIALITE_LIBRARY``
+    The SpatiaLite extension loaded into SQLite connections (default
+    ``'mod_spatialite'``).
+
+"""
+
+from django.conf import settings
+from django.db import DatabaseError
+
+
+ENABLED = getattr(settings, 'LOCI_SPATIAL_BACKEND', False)
+
+SPATIALITE_LIBRARY = getattr(
+    settings, 'LOCI_SPATIALITE_LIBRARY', 'mod_spatialite')
+
+COLUMN = 'loci_point'
+
+SRID = 4326
+
+POSTGIS = 'postgis'
+SPATIALITE = 'spatialite'
+
+
+def load_spatialite(sender, connection, **kwargs):
+    """
+    Loads SpatiaLite into new SQLite connections. Connected to
+    :data:`django.db.backends.signals.connection_created`.
+
+    """
+    if not ENABLED or connection.vendor != 'sqlite':
+        return
+    try:
+        connection.connection.enable_load_extension(True)
+        connection.connection.load_extension(SPATIALITE_LIBRARY)
+    except Exception:
+        # not available in this build of SQLite; the float columns
+        # are used instead
+        connection.loci_spatialite = False
+    else:
+        connection.loci_spatialite = True
+
+
+def spatial_kind(connection):
+    """
+    Returns ``POSTGIS`` or ``SPATIALITE`` for a connection that can
+    run spatial queries, or ``None``.
+
+    """
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT 1 FROM pg_proc WHERE proname = 'postgis_version'")
+        if cursor.fetchone():
+            return POSTGIS
+    elif connection.vendor == 'sqlite':
+        if getattr(connection, 'loci_spatialite', False):
+            return SPATIALITE
+    return None
+
+
+_ready = {}
+
+
+def is_ready(connection, table):
+    """
+    Returns the spatial kind of a connection if ``table`` has had its
+    point column set up, otherwise ``None``. The answer is remembered
+    per database; :func:`reset` forgets it.
+
+    """
+    if not ENABLED:
+        return None
+    key = (connection.alias, table)
+    if key not in _ready:
+        kind = spatial_kind(connection)
+        if kind is not None and not _has_column(connection, kind, table):
+            kind = None
+        _ready[key] = kind
+    return _ready[key]
+
+
+def reset():
+    _ready.clear()
+
+
+def _has_column(connection, kind, table):
+    cursor = connection.cursor()
+    try:
+        if kind == POSTGIS:
+            cursor.execute(
+                'SELECT 1 FROM information_schema.columns'
+                ' WHERE table_name = %s AND column_name = %s',
+                [table, COLUMN])
+        else:
+            cursor.execute(
+                'SELECT 1 FROM geometry_columns'
+                ' WHERE f_table_name = %s AND f_geometry_column = %s',
+                [table, COLUMN])
+    except DatabaseError:
+        return False
+    return cursor.fetchone() is not None
+
+
+def box_sql(connection, table, pk_column, boxes):
+    """
+    Returns ``(sql, params)`` for a condition that holds for rows of
+    ``table`` whose point lies in any of the given
+    ``(latitude_range, longitude_ranges)`` boxes and can be answered
+    from the spatial index, or ``None`` if the index is not available.
+
+    """
+    kind = is_ready(connection, table)
+    if kind is None:
+        return None
+    qn = connection.ops.quote_name
+
+    conditions = []
+    params = []
+    for (lat_range, lon_ranges) in boxes:
+        for lon_range in lon_ranges:
+            if kind == POSTGIS:
+                conditions.append(
+                    '%s.%s && ST_MakeEnvelope(%%s, %%s, %%s, %%s, %s)'
+                    % (qn(table), qn(COLUMN), SRID))
+            else:
+                conditions.append(
+                    '%s.%s IN (SELECT ROWID FROM SpatialIndex'
+                    ' WHERE f_table_name = %%s AND f_geometry_column = %%s'
+                    ' AND search_frame = BuildMbr(%%s, %%s, %%s, %%s, %s))'
+                    % (qn(table), qn(pk_column), SRID))
+                params.extend([table, COLUMN])
+            params.extend(
+                [lon_range[0], lat_range[0], lon_range[1], lat_range[1]])
+    return ('(%s)' % ' OR '.join(conditions), params)
+
+
+def setup_sql(kind, table, pk_column):
+    """
+    Returns the statements that add the point column, its index and the
+    triggers maintaining it to ``table``.
+
+    """
+    names = {
+        'table': table,
+        'pk': pk_column,
+        'column': COLUMN,
+        'srid': SRID,
+    }
+    if kind == POSTGIS:
+        statements = [
+            'ALTER TABLE "%(table)s"'
+            ' ADD COLUMN "%(column)s" geometry(Point, %(srid)s)',
+            'UPDATE "%(table)s" SET "%(column)s" ='
+            ' ST_SetSRID(ST_MakePoint(longitude, latitude), %(srid)s)',
+            'CREATE INDEX "%(table)s_%(column)s_gist"'
+            ' ON "%(table)s" USING GIST ("%(column)s")',
+            'CREATE OR REPLACE FUNCTION "%(table)s_%(column)s"()'
+            ' RETURNS trigger AS $$ BEGIN'
+            ' NEW."%(column)s" :='
+            ' ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), %(srid)s);'
+            ' RETURN NEW; END; $$ LANGUAGE plpgsql',
+            'CREATE TRIGGER "%(table)s_%(column)s"'
+            ' BEFORE INSERT OR UPDATE OF latitude, longitude ON "%(table)s"'
+            ' FOR EACH ROW EXECUTE PROCEDURE "%(table)s_%(column)s"()',
+        ]
+    else:
+        update = (
+            'UPDATE "%(table)s" SET "%(column)s" ='
+            ' MakePoint(NEW.longitude, NEW.latitude, %(srid)s)'
+            ' WHERE "%(pk)s" = NEW."%(pk)s";'
+        )
+        statements = [
+            "SELECT AddGeometryColumn("
+            "'%(table)s', '%(column)s', %(srid)s, 'POINT', 'XY')",
+            'UPDATE "%(table)s" SET "%(column)s" ='
+            ' MakePoint(longitude, latitude, %(srid)s)',
+            "SELECT CreateSpatialIndex('%(table)s', '%(column)s')",
+            'CREATE TRIGGER "%(table)s_%(column)s_insert"'
+            ' AFTER INSERT ON "%(table)s" BEGIN ' + update + ' END',
+            'CREATE TRIGGER "%(table)s_%(column)s_update"'
+            ' AFTER UPDATE OF latitude, longitude ON "%(table)s"'
+            ' BEGIN ' + update + ' END',
+        ]
+    return [statement % names for statement in statements]
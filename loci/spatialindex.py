@@ -0,0 +1,270 @@
+"""
+Spatial Index
+=============
+
+An optional in-process index of place coordinates, so proximity
+queries on a read-heavy, rarely changing place table can find matching
+ids without a database round trip and then load only those rows.
+
+Enable it with ``LOCI_SPATIAL_INDEX = True``. The index is built from
+``Place.objects.values_list('id', 'latitude', 'longitude')`` on first
+use and kept in step with ``post_save``/``post_delete`` signals. Other
+processes notice changes through :mod:`loci.generation` and rebuild.
+
+Settings:
+
+``LOCI_SPATIAL_INDEX_MAX_BYTES``
+    Memory budget for the index (default 64MB). If the place table is
+    too large to fit, the index is not built and queries go to the
+    database as usual.
+
+``LOCI_SPATIAL_INDEX_MAX_AGE``
+    Seconds after which the index is rebuilt even if no change was
+    seen (default 600), to pick up rows saved in transactions that had
+    not committed when the index was built.
+
+"""
+
+from array import array
+from math import floor
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.loading import get_model
+
+import loci.distance
+import loci.generation
+
+
+ENABLED = getattr(settings, 'LOCI_SPATIAL_INDEX', False)
+
+MAX_BYTES = getattr(settings, 'LOCI_SPATIAL_INDEX_MAX_BYTES', 64 * 1024 * 1024)
+
+MAX_AGE = getattr(settings, 'LOCI_SPATIAL_INDEX_MAX_AGE', 600)
+
+# rough cost of one place: three array slots plus its share of the
+# key and cell dictionaries
+BYTES_PER_PLACE = 150
+
+
+class GridIndex(object):
+    """
+    Points stored in flat arrays and bucketed into cells of a regular
+    latitude/longitude grid. Supports incremental adds and removals.
+
+    """
+
+    def __init__(self, cell_size=0.5):
+        self.cell_size = cell_size
+        self.keys = array('l')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.slots = {}
+        self.free = []
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def nbytes(self):
+        return len(self.keys) * BYTES_PER_PLACE
+
+    def _cell(self, latitude, longitude):
+        return (
+            int(floor(latitude / self.cell_size)),
+            int(floor(longitude / self.cell_size)),
+        )
+
+    def add(self, key, latitude, longitude):
+        """
+        Adds a point, replacing any point already stored for ``key``.
+
+        """
+        self.remove(key)
+        if latitude is None or longitude is None:
+            return
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+        self.slots[key] = slot
+        self.cells.setdefault(self._cell(latitude, longitude), []).append(slot)
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        cell = self._cell(self.latitudes[slot], self.longitudes[slot])
+        self.cells[cell].remove(slot)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        self.free.append(slot)
+
+    def _slots_in_box(self, lat_range, lon_ranges):
+        (row_min, _) = self._cell(lat_range[0], 0)
+        (row_max, _) = self._cell(lat_range[1], 0)
+        slots = []
+        for lon_range in lon_ranges:
+            (_, col_min) = self._cell(0, lon_range[0])
+            (_, col_max) = self._cell(0, lon_range[1])
+            cell_count = (row_max - row_min + 1) * (col_max - col_min + 1)
+            if cell_count > len(self.cells):
+                # cheaper to walk the occupied cells than the box
+                for ((row, col), cell) in self.cells.items():
+                    if row_min <= row <= row_max and col_min <= col <= col_max:
+                        slots.extend(cell)
+            else:
+                for row in range(row_min, row_max + 1):
+                    for col in range(col_min, col_max + 1):
+                        slots.extend(self.cells.get((row, col), ()))
+        return slots
+
+    def _rows(self, slots):
+        return [
+            (self.keys[slot], self.latitudes[slot], self.longitudes[slot])
+            for slot in slots
+        ]
+
+    def rows_in_box(self, lat_range, lon_ranges):
+        """
+        Returns ``(key, latitude, longitude)`` rows for the points in
+        the cells overlapping a box (as returned by
+        :func:`loci.distance.bounding_box`).
+
+        """
+        return self._rows(self._slots_in_box(lat_range, lon_ranges))
+
+    def within(self, origin, distance):
+        """
+        Returns ``(key, miles)`` pairs for the points within
+        ``distance`` miles of ``origin``, ordered by key.
+
+        """
+        (lat_range, lon_ranges) = loci.distance.bounding_box(origin, distance)
+        rows = self._rows(sorted(
+            self._slots_in_box(lat_range, lon_ranges),
+            key=lambda slot: self.keys[slot]
+        ))
+        return loci.distance.within(origin, rows, distance)
+
+    def nearest(self, origin, k, max_distance=None):
+        """
+        Returns ``(key, miles)`` pairs for the ``k`` points closest to
+        ``origin``, nearest first.
+
+        """
+        if not self.slots or k < 1:
+            return []
+        # start with about one grid cell and double until k are found
+        radius = self.cell_size * 69.0
+        if max_distance is not None:
+            radius = min(radius, max_distance)
+        while True:
+            (lat_range, lon_ranges) = loci.distance.bounding_box(origin, radius)
+            rows = self._rows(self._slots_in_box(lat_range, lon_ranges))
+            candidates = []
+            if rows:
+                (keys, latitudes, longitudes) = zip(*rows)
+                miles = loci.distance.batch_distances(
+                    origin, latitudes, longitudes)
+                candidates = list(zip(keys, [float(d) for d in miles]))
+            inside = [(key, d) for (key, d) in candidates if d <= radius]
+            if (
+                len(inside) >= k
+                or radius >= loci.distance.MAX_DISTANCE
+                or (max_distance is not None and radius >= max_distance)
+            ):
+                break
+            radius *= 2
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+        inside.sort(key=lambda candidate: (candidate[1], candidate[0]))
+        return inside[:k]
+
+
+_lock = threading.RLock()
+_state = {'index': None, 'generation': None, 'built': 0}
+
+
+def _build():
+    Place = get_model('loci', 'place')
+    generation = loci.generation.current()
+    queryset = Place.objects.filter(
+        latitude__isnull=False,
+        longitude__isnull=False,
+        geocode_pending=False
+    )
+    _state.update(index=None, generation=generation, built=time.time())
+    if queryset.count() * BYTES_PER_PLACE > MAX_BYTES:
+        return None
+    index = GridIndex()
+    for (pk, latitude, longitude) in queryset.values_list(
+            'id', 'latitude', 'longitude').iterator():
+        index.add(pk, latitude, longitude)
+    _state['index'] = index
+    return index
+
+
+def get_index():
+    """
+    Returns the up to date index for this process, building it if
+    needed, or ``None`` if the index is disabled or over budget.
+
+    """
+    if not ENABLED:
+        return None
+    with _lock:
+        if (
+            _state['generation'] != loci.generation.current()
+            or time.time() - _state['built'] > MAX_AGE
+        ):
+            return _build()
+        return _state['index']
+
+
+def invalidate():
+    with _lock:
+        _state.update(index=None, generation=None, built=0)
+
+
+def place_saved(place):
+    """
+    Records a saved place: bumps the generation and, if this process's
+    index was current, applies the change to it in place.
+
+    """
+    with _lock:
+        generation = loci.generation.bump()
+        index = _state['index']
+        if index is None:
+            return
+        if _state['generation'] != generation - 1:
+            # another process changed places too; rebuild on next use
+            invalidate()
+            return
+        if place.geocode_pending:
+            index.remove(place.pk)
+        else:
+            index.add(place.pk, place.latitude, place.longitude)
+        _state['generation'] = generation
+
+
+def place_deleted(place):
+    with _lock:
+        generation = loci.generation.bump()
+        index = _state['index']
+        if index is None:
+            return
+        if _state['generation'] != generation - 1:
+            invalidate()
+            return
+        index.remove(place.pk)
+        _state['generation'] = generation
@@ -1,34 +1,194 @@
+from collections import OrderedDict
+import hashlib
+from math import floor
+
 from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
 
 from loci.models import Place
+import loci.distance
+import loci.generation
 
 
 register = template.Library()
 
 
+MAP_URL = (
+    "http://maps.google.com/maps/api/staticmap?"
+    "size=640x360&maptype=roadmap&sensor=false"
+)
+
+# the static maps API refuses longer URLs
+MAP_URL_LENGTH = getattr(settings, 'LOCI_MAP_URL_LENGTH', 2048)
+
+# 'cluster' to merge nearby markers or 'sample' to drop some of them
+MAP_MARKER_MODE = getattr(settings, 'LOCI_MAP_MARKER_MODE', 'cluster')
+
+MAP_CACHE_TIMEOUT = getattr(settings, 'LOCI_MAP_CACHE_TIMEOUT', 3600)
+
+# about 10m, and keeps each marker short
+MARKER_PRECISION = 4
+
+PLACE_MARKERS = "&markers=color:blue"
+CLUSTER_MARKERS = "&markers=color:purple%7Clabel:C"
+CENTER_MARKERS = "&markers=color:red"
+
+
+def _marker(point):
+    return "%%7C%.*f,%.*f" % (
+        MARKER_PRECISION, point[0], MARKER_PRECISION, point[1])
+
+
+def _markers_length(singles, clusters):
+    length = sum(len(_marker(point)) for point in singles)
+    if singles:
+        length += len(PLACE_MARKERS)
+    if clusters:
+        length += len(CLUSTER_MARKERS)
+        length += sum(len(_marker(point)) for point in clusters)
+    return length
+
+
+def _cluster(points, cell_size):
+    """
+    Groups points into a grid of ``cell_size`` degree cells. Returns
+    the points alone in their cell and the centroids of the others.
+
+    """
+    cells = OrderedDict()
+    for point in points:
+        key = (floor(point[0] / cell_size), floor(point[1] / cell_size))
+        cells.setdefault(key, []).append(point)
+    singles = []
+    clusters = []
+    for members in cells.values():
+        if len(members) == 1:
+            singles.append(members[0])
+        else:
+            clusters.append((
+                sum(p[0] for p in members) / len(members),
+                sum(p[1] for p in members) / len(members),
+            ))
+    return (singles, clusters)
+
+
+def fit_markers(points, budget, mode=None):
+    """
+    Returns ``(singles, clusters)``: the place markers to draw and the
+    cluster markers standing for several places, with at most
+    ``budget`` characters of marker parameters between them.
+
+    All points are drawn if they fit. Otherwise they are either grouped
+    into grid cells that grow until the markers fit, or, in
+    ``'sample'`` mode, an evenly spaced subset of them is drawn.
+
+    """
+    points = list(points)
+    if _markers_length(points, []) <= budget:
+        return (points, [])
+
+    if (mode or MAP_MARKER_MODE) == 'sample':
+        per_marker = max(len(_marker(point)) for point in points)
+        count = max(0, (budget - len(PLACE_MARKERS)) // per_marker)
+        if not count:
+            return ([], [])
+        step = float(len(points)) / count
+        return ([points[int(i * step)] for i in range(count)], [])
+
+    cell_size = 0.01
+    while cell_size < 360:
+        (singles, clusters) = _cluster(points, cell_size)
+        if _markers_length(singles, clusters) <= budget:
+            return (singles, clusters)
+        cell_size *= 1.5
+    return _cluster(points, 360)
+
+
+def map_url(singles, clusters, center=None):
+    url = MAP_URL
+    if singles:
+        url += PLACE_MARKERS + "".join(_marker(point) for point in singles)
+    if clusters:
+        url += CLUSTER_MARKERS + "".join(_marker(point) for point in clusters)
+    if center:
+        url += CENTER_MARKERS + _marker(center)
+    return url
+
+
+def _points(places, center=None, limit=None, near=None):
+    """
+    Returns the (lat, lon) pairs of the places to draw: all of them, or
+    those within ``near`` miles of ``center``, and at most ``limit`` of
+    them (the nearest ones if there is a center).
+
+    Querysets are read with ``values_list`` rather than as models.
+
+    """
+    if isinstance(places, QuerySet) and places.query.can_filter():
+        if center and limit:
+            places = places.nearest(center, limit, max_distance=near)
+            return [(p.latitude, p.longitude) for p in places]
+        if center and near is not None:
+            places = places.within(center, near)
+        elif limit:
+            places = places[:limit]
+        return [
+            point for point in places.values_list('latitude', 'longitude')
+            if point[0] is not None
+        ]
+
+    if isinstance(places, QuerySet):
+        rows = places.values_list('latitude', 'longitude')
+    else:
+        rows = [(place.latitude, place.longitude) for place in places]
+    points = [point for point in rows if point[0] is not None]
+    if center and (limit or near is not None):
+        matches = loci.distance.within(
+            center,
+            [(i, lat, lon) for (i, (lat, lon)) in enumerate(points)],
+            loci.distance.MAX_DISTANCE if near is None else near
+        )
+        matches.sort(key=lambda match: match[1])
+        points = [points[i] for (i, miles) in matches]
+    if limit:
+        points = points[:limit]
+    return points
+
+
 class PlaceMapNode(template.Node):
     
     @classmethod
     def handle_token(cls, parser, token):
-        bits = token.split_contents()
+        bits = token.split_contents()[1:]
         
-        if len(bits) not in (1, 6):
-            raise template.TemplateSyntaxError
-        if len(bits) == 6:
-            if bits[1] != "for" or bits[3] != "and":
+        kwargs = {}
+        if bits and bits[0] == "for":
+            if len(bits) < 5 or bits[2] != "and":
+                raise template.TemplateSyntaxError
+            kwargs["places"] = parser.compile_filter(bits[1])
+            kwargs["latitude"] = parser.compile_filter(bits[3])
+            kwargs["longitude"] = parser.compile_filter(bits[4])
+            bits = bits[5:]
+        while bits:
+            if len(bits) < 2 or bits[0] not in ("limit", "near"):
                 raise template.TemplateSyntaxError
-            
-            return cls(
-                parser.compile_filter(bits[2]),
-                parser.compile_filter(bits[4]),
-                parser.compile_filter(bits[5])
-            )
-        return cls()
+            kwargs[bits[0]] = parser.compile_filter(bits[1])
+            bits = bits[2:]
+        if "near" in kwargs and "places" not in kwargs:
+            raise template.TemplateSyntaxError(
+                "google_map needs a location to use 'near'")
+        return cls(**kwargs)
     
-    def __init__(self, places=None, latitude=None, longitude=None):
+    def __init__(self, places=None, latitude=None, longitude=None,
+            limit=None, near=None):
         self.places = places
         self.latitude = latitude
         self.longitude = longitude
+        self.limit = limit
+        self.near = near
     
     def render(self, context):
         if self.places and self.latitude and self.longitude:
@@ -39,25 +199,61 @@ class PlaceMapNode(template.Node):
             places = Place.objects.all()
             latitude = None
             longitude = None
-        
-        url = "http://maps.google.com/maps/api/staticmap?"
-        url += "size=640x360"
-        url += "&maptype=roadmap"
-        url += "&sensor=false"
-        
-        for place in places:
-            url += "&markers=color:blue%%7C%s,%s" % (place.latitude, place.longitude)
+        if not isinstance(places, QuerySet):
+            places = list(places)
+        center = None
         if latitude and longitude:
-            url += "&markers=color:red%%7C%s,%s" % (latitude, longitude)
+            center = (float(latitude), float(longitude))
+        limit = self.limit and int(self.limit.resolve(context))
+        near = self.near and float(self.near.resolve(context))
+        
+        key = self.cache_key(places, center, limit, near)
+        url = key and cache.get(key)
+        if not url:
+            points = _points(places, center, limit, near)
+            budget = MAP_URL_LENGTH - len(map_url([], [], center))
+            url = map_url(*fit_markers(points, budget), center=center)
+            if key:
+                cache.set(key, url, MAP_CACHE_TIMEOUT)
         
         return "<img src=\"%s\">" % url
+    
+    def cache_key(self, places, center, limit, near):
+        """
+        Identifies the marker set by the place generation and either a
+        queryset's SQL, so it is not read at all on a hit, or the ids of
+        a list of places.
+
+        """
+        if not MAP_CACHE_TIMEOUT:
+            return None
+        if isinstance(places, QuerySet):
+            try:
+                markers = str(places.query)
+            except EmptyResultSet:
+                markers = ()
+        else:
+            markers = [place.pk for place in places]
+            if None in markers:
+                # unsaved places can only be told apart by their points
+                return None
+        return "loci:map:%s" % hashlib.md5(repr((
+            markers, loci.generation.current(), center, limit, near,
+            MAP_URL_LENGTH, MAP_MARKER_MODE,
+        )).encode("utf-8")).hexdigest()
 
 
 @register.tag
 def google_map(parser, token):
     """
     Usage::
+        {% google_map %}
         {% google_map for places and latitude longitude %}
+        {% google_map for places and latitude longitude limit 50 near 20 %}
+    
+    ``limit`` draws at most that many places, the nearest first, and
+    ``near`` only those within that many miles of the location. Markers
+    are clustered when they do not fit in ``LOCI_MAP_URL_LENGTH``.
     """
     return PlaceMapNode.handle_token(parser, token)
 
@@ -102,3 +298,74 @@ def distance(parser, token):
         {% distance from place to latitude longitude as var %}
     """
     return DistanceNode.handle_token(parser, token)
+
+
+class DistancesNode(template.Node):
+    
+    @classmethod
+    def handle_token(cls, parser, token):
+        bits = token.split_contents()
+        if len(bits) != 8:
+            raise template.TemplateSyntaxError
+        if bits[1] != "from" or bits[3] != "to" or bits[6] != "as":
+            raise template.TemplateSyntaxError
+        return cls(
+            parser.compile_filter(bits[2]),
+            parser.compile_filter(bits[4]),
+            parser.compile_filter(bits[5]),
+            bits[7]
+        )
+    
+    def __init__(self, places, latitude, longitude, varname):
+        self.places = places
+        self.latitude = latitude
+        self.longitude = longitude
+        self.varname = varname
+    
+    def render(self, context):
+        places = list(self.places.resolve(context))
+        latitude = self.latitude.resolve(context)
+        longitude = self.longitude.resolve(context)
+        origin = None
+        if latitude is not None and longitude is not None:
+            origin = (float(latitude), float(longitude))
+        context[self.varname] = attach_distances(places, origin)
+        return ""
+
+
+def attach_distances(places, origin):
+    """
+    Sets ``exact_distance`` on each place to its distance from
+    ``origin``, computed for all of them in one batch, and returns the
+    places. Places without coordinates, or all places if ``origin`` is
+    ``None``, get ``None``.
+
+    """
+    for place in places:
+        place.exact_distance = None
+    if origin is None:
+        return places
+    located = [
+        place for place in places
+        if place.latitude is not None and place.longitude is not None
+    ]
+    miles = loci.distance.batch_distances(
+        origin,
+        [place.latitude for place in located],
+        [place.longitude for place in located],
+    )
+    for (place, d) in zip(located, miles):
+        place.exact_distance = loci.distance.as_distance(float(d))
+    return places
+
+
+@register.tag
+def distances(parser, token):
+    """
+    Usage::
+        {% distances from places to latitude longitude as var %}
+    
+    Like ``distance``, for a whole list of places at once: ``var`` is
+    the list, with ``exact_distance`` set on each place.
+    """
+    return DistancesNode.handle_token(parser, token)
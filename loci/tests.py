@@ -1,16 +1,130 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signals import request_finished
+from django.db import connection
+from django.template import Context, Template
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipUnless
 from django.conf import settings
+from django.utils import six, timezone
+from django.utils.six.moves import BaseHTTPServer
+import geopy.distance
 
-from loci.models import Place
-from loci.utils import geocode, geolocate_request
+from loci.middleware import GeolocationMiddleware
+from loci.models import GeocodeResult, Place
+from loci.signals import metric, place_geocoded
+from loci.utils import geocode, geocode_many, geolocate_request
+import loci.aio
+import loci.benchmark
+import loci.distance
+import loci.geohash
+import loci.metrics
+import loci.deferred
+import loci.generation
+import loci.geocache
+import loci.geocoders
+import loci.geostore
+import loci.models
+import loci.spatial
+import loci.spatialindex
+import loci.transport
+from loci.templatetags import loci_tags
 
 
 class _Mock(object):
     pass
 
 
+def _spatialite_available():
+    import sqlite3
+    try:
+        db = sqlite3.connect(':memory:')
+        db.enable_load_extension(True)
+        db.load_extension(loci.spatial.SPATIALITE_LIBRARY)
+    except Exception:
+        return False
+    return True
+
+
+ZIP_CENTROIDS = [
+    {'zip_code': '54401', 'city': 'Wausau', 'state': 'WI',
+     'latitude': '44.9591', 'longitude': '-89.6301'},
+    {'zip_code': '54403', 'city': 'Wausau', 'state': 'WI',
+     'latitude': '44.9651', 'longitude': '-89.5697'},
+    {'zip_code': '54481', 'city': 'Stevens Point', 'state': 'WI',
+     'latitude': '44.5233', 'longitude': '-89.5746'},
+]
+
+
+class _LocalTestGeocoder(loci.geocoders.LocalGeocoder):
+
+    def __init__(self):
+        super(_LocalTestGeocoder, self).__init__(rows=ZIP_CENTROIDS)
+
+
+class _StreetTestGeocoder(loci.geocoders.BaseGeocoder):
+    """
+    Answers street addresses ending in a ZIP code of the test table with
+    the centroid of that ZIP code, standing in for a remote geocoder.
+
+    """
+    name = 'street'
+
+    def __init__(self):
+        self.local = _LocalTestGeocoder()
+
+    def geocode(self, address):
+        match = re.search(r'(\d{5})\s*$', address)
+        if match is None:
+            return None
+        result = self.local.geocode(match.group(1))
+        if result is None:
+            return None
+        (location, (street_address, city, state, zip_code)) = result
+        return (location, (address.split(',')[0], city, state, zip_code))
+
+    def reverse(self, location):
+        return self.local.reverse(location)
+
+
+# keeps the suite offline: ZIP codes and cities from the local table,
+# street addresses from the stand-in above
+OFFLINE_GEOCODERS = [
+    'loci.tests._LocalTestGeocoder',
+    'loci.tests._StreetTestGeocoder',
+]
+
+
+class _ProxyPlace(Place):
+    # saves of a subclass are signalled with the subclass as sender
+
+    class Meta:
+        app_label = 'loci'
+        proxy = True
+
+
+class _FailingGeocoder(loci.geocoders.BaseGeocoder):
+    name = 'failing'
+
+    def geocode(self, address):
+        raise loci.geocoders.GeocoderError('unavailable')
+
+    def reverse(self, location):
+        raise loci.geocoders.GeocoderError('unavailable')
+
+
 class ModelTests(TestCase):
     
+    @override_settings(LOCI_GEOCODER=OFFLINE_GEOCODERS)
     def test_place_creation(self):
         # make sure geocode is working
         assert(geocode('54403').latitude)
@@ -46,6 +160,7 @@ class ModelTests(TestCase):
         self.assertEqual(place3.address, '557 Scott St')
         self.assertEqual(place3.location, (-45, -45))
     
+    @override_settings(LOCI_GEOCODER=OFFLINE_GEOCODERS)
     def test_near_query(self):
         test_place = Place.objects.create(
             name='Wausau',
@@ -73,8 +188,1019 @@ class ModelTests(TestCase):
         self.assertEqual(len(nearby), 1)
         self.assertTrue(test_place in nearby)
 
+    def test_within_query(self):
+        near = Place.objects.create(name='near', location=(44.97, -89.6))
+        far = Place.objects.create(name='far', location=(45.5, -89.0))
+        Place.objects.create(name='very far', location=(43.07, -89.4))
+        origin = (44.96, -89.63)
+
+        nearby = Place.objects.within(origin, 50).order_by('distance')
+        self.assertEqual(list(nearby), [near, far])
+        self.assertTrue(nearby[0].distance < nearby[1].distance)
+        self.assertEqual(list(nearby[:1]), [near])
+        self.assertEqual(
+            sorted(p.pk for p in Place.objects.near(origin, 50)),
+            sorted(p.pk for p in nearby)
+        )
+
+        # distance can also be attached to the location
+        location = Place(location=origin)
+        location.nearby_distance = 5
+        self.assertEqual(list(Place.objects.within(location)), [near])
+
+    def test_nearest_query(self):
+        origin = (44.96, -89.63)
+        places = [
+            Place.objects.create(
+                name=str(i), location=(44.96 + i * 0.2, -89.63 + i * 0.1))
+            for i in range(1, 6)
+        ]
+
+        nearest = Place.objects.nearest(origin, 3)
+        self.assertEqual(nearest, places[:3])
+        self.assertTrue(
+            nearest[0].exact_distance.miles < nearest[1].exact_distance.miles)
+
+        # asking for more than exist returns everything
+        self.assertEqual(Place.objects.nearest(origin, 10), places)
+
+        # max_distance cuts the search off
+        self.assertEqual(
+            Place.objects.nearest(origin, 3, max_distance=30), places[:2])
+
+    def test_near_across_antimeridian(self):
+        west = Place.objects.create(name='west', location=(60, 179.8))
+        east = Place.objects.create(name='east', location=(60, -179.8))
+        Place.objects.create(name='elsewhere', location=(60, 170))
+
+        nearby = Place.objects.near((60, 179.9), 20)
+        self.assertEqual(set(nearby), set([west, east]))
+        self.assertEqual(nearby.candidates, 2)
+        self.assertEqual(nearby.pruning_ratio, 1.0)
+
+    def test_geohash_lookups(self):
+        place = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        self.assertEqual(place.geohash, loci.geohash.encode(44.96, -89.63))
+        Place.objects.create(name='Madison', location=(43.07, -89.4))
+
+        loci.models.GEOHASH_LOOKUPS = True
+        try:
+            nearby = Place.objects.near((44.97, -89.6), 20)
+        finally:
+            loci.models.GEOHASH_LOOKUPS = False
+        self.assertEqual(list(nearby), [place])
+
+    def test_spatial_index(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        madison = Place.objects.create(name='Madison', location=(43.07, -89.4))
+
+        loci.spatialindex.ENABLED = True
+        try:
+            index = loci.spatialindex.get_index()
+            self.assertEqual(len(index), 2)
+            self.assertEqual(Place.objects.nearest((43, -89), 1), [madison])
+
+            # saves and deletes are applied to the index in place
+            duluth = Place.objects.create(name='Duluth', location=(46.8, -92.1))
+            self.assertTrue(loci.spatialindex.get_index() is index)
+            self.assertEqual(len(index), 3)
+            madison.delete()
+            self.assertEqual(Place.objects.nearest((43, -89), 1), [wausau])
+            self.assertEqual(
+                list(Place.objects.filter(name='Duluth').near((46.8, -92), 200)),
+                [duluth]
+            )
+
+            # a change made elsewhere makes the index stale
+            loci.generation.bump()
+            self.assertFalse(loci.spatialindex.get_index() is index)
+        finally:
+            loci.spatialindex.ENABLED = False
+            loci.spatialindex.invalidate()
+
+    def test_generation_follows_places(self):
+        generation = loci.generation.current()
+        GeocodeResult.objects.create(
+            key='test', query='address:test', latitude=44.96, longitude=-89.63,
+            fetched_at=timezone.now())
+        self.assertEqual(loci.generation.current(), generation)
+        Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        self.assertNotEqual(loci.generation.current(), generation)
+
+        # and so do changes to subclasses
+        generation = loci.generation.current()
+        place = _ProxyPlace.objects.create(
+            name='Madison', location=(43.07, -89.4))
+        self.assertNotEqual(loci.generation.current(), generation)
+        generation = loci.generation.current()
+        place.delete()
+        self.assertNotEqual(loci.generation.current(), generation)
+
+    def test_deferred_geocoding(self):
+        geocoded = []
+        def receiver(sender, place, success, **kwargs):
+            geocoded.append((place.pk, success))
+        place_geocoded.connect(receiver)
+
+        loci.deferred.MODE = 'queue'
+        try:
+            with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+                place = Place.objects.create(name='Wausau', zip_code='54403')
+                self.assertTrue(place.geocode_pending)
+                self.assertEqual(place.location, (None, None))
+                self.assertEqual(Place.objects.near((44.96, -89.6), 20), [])
+
+                call_command('loci_geocode_worker', once=True)
+        finally:
+            loci.deferred.MODE = False
+            place_geocoded.disconnect(receiver)
+
+        self.assertEqual(geocoded, [(place.pk, True)])
+        place = Place.objects.get(pk=place.pk)
+        self.assertFalse(place.geocode_pending)
+        self.assertEqual(place.location, (44.9651, -89.5697))
+        self.assertEqual(place.city, 'Wausau')
+        self.assertEqual(Place.objects.near((44.96, -89.6), 20), [place])
+
+    def test_deferred_geocoding_overridden(self):
+        loci.deferred.MODE = 'queue'
+        try:
+            with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+                place = Place.objects.create(name='Wausau', zip_code='54403')
+                self.assertTrue(place.geocode_pending)
+
+                # coordinates set before the worker gets to it are kept
+                place.location = (44.96, -89.63)
+                place.save()
+                self.assertFalse(place.geocode_pending)
+                call_command('loci_geocode_worker', once=True)
+        finally:
+            loci.deferred.MODE = False
+
+        place = Place.objects.get(pk=place.pk)
+        self.assertFalse(place.geocode_pending)
+        self.assertEqual(place.location, (44.96, -89.63))
+
+    def test_deferred_geocoding_overridden_during_lookup(self):
+        geocoded = []
+        def receiver(sender, place, success, **kwargs):
+            geocoded.append((place.pk, success))
+        place_geocoded.connect(receiver)
+
+        def override_and_geocode(address):
+            # coordinates are saved while the lookup is in flight
+            override = Place.objects.get(pk=place.pk)
+            override.location = (10, 10)
+            override.save()
+            return geocode(address)
+
+        loci.deferred.MODE = 'queue'
+        loci.deferred.geocode = override_and_geocode
+        loci.spatialindex.ENABLED = True
+        try:
+            with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+                place = Place.objects.create(name='Wausau', zip_code='54403')
+                loci.spatialindex.get_index()
+                self.assertEqual(loci.deferred.process(place.pk), None)
+                self.assertEqual(
+                    [p.pk for p in Place.objects.near((10, 10), 1)],
+                    [place.pk])
+        finally:
+            loci.deferred.MODE = False
+            loci.deferred.geocode = geocode
+            loci.spatialindex.ENABLED = False
+            loci.spatialindex.invalidate()
+            place_geocoded.disconnect(receiver)
+
+        self.assertEqual(geocoded, [])
+        self.assertEqual(Place.objects.get(pk=place.pk).location, (10, 10))
+
+    def test_near_many(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        madison = Place.objects.create(name='Madison', location=(43.07, -89.4))
+        origins = [
+            (44.97, -89.6),
+            Place(location=(43.1, -89.35)),
+            (44.0, -89.5),
+            Place(),
+        ]
+
+        nearby = Place.objects.near_many(origins, 20)
+        self.assertEqual(len(nearby), 3)
+        self.assertEqual(
+            [place for (place, d) in nearby[(44.97, -89.6)]], [wausau])
+        self.assertEqual(
+            [place for (place, d) in nearby[(43.1, -89.35)]], [madison])
+        self.assertEqual(nearby[(44.0, -89.5)], [])
+
+        # the results agree with near()
+        for origin in [(44.97, -89.6), (43.1, -89.35)]:
+            expected = Place.objects.near(origin, 20)[0]
+            (place, d) = nearby[origin][0]
+            self.assertAlmostEqual(
+                d.miles, expected.exact_distance.miles, places=6)
+
+    def test_distance_page(self):
+        for i in range(5):
+            Place.objects.create(name='Place %s' % i, location=(44 + i * 0.1, -89.6))
+        # two places at the same distance are ordered by pk
+        Place.objects.create(name='Tie', location=(44.2, -89.6))
+        nowhere = Place.objects.create(name='Nowhere')
+
+        def pages(**kwargs):
+            seen = []
+            after = None
+            while True:
+                (places, after) = Place.objects.distance_page(
+                    (44, -89.6), 100, after=after, size=4, **kwargs)
+                seen.extend(places)
+                if after is None:
+                    return seen
+
+        seen = pages()
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(len(set(p.pk for p in seen)), 6)
+        keys = [p.page_key for p in seen]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual([p.name for p in seen[2:4]], ['Place 2', 'Tie'])
+
+        # places without coordinates come last
+        seen = pages(unlocated=True)
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(seen[-1], nowhere)
+        self.assertTrue(seen[-1].distance is None)
+
+        (places, after) = Place.objects.distance_page(Place(), size=4)
+        self.assertEqual([p.distance for p in places], [None] * 4)
+        (places, after) = Place.objects.distance_page(Place(), after=after)
+        self.assertEqual(len(places), 3)
+        self.assertTrue(after is None)
+
+    def test_within_bounds(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Madison', location=(43.07, -89.4))
+        fiji = Place.objects.create(name='Suva', location=(-18.14, 178.44))
+        samoa = Place.objects.create(name='Apia', location=(-13.83, -171.76))
+
+        self.assertEqual(
+            list(Place.objects.within_bounds((44, -90), (45, -89))), [wausau])
+        # a viewport across the antimeridian
+        self.assertEqual(
+            sorted(p.pk for p in Place.objects.within_bounds((-20, 170), (-10, -170))),
+            [fiji.pk, samoa.pk]
+        )
+
+        (places, clusters) = Place.objects.viewport((40, -95), (50, -85))
+        self.assertEqual(len(places), 2)
+        self.assertEqual(clusters, [])
+
+        for i in range(3):
+            Place.objects.create(name='Suva %s' % i, location=(-18.1, 178.4 + i * 0.01))
+        (places, clusters) = Place.objects.viewport(
+            (-20, 170), (-10, -170), max_places=4, grid=2)
+        self.assertEqual(places, [])
+        self.assertEqual([c['count'] for c in clusters], [4, 1])
+        self.assertAlmostEqual(clusters[0]['longitude'], 178.4175)
+        self.assertAlmostEqual(clusters[1]['longitude'], -171.76)
+
+    def test_proximity_cache(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+
+        loci.models.PROXIMITY_CACHE_TIMEOUT = 60
+        try:
+            self.assertEqual(Place.objects.near((44.97, -89.6), 20), [wausau])
+            # a cached result only needs the places loaded
+            with self.assertNumQueries(1):
+                nearby = Place.objects.near((44.9701, -89.6001), 20)
+            self.assertEqual(nearby, [wausau])
+            self.assertEqual(
+                Place.objects.filter(name='Madison').near((44.97, -89.6), 20),
+                [])
+
+            # saving a place makes earlier results stale
+            madison = Place.objects.create(name='Madison', location=(44.9, -89.6))
+            self.assertEqual(
+                sorted(p.pk for p in Place.objects.near((44.97, -89.6), 20)),
+                [wausau.pk, madison.pk]
+            )
+            self.assertEqual(Place.objects.nearest((44.9, -89.6), 1), [madison])
+        finally:
+            loci.models.PROXIMITY_CACHE_TIMEOUT = 0
+
+    def test_proximity_cache_exact_origin(self):
+        # a row of places across the 20 mile radius of the origins below
+        for i in range(20):
+            Place.objects.create(
+                name='Place %s' % i, location=(45.259 + i * 0.0001, -89.6))
+
+        def query(origin):
+            return (
+                sorted((p.pk, p.exact_distance.miles)
+                    for p in Place.objects.near(origin, 20)),
+                [(p.pk, p.exact_distance.miles)
+                    for p in Place.objects.nearest(origin, 30, max_distance=20)],
+                [p.pk for p in Place.objects.nearest(origin, 3)],
+            )
+
+        # all round to the same cache key
+        origins = [(44.9704, -89.6), (44.9696, -89.6), (44.97, -89.6004)]
+        expected = [query(origin) for origin in origins]
+        self.assertNotEqual(expected[0][0], expected[1][0])
+
+        loci.models.PROXIMITY_CACHE_TIMEOUT = 60
+        try:
+            self.assertEqual([query(origin) for origin in origins], expected)
+        finally:
+            loci.models.PROXIMITY_CACHE_TIMEOUT = 0
+
+
+class SpatialBackendTests(TransactionTestCase):
+    # the setup runs DDL and creates triggers and a virtual table, which
+    # must not happen inside the transaction a TestCase wraps tests in
+
+    @skipUnless(_spatialite_available(), 'SpatiaLite is not available.')
+    def test_spatial_backend(self):
+        for i in range(20):
+            Place.objects.create(
+                name='Place %s' % i, location=(44 + i * 0.05, -89.6 - i * 0.05))
+        queries = [
+            lambda: [p.pk for p in Place.objects.near((44.5, -90), 30)],
+            lambda: [p.pk for p in Place.objects.nearest((44.5, -90), 5)],
+            lambda: sorted(p.pk for p in Place.objects.within_bounds(
+                (44.2, -90.5), (44.6, -89.5))),
+        ]
+        expected = [query() for query in queries]
+
+        loci.spatial.ENABLED = True
+        try:
+            loci.spatial.load_spatialite(None, connection)
+            call_command('loci_spatial')
+            self.assertEqual(
+                loci.spatial.is_ready(connection, Place._meta.db_table),
+                loci.spatial.SPATIALITE)
+            self.assertEqual([query() for query in queries], expected)
+
+            # the point column follows changes made through the ORM
+            moved = Place.objects.create(name='Moved', location=(0, 0))
+            Place.objects.filter(pk=moved.pk).update(latitude=44.5, longitude=-90)
+            self.assertTrue(moved.pk in queries[0]())
+        finally:
+            loci.spatial.ENABLED = False
+            loci.spatial.reset()
+            # the schema changes outlive the test's flush
+            table = Place._meta.db_table
+            cursor = connection.cursor()
+            for statement in [
+                'DROP TRIGGER IF EXISTS "%s_loci_point_insert"' % table,
+                'DROP TRIGGER IF EXISTS "%s_loci_point_update"' % table,
+                "SELECT DisableSpatialIndex('%s', 'loci_point')" % table,
+                'DROP TABLE IF EXISTS "idx_%s_loci_point"' % table,
+                "SELECT DiscardGeometryColumn('%s', 'loci_point')" % table,
+            ]:
+                cursor.execute(statement)
+
+
+class SpatialSqlTests(SimpleTestCase):
+
+    def setUp(self):
+        self.connection = _Mock()
+        self.connection.alias = 'postgis'
+        self.connection.ops = _Mock()
+        self.connection.ops.quote_name = lambda name: '"%s"' % name
+        loci.spatial.ENABLED = True
+        loci.spatial._ready[('postgis', 'loci_place')] = loci.spatial.POSTGIS
+
+    def tearDown(self):
+        loci.spatial.ENABLED = False
+        loci.spatial.reset()
+
+    def test_postgis_box_sql(self):
+        (sql, params) = loci.spatial.box_sql(
+            self.connection, 'loci_place', 'id',
+            [((44.0, 45.0), [(170.0, 180.0), (-180.0, -170.0)])])
+        self.assertEqual(sql,
+            '("loci_place"."loci_point" && ST_MakeEnvelope(%s, %s, %s, %s, 4326)'
+            ' OR "loci_place"."loci_point" && ST_MakeEnvelope(%s, %s, %s, %s, 4326))')
+        self.assertEqual(params,
+            [170.0, 44.0, 180.0, 45.0, -180.0, 44.0, -170.0, 45.0])
+
+        # tables without the column fall back to the float columns
+        loci.spatial._ready[('postgis', 'loci_place')] = None
+        self.assertEqual(loci.spatial.box_sql(
+            self.connection, 'loci_place', 'id', [((44.0, 45.0), [(0, 1)])]),
+            None)
+
+    def test_postgis_setup_sql(self):
+        statements = loci.spatial.setup_sql(
+            loci.spatial.POSTGIS, 'loci_place', 'id')
+        self.assertEqual(statements[0],
+            'ALTER TABLE "loci_place"'
+            ' ADD COLUMN "loci_point" geometry(Point, 4326)')
+        self.assertTrue(
+            'ON "loci_place" USING GIST ("loci_point")' in statements[2])
+        self.assertTrue(
+            'ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326)'
+            in statements[3])
+        self.assertTrue(
+            'BEFORE INSERT OR UPDATE OF latitude, longitude ON "loci_place"'
+            in statements[4])
+        self.assertFalse([s for s in statements if '%(' in s])
+
+
+class TemplateTagTests(TestCase):
+
+    def render(self, source, **context):
+        return Template('{% load loci_tags %}' + source).render(Context(context))
+
+    def test_google_map(self):
+        Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Madison', location=(43.07, -89.4))
+
+        html = self.render('{% google_map %}')
+        self.assertTrue('&markers=color:blue%7C' in html)
+        self.assertTrue('%7C44.9600,-89.6300' in html)
+        self.assertTrue('%7C43.0700,-89.4000' in html)
+
+        html = self.render(
+            '{% google_map for places and lat lon limit 1 %}',
+            places=Place.objects.all(), lat=43, lon=-89)
+        self.assertTrue('43.0700,-89.4000' in html)
+        self.assertFalse('44.9600,-89.6300' in html)
+        self.assertTrue('&markers=color:red%7C43.0000,-89.0000' in html)
+
+        html = self.render(
+            '{% google_map for places and lat lon near 20 %}',
+            places=list(Place.objects.all()), lat=44.97, lon=-89.6)
+        self.assertTrue('44.9600,-89.6300' in html)
+        self.assertFalse('43.0700,-89.4000' in html)
+
+    def test_google_map_cache(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        source = '{% google_map for places and lat lon %}'
+        html = self.render(source, places=[wausau], lat=44, lon=-89)
+        self.assertTrue('44.9600,-89.6300' in html)
+
+        # lists of places are cached by their ids until a place changes
+        wausau.location = (43.07, -89.4)
+        wausau.save()
+        html = self.render(source, places=[wausau], lat=44, lon=-89)
+        self.assertTrue('43.0700,-89.4000' in html)
+
+    def test_distances(self):
+        Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Nowhere')
+
+        html = self.render(
+            '{% distances from places to lat lon as places %}'
+            '{% for p in places %}{{ p.exact_distance.miles|floatformat }};{% endfor %}',
+            places=Place.objects.order_by('pk'), lat=44.97, lon=-89.6)
+        self.assertEqual(html, '1.6;;')
+
+        places = loci_tags.attach_distances(
+            list(Place.objects.order_by('pk')), (44.97, -89.6))
+        self.assertAlmostEqual(
+            places[0].exact_distance.miles,
+            places[0].distance_to(44.97, -89.6).miles,
+            places=2
+        )
+        self.assertTrue(places[1].exact_distance is None)
+
+    def test_marker_budget(self):
+        points = [(44 + i * 0.001, -89 - (i % 50) * 0.01) for i in range(500)]
+        (singles, clusters) = loci_tags.fit_markers(points, 1000)
+        url = loci_tags.map_url(singles, clusters)
+        self.assertTrue(len(url) <= len(loci_tags.map_url([], [])) + 1000)
+        self.assertTrue(clusters)
+
+        (singles, clusters) = loci_tags.fit_markers(points, 1000, 'sample')
+        self.assertEqual(clusters, [])
+        self.assertTrue(0 < len(singles) < len(points))
+
+
+class ApiTests(TestCase):
+    urls = 'loci.urls'
+
+    def test_places_json(self):
+        wausau = Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Madison', location=(43.07, -89.4))
+
+        # origins are snapped to the grid
+        response = self.client.get('/places.json?lon=-89.6012&lat=44.9712&dist=20')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(
+            '/places.json?lat=44.97&lon=-89.60&dist=20'))
+
+        response = self.client.get('/places.json?lat=44.97&lon=-89.60&dist=20')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('public' in response['Cache-Control'])
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual([p['id'] for p in data['places']], [wausau.pk])
+
+        # unchanged data is not sent again
+        etag = response['ETag']
+        response = self.client.get(
+            '/places.json?lat=44.97&lon=-89.60&dist=20', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Place.objects.create(name='Duluth', location=(46.8, -92.1))
+        response = self.client.get(
+            '/places.json?lat=44.97&lon=-89.60&k=2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(data['places'][0]['name'], 'Wausau')
+        self.assertEqual(len(data['places']), 2)
+
+        response = self.client.get('/places.json?lat=44.97&lon=-89.60')
+        self.assertEqual(response.status_code, 400)
+
+    def test_places_json_conditional(self):
+        Place.objects.create(name='Far', location=(0.2, 0.2))
+        Place.objects.create(name='Near', location=(0.01, 0.01))
+
+        # 0 is a coordinate like any other; results are nearest first
+        response = self.client.get('/places.json?lat=0.00&lon=0.00&dist=50')
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual([p['name'] for p in data['places']], ['Near', 'Far'])
+
+        # each query has its own ETag
+        etag = response['ETag']
+        response = self.client.get(
+            '/places.json?lat=0.00&lon=0.00&dist=10', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # other spellings are redirected even if the ETag matches
+        response = self.client.get(
+            '/places.json?lat=0&lon=0&dist=50', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 302)
+
+
+class DistanceTests(SimpleTestCase):
+
+    def test_batch_distances_match_geopy(self):
+        origin = (44.96, -89.63)
+        points = [(44.96, -89.63), (45.5, -89.0), (43.07, -89.4), (46.8, -92.1)]
+        miles = loci.distance.batch_distances(
+            origin, [p[0] for p in points], [p[1] for p in points])
+        for (point, batch) in zip(points, miles):
+            exact = geopy.distance.distance(origin, point).miles
+            self.assertTrue(
+                abs(batch - exact) <= exact * loci.distance.TOLERANCE)
+
+    def test_within_matches_geopy(self):
+        origin = (44.96, -89.63)
+        rows = [
+            (i, 44.96 + i * 0.01, -89.63 + i * 0.013) for i in range(-200, 200)
+        ]
+        expected = [
+            key for (key, lat, lon) in rows
+            if geopy.distance.distance(origin, (lat, lon)).miles <= 100
+        ]
+        matches = loci.distance.within(origin, rows, 100)
+        self.assertEqual([key for (key, miles) in matches], expected)
+
+    def test_bounding_box_widens_with_latitude(self):
+        for latitude in (0, 45, 70, 85):
+            (lat_range, long_ranges) = loci.distance.bounding_box(
+                (latitude, 0), 100)
+            # a point 99 miles due east must fall inside the box
+            east = 0.0
+            while geopy.distance.distance((latitude, 0), (latitude, east)).miles < 99:
+                east += 0.01
+            self.assertTrue(lat_range[0] <= latitude <= lat_range[1])
+            self.assertTrue(any(
+                low <= east <= high for (low, high) in long_ranges))
+
+        # near a pole every longitude is in range
+        self.assertEqual(
+            loci.distance.bounding_box((89.5, 0), 100)[1], [(-180.0, 180.0)])
+
+    def test_geohash_cover(self):
+        self.assertEqual(loci.geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        (lat_range, long_ranges) = loci.distance.bounding_box((60, 179.9), 20)
+        prefixes = loci.geohash.cover(lat_range, long_ranges)
+        self.assertTrue(0 < len(prefixes) <= 16)
+        for point in [(60, 179.9), (60, -179.8), (60.2, 179.7)]:
+            geohash = loci.geohash.encode(*point)
+            self.assertTrue(any(geohash.startswith(p) for p in prefixes))
+
+
+class GeocoderTests(TestCase):
+
+    def setUp(self):
+        self.local = loci.geocoders.LocalGeocoder(rows=ZIP_CENTROIDS)
+
+    def test_local_geocoder(self):
+        (location, address) = self.local.geocode('54481')
+        self.assertEqual(location, (44.5233, -89.5746))
+        self.assertEqual(address, (None, 'Stevens Point', 'WI', '54481'))
+
+        (location, address) = self.local.geocode('wausau, wi')
+        self.assertAlmostEqual(location[0], 44.9621)
+        self.assertEqual(address, (None, 'Wausau', 'WI', None))
+
+        # street addresses are left to other backends
+        self.assertEqual(self.local.geocode('557 Scott St, Wausau WI'), None)
+
+        (location, address) = self.local.reverse((44.96, -89.62))
+        self.assertEqual(address[3], '54401')
+        self.assertEqual(self.local.reverse((10, 10)), None)
+
+    def test_chain_geocoder(self):
+        chain = loci.geocoders.ChainGeocoder([self.local, _FailingGeocoder()])
+        self.assertEqual(chain.geocode('54403')[1][3], '54403')
+        self.assertRaises(
+            loci.geocoders.GeocoderError, chain.geocode, '557 Scott St')
+
+    def test_geocode_with_local_table(self):
+        (fd, path) = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            writer = csv.DictWriter(f, list(ZIP_CENTROIDS[0].keys()))
+            writer.writeheader()
+            writer.writerows(ZIP_CENTROIDS)
+        try:
+            with self.settings(
+                    LOCI_GEOCODER='loci.geocoders.LocalGeocoder',
+                    LOCI_ZIP_CENTROIDS=path):
+                place = geocode('Stevens Point WI')
+        finally:
+            os.remove(path)
+        self.assertEqual(place.location, (44.5233, -89.5746))
+        self.assertEqual(place.zip_code, '54481')
+
+    def test_geocode_many(self):
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            results = geocode_many(['54403', ' 54403 ', '54481', 'nowhere'])
+        self.assertEqual(results['54403'].zip_code, '54403')
+        self.assertEqual(results[' 54403 '].location, results['54403'].location)
+        self.assertEqual(results['54481'].city, 'Stevens Point')
+        self.assertEqual(results['nowhere'].location, (None, None))
+
+        # without a pool the lookups run in this thread
+        loci.geocache.geocode_cache.delete(
+            loci.geocache.make_key('54401', 'address'))
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            results = geocode_many(['54401'], threads=0)
+        self.assertEqual(results['54401'].location, (44.9591, -89.6301))
+
+    def test_geocode_command(self):
+        Place.objects.bulk_create([
+            Place(name='a', zip_code='54403'),
+            Place(name='b', city='Stevens Point', state='WI'),
+            Place(name='c', zip_code='00000'),
+            Place(name='d'),
+        ])
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            call_command('loci_geocode', batch_size=2, stdout=six.StringIO())
+        places = dict((p.name, p) for p in Place.objects.all())
+        self.assertEqual(places['a'].location, (44.9651, -89.5697))
+        self.assertEqual(places['b'].zip_code, '54481')
+        self.assertTrue(places['b'].geohash)
+        self.assertEqual(places['c'].location, (None, None))
+        self.assertEqual(places['d'].location, (None, None))
+
+
+class ImportExportTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def test_import_csv(self):
+        path = os.path.join(self.dir, 'places.csv')
+        with open(path, 'w') as f:
+            f.write(
+                'name,zip_code,latitude,longitude\n'
+                'Wausau,54403,44.96,-89.63\n'
+                'Library,54481,,\n'
+                'Museum,54481,,\n'
+                'Nowhere,,,\n'
+            )
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            call_command(
+                'loci_import', path, batch_size=2, stdout=six.StringIO())
+
+        places = list(Place.objects.order_by('pk'))
+        self.assertEqual([p.name for p in places],
+            ['Wausau', 'Library', 'Museum', 'Nowhere'])
+        self.assertEqual(places[0].location, (44.96, -89.63))
+        self.assertEqual(places[0].geohash, loci.geohash.encode(44.96, -89.63))
+        self.assertEqual(places[1].location, (44.5233, -89.5746))
+        self.assertEqual(places[2].location, places[1].location)
+        self.assertEqual(places[3].location, (None, None))
+
+    def test_export_and_import_geojson(self):
+        Place.objects.create(name='Wausau', city='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Nowhere')
+        path = os.path.join(self.dir, 'places.geojson')
+        call_command('loci_export', path)
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(data['features'][0]['geometry']['coordinates'],
+            [-89.63, 44.96])
+        self.assertEqual(data['features'][1]['geometry'], None)
+
+        Place.objects.all().delete()
+        call_command(
+            'loci_import', path, geocode=False, stdout=six.StringIO())
+        self.assertEqual(
+            list(Place.objects.order_by('pk').values_list(
+                'name', 'city', 'latitude', 'longitude')),
+            [('Wausau', 'Wausau', 44.96, -89.63), ('Nowhere', '', None, None)]
+        )
+
+    def test_export_to_stdout(self):
+        Place.objects.create(name='Wausau', city='Wausau', location=(44.96, -89.63))
+        out = six.StringIO()
+        call_command('loci_export', stdout=out)
+        rows = list(csv.DictReader(six.StringIO(out.getvalue())))
+        self.assertEqual([(r['name'], r['latitude']) for r in rows],
+            [('Wausau', '44.96')])
+
+    def test_import_is_atomic(self):
+        path = os.path.join(self.dir, 'places.geojson')
+        with open(path, 'w') as f:
+            f.write(
+                '{"type": "FeatureCollection", "features": [\n'
+                '{"type": "Feature", "geometry": null,'
+                ' "properties": {"name": "First"}},\n'
+                '{"type": "Feature", "geometry": null,'
+                ' "properties": {"name": "Second"}},\n'
+            )
+        self.assertRaises(CommandError, call_command,
+            'loci_import', path, batch_size=1, geocode=False,
+            stdout=six.StringIO())
+        self.assertEqual(Place.objects.count(), 0)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_synthetic_points(self):
+        (points, towns) = loci.benchmark.synthetic_points(1000, seed=1)
+        self.assertEqual(len(points), 1000)
+        self.assertEqual(
+            loci.benchmark.synthetic_points(1000, seed=1), (points, towns))
+
+    def test_benchmark_command(self):
+        generation = loci.generation.current()
+        (fd, path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            call_command(
+                'loci_benchmark', sizes='300', radii='5', repeat=2,
+                output=path, label='test')
+            with open(path) as f:
+                data = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual(data['meta']['label'], 'test')
+        names = set(result['name'] for result in data['results'])
+        for name in ['near', 'nearest', 'geocode_miss', 'geocode_hit',
+                'geolocate_request', 'distances_tag', 'home_template']:
+            self.assertTrue(name in names)
+        self.assertEqual(
+            sorted(set(result['spatial_index'] for result in data['results']
+                if result['name'] == 'near')),
+            [False, True])
+        # the benchmark data is not left behind, nor are the site's
+        # cached results invalidated
+        self.assertEqual(Place.objects.count(), 0)
+        self.assertEqual(loci.generation.current(), generation)
+        self.assertEqual(loci.geocache.geocode_cache.get(
+            loci.geocache.make_key('0 Benchmark Street', 'address')),
+            (False, None))
+
+
+class GeocodeCacheTests(TestCase):
+
+    def setUp(self):
+        loci.geocache.geocode_cache.clear()
+        loci.geocache.geocode_cache.reset_stats()
+
+    def test_normalized_keys(self):
+        make_key = loci.geocache.make_key
+        self.assertEqual(
+            make_key('557 Scott St, Wausau', 'address'),
+            make_key('557 scott street  wausau', 'address')
+        )
+        self.assertEqual(
+            make_key((44.959100001, -89.63), None),
+            make_key((44.95910, -89.630000002), None)
+        )
+        self.assertNotEqual(
+            make_key((44.9591, -89.63), None),
+            make_key((44.9592, -89.63), None)
+        )
+
+    def test_negative_caching(self):
+        with self.settings(LOCI_GEOCODER='loci.tests._FailingGeocoder'):
+            self.assertEqual(geocode('nowhere at all').location, (None, None))
+            self.assertEqual(geocode('Nowhere, at all').location, (None, None))
+        stats = loci.geocache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['negative_hits'], 1)
+
+    def test_lru(self):
+        lru = loci.geocache.GeocodeCache(lru_size=2)
+        for key in ('a', 'b', 'c'):
+            lru.set('loci:test:' + key, key)
+        self.assertEqual(list(lru.lru.keys()), ['loci:test:b', 'loci:test:c'])
+        self.assertEqual(lru.get('loci:test:a'), (True, 'a'))
+        self.assertEqual(lru.stats['lru_hits'], 0)
+        self.assertEqual(lru.get('loci:test:c'), (True, 'c'))
+        self.assertEqual(lru.stats['lru_hits'], 1)
+
+    def test_single_flight(self):
+        geocode_cache = loci.geocache.GeocodeCache()
+        calls = []
+        started = threading.Event()
+
+        def lookup():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'result'
+
+        results = []
+        def worker():
+            results.append(
+                geocode_cache.get_or_lookup('loci:test:flight', lookup))
+        threads = [threading.Thread(target=worker) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results),
+            [('result', 'coalesced')] * 4 + [('result', 'miss')])
+        self.assertEqual(geocode_cache.stats['coalesced'], 4)
+
+    def test_distributed_lock_timeout(self):
+        geocode_cache = loci.geocache.GeocodeCache(
+            distributed_lock=True, lock_timeout=0.1)
+        geocode_cache.delete('loci:test:locked')
+        # held by a lookup in another process
+        geocode_cache.backend.set('loci:test:locked:lock', 1, 10)
+        try:
+            self.assertEqual(
+                geocode_cache.get_or_lookup('loci:test:locked', lambda: 'result'),
+                ('result', 'miss')
+            )
+            # the other process's lock is left for it to release
+            self.assertEqual(geocode_cache.backend.get('loci:test:locked:lock'), 1)
+        finally:
+            geocode_cache.backend.delete('loci:test:locked:lock')
+            geocode_cache.delete('loci:test:locked')
+
+    def test_stale_while_revalidate(self):
+        geocode_cache = loci.geocache.GeocodeCache(timeout=-1)
+        geocode_cache.set('loci:test:stale', 'old')
+        self.assertEqual(
+            geocode_cache.get_or_lookup(
+                'loci:test:stale', lambda: 'lookup', lambda: 'new'),
+            ('old', 'stale_hit')
+        )
+        self.assertEqual(geocode_cache.stats['stale_hits'], 1)
+        while geocode_cache.refreshing:
+            time.sleep(0.01)
+        self.assertEqual(geocode_cache.get('loci:test:stale'), (True, 'new'))
+
+    def test_geocode_store(self):
+        loci.geostore.ENABLED = True
+        try:
+            key = loci.geocache.make_key('54403', 'address')
+            loci.geocache.geocode_cache.delete(key)
+            with self.settings(LOCI_GEOCODER=[
+                    'loci.tests._FailingGeocoder', 'loci.tests._LocalTestGeocoder']):
+                place = geocode('54403')
+            stored = GeocodeResult.objects.get()
+            self.assertEqual(stored.query, 'address:54403')
+            self.assertEqual(stored.location_data[0], place.location)
+            # the backend that answered, not the whole chain
+            self.assertEqual(stored.provider, 'local')
+
+            # a cache flush does not mean another remote lookup
+            loci.geocache.geocode_cache.delete(key)
+            with self.settings(LOCI_GEOCODER='loci.tests._FailingGeocoder'):
+                self.assertEqual(geocode('54403').location, place.location)
+
+            # nor does a restart, once the cache is prewarmed
+            Place.objects.create(
+                name='Home', address='1 Main St', city='Wausau', state='WI',
+                location=(44.96, -89.63))
+            loci.geocache.geocode_cache.delete(key)
+            loci.geocache.geocode_cache.clear()
+            call_command('loci_geocode_prewarm', stdout=six.StringIO())
+            self.assertEqual(
+                loci.geocache.geocode_cache.get(key), (True, stored.location_data))
+            (found, location_data) = loci.geocache.geocode_cache.get(
+                loci.geocache.make_key('1 Main Street, Wausau WI', 'address'))
+            self.assertEqual(location_data[0], (44.96, -89.63))
+
+            # refreshes ask the geocoder even though the stored row is fresh
+            self.assertEqual(loci.geostore.lookup(
+                '54403', 'address', lambda: (None, 'failing'), refresh=True), None)
+            moved = ((44.97, -89.57), stored.location_data[1])
+            self.assertEqual(loci.geostore.lookup(
+                '54403', 'address', lambda: (moved, 'google'), refresh=True), moved)
+            stored = GeocodeResult.objects.get()
+            self.assertEqual(stored.location_data, moved)
+            self.assertEqual(stored.provider, 'google')
+        finally:
+            loci.geostore.ENABLED = False
+
+
+class AsyncTests(TestCase):
+
+    def test_ageocode(self):
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            results = [
+                loci.aio.ageocode('54481'),
+                loci.aio.ageocode('54481'),
+                loci.aio.ageocode('Stevens Point, WI'),
+            ]
+            places = [result.get(10) for result in results]
+        self.assertEqual(places[0].location, (44.5233, -89.5746))
+        self.assertEqual(places[1].location, places[0].location)
+        self.assertEqual(places[2].city, 'Stevens Point')
+        # filled in by a reverse lookup of the city's point
+        self.assertEqual(places[2].zip_code, '54481')
+
+    def test_callback(self):
+        found = []
+        done = threading.Event()
+        def callback(place):
+            found.append(place)
+            done.set()
+
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            loci.aio.aget_geo((44.96, -89.62), callback=callback)
+            done.wait(10)
+        self.assertEqual(found[0].zip_code, '54401')
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    statuses = []
+
+    def do_GET(self):
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = json.dumps({'results': []}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.transport = loci.transport.Transport(
+            retries=2,
+            circuit_threshold=2,
+            sleep=lambda seconds: None
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries(self):
+        _StubHandler.statuses = [503, 502, 200]
+        self.assertEqual(self.transport.get(self.url).status_code, 200)
+
+    def test_circuit_breaker(self):
+        _StubHandler.statuses = [500] * 6
+        for i in range(2):
+            self.assertRaises(
+                loci.transport.TransportError, self.transport.get, self.url)
+        self.assertRaises(
+            loci.transport.CircuitOpenError, self.transport.get, self.url)
+        self.assertEqual(len(_StubHandler.statuses), 0)
+
+    def test_google_geocoder_failure(self):
+        _StubHandler.statuses = [500] * 3
+        geocoder = loci.geocoders.GoogleGeocoder(self.transport)
+        geocoder.api_url = self.url + '?'
+        self.assertRaises(
+            loci.geocoders.GeocoderError, geocoder.geocode, '54403')
+        self.assertEqual(geocoder.geocode('54403'), None)
+
 
 class LookupTests(TestCase):
+    @override_settings(LOCI_GEOCODER=OFFLINE_GEOCODERS)
     def test_request_geolocation(self):
         # use a consistent default ZIP
         settings.DEFAULT_ZIP_CODE = '54403'
@@ -101,3 +1227,138 @@ class LookupTests(TestCase):
         del mock_request.GET['geo']
         l3 = geolocate_request(mock_request)
         self.assertEqual(l3.location, l2.location)
+
+    def test_request_memoization(self):
+        mock_request = _Mock()
+        mock_request.GET = {'geo': '54481'}
+        mock_request.session = {}
+        mock_request.META = {'REMOTE_ADDR': '127.0.0.1'}
+
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            l1 = geolocate_request(mock_request, 50)
+            self.assertTrue(geolocate_request(mock_request, 50) is l1)
+            data = mock_request.session['geolocation_data']
+            self.assertEqual(data['query'], '54481')
+            self.assertEqual(tuple(data['location']), l1.location)
+
+        # later requests use the coordinates stored in the session, even
+        # if the geocoder is unavailable
+        mock_request = _Mock()
+        mock_request.GET = {}
+        mock_request.session = {
+            'geolocation': '54481',
+            'geodistance': 50,
+            'geolocation_data': data,
+        }
+        with self.settings(LOCI_GEOCODER='loci.tests._FailingGeocoder'):
+            l2 = geolocate_request(mock_request)
+        self.assertEqual(l2.location, l1.location)
+        self.assertEqual(l2.zip_code, '54481')
+        self.assertEqual(l2.nearby_distance, 50)
+
+    def test_middleware(self):
+        with self.settings(
+                LOCI_GEOCODER='loci.tests._LocalTestGeocoder',
+                DEFAULT_ZIP_CODE='54403'):
+            middleware = GeolocationMiddleware()
+            mock_request = _Mock()
+            mock_request.GET = {}
+            mock_request.session = {}
+            mock_request.META = {'REMOTE_ADDR': '127.0.0.1'}
+            middleware.process_request(mock_request)
+            self.assertFalse(hasattr(mock_request, '_loci_geolocations'))
+            self.assertEqual(mock_request.geolocation.zip_code, '54403')
+            self.assertTrue(hasattr(mock_request, '_loci_geolocations'))
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.metrics = []
+        metric.connect(self.receiver)
+        loci.geocache.geocode_cache.delete(
+            loci.geocache.make_key('Stevens Point WI', 'address'))
+
+    def tearDown(self):
+        metric.disconnect(self.receiver)
+
+    def receiver(self, sender, name, value, tags, **kwargs):
+        self.metrics.append((name, value, tags))
+
+    def names(self):
+        return [name for (name, value, tags) in self.metrics]
+
+    def test_geocode_metrics(self):
+        with self.settings(LOCI_GEOCODER='loci.tests._LocalTestGeocoder'):
+            geocode('Stevens Point WI')
+            geocode('Stevens Point WI')
+
+        cache_results = [
+            tags['result'] for (name, value, tags) in self.metrics
+            if name == 'geocode.cache' and tags['query_type'] == 'address'
+        ]
+        self.assertEqual(cache_results, ['miss', 'hit'])
+        lookups = [
+            tags for (name, value, tags) in self.metrics
+            if name == 'geocode.lookup'
+        ]
+        self.assertEqual(lookups[0]['outcome'], 'found')
+        self.assertEqual(lookups[0]['provider'], 'local')
+        # the local table has no ZIP code for a city
+        self.assertTrue('geocode.reverse_fallback' in self.names())
+
+    def test_chain_metrics(self):
+        with self.settings(LOCI_GEOCODER=[
+                'loci.tests._FailingGeocoder', 'loci.tests._LocalTestGeocoder']):
+            geocode('Stevens Point WI')
+        lookups = [
+            (tags['provider'], tags['outcome'])
+            for (name, value, tags) in self.metrics
+            if name == 'geocode.lookup' and tags['query_type'] == 'address'
+        ]
+        self.assertEqual(lookups, [('failing', 'error'), ('local', 'found')])
+
+    def test_near_metrics(self):
+        Place.objects.create(name='Wausau', location=(44.96, -89.63))
+        Place.objects.create(name='Madison', location=(43.07, -89.4))
+        Place.objects.near((44.97, -89.6), 20)
+
+        values = dict(
+            (name, value) for (name, value, tags) in self.metrics
+            if name.startswith('near.')
+        )
+        self.assertEqual(values['near.results'], 1)
+        self.assertTrue(values['near.candidates'] >= 1)
+        self.assertTrue(values['near.sql'] >= 0 and values['near.math'] >= 0)
+        self.assertTrue('place.save' in self.names())
+
+    def test_request_summary(self):
+        middleware = loci.metrics.MetricsMiddleware()
+        request = _Mock()
+        middleware.process_request(request)
+        Place.objects.near((44.97, -89.6), 20)
+        response = middleware.process_response(request, 'response')
+        self.assertEqual(response, 'response')
+        self.assertEqual(
+            request.loci_metrics['near.results source=database'],
+            {'count': 1, 'total': 0}
+        )
+        # nothing is collected outside requests
+        Place.objects.near((44.97, -89.6), 20)
+        self.assertEqual(loci.metrics.stop_summary(), {})
+
+    def test_request_summary_reset(self):
+        middleware = loci.metrics.MetricsMiddleware()
+        request = _Mock()
+        middleware.process_request(request)
+        Place.objects.near((44.97, -89.6), 20)
+        # an error kept process_response from running
+        request_finished.send(sender=None)
+        Place.objects.near((44.97, -89.6), 20)
+        self.assertEqual(loci.metrics.stop_summary(), {})
+
+        loci.metrics.start_summary()
+        Place.objects.near((44.97, -89.6), 20)
+        middleware.process_request(request)
+        middleware.process_response(request, 'response')
+        self.assertEqual(request.loci_metrics, {})
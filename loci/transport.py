@@ -0,0 +1,195 @@
+"""
+Transport
+=========
+
+The HTTP client used by remote geocoders: one keep-alive session with
+a connection pool shared by every request in the process, connect and
+read timeouts, a bounded number of retries with jittered exponential
+backoff, a client-side rate limit and a circuit breaker that fails
+fast while the service keeps failing.
+
+Options are read from the ``LOCI_GEOCODER_HTTP`` setting, a dictionary
+of :class:`Transport` keyword arguments, e.g.::
+
+    LOCI_GEOCODER_HTTP = {
+        'timeout': (2, 5),
+        'retries': 1,
+        'rate_limit': 10,
+    }
+
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TransportError(Exception):
+    pass
+
+
+class CircuitOpenError(TransportError):
+    pass
+
+
+class RateLimiter(object):
+    """
+    A token bucket allowing ``rate`` requests per second on average and
+    bursts of up to ``burst`` requests. :meth:`acquire` blocks until a
+    request may be made.
+
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``threshold`` consecutive failures. While open, calls
+    are refused until ``reset_timeout`` seconds have passed; then one
+    trial call is let through, which closes the circuit again if it
+    succeeds.
+
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                # let one trial request through; hold the rest off for
+                # another period in case it fails too
+                self.opened_at = self.clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Transport(object):
+
+    def __init__(self, timeout=(3.05, 10), retries=2, backoff=0.5,
+            max_backoff=5, rate_limit=None, burst=1, circuit_threshold=5,
+            circuit_reset=30, pool_size=10, sleep=time.sleep):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        if rate_limit:
+            self.limiter = RateLimiter(rate_limit, burst)
+        else:
+            self.limiter = None
+        self.breaker = CircuitBreaker(circuit_threshold, circuit_reset)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=0
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        """
+        Returns the response for a GET of ``url``, retrying connection
+        errors, timeouts and temporary server errors. Raises
+        :class:`TransportError` if every attempt fails and
+        :class:`CircuitOpenError` without trying while the circuit
+        breaker is open.
+
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError('Too many recent failures for %s' % url)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # "full jitter" backoff spreads out retries from many
+                # clients that failed at the same moment
+                self.sleep(random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                resp = self.session.get(url, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+                continue
+            except requests.exceptions.RequestException as e:
+                self.breaker.record_failure()
+                raise TransportError(e)
+            if resp.status_code in RETRY_STATUSES:
+                error = 'HTTP status %s' % resp.status_code
+                continue
+            self.breaker.record_success()
+            return resp
+
+        self.breaker.record_failure()
+        raise TransportError(error)
+
+
+_transport = []
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the process-wide :class:`Transport`.
+
+    """
+    with _transport_lock:
+        if not _transport:
+            options = getattr(settings, 'LOCI_GEOCODER_HTTP', {})
+            _transport.append(Transport(**options))
+        return _transport[0]
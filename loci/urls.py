@@ -3,4 +3,5 @@ from django.conf.urls import patterns, url
 
 urlpatterns = patterns('loci.views',
     url(r'^$', 'home', name='loci_home'),
+    url(r'^places\.json$', 'places_json', name='loci_places_json'),
 )
@@ -1,90 +1,91 @@
-import json
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.core.cache import cache
-from django.template.defaultfilters import slugify
+from django.db import connection
 from django.db.models.loading import get_model
 from django.contrib.sites.models import get_current_site
 
-import requests
+from loci.geocoders import get_geocoder, GeocoderError
+from loci.geocache import geocode_cache, make_key, round_location
+import loci.geostore
+import loci.metrics
 
 
 MAX_DIST = getattr(settings, 'LOCI_NEARBY_DISTANCE', 80)
 
+BULK_THREADS = getattr(settings, 'LOCI_GEOCODE_BULK_THREADS', 4)
+
+
+def _lookup(query, query_type=None):
+    """
+    Asks the geocoder about a query. Returns ``(location_data,
+    provider)``: ``(location, address_data)``, or ``None`` if nothing was
+    found or the lookup failed, and the name of the backend that found
+    it.
+
+    """
+    geocoder = get_geocoder()
+    provider = geocoder.name
+    try:
+        (result, provider) = geocoder.lookup(
+            'geocode' if query_type == 'address' else 'reverse', query)
+    except GeocoderError:
+        result = None
+    if result is not None and result[0] == (None, None):
+        result = None
+    if result is None:
+        return (None, provider)
+    (location, (street_address, city, state, zip_code)) = result
+
+    if query_type == 'address' and not (city and state and zip_code):
+        # missing some data, try to get it from coords
+        loci.metrics.emit('geocode.reverse_fallback', 1)
+        loc_data = get_geo(location)
+        if not city:
+            city = loc_data.city
+        if not state:
+            state = loc_data.state
+        if not zip_code:
+            zip_code = loc_data.zip_code
+
+    address_data = (
+        street_address,
+        city,
+        state,
+        zip_code,
+    )
+    return ((location, address_data), provider)
+
 
 def _geo_query(query, query_type=None):
-    cache_key = 'geo:' + slugify(str(query))
-    location_data = cache.get(cache_key)
-    
-    if not location_data:
-        # data not in cache, do an API query
-        api_url = 'http://maps.googleapis.com/maps/api/geocode/json?'
-        if query_type == 'address':
-            api_url += 'address=%s' % query
-        else:
-            api_url += 'latlng=%s,%s' % query
-        api_url += '&sensor=false'
-        try:
-            resp = requests.get(api_url)
-        except requests.exceptions.RequestException:
-            data = {}
-        else:
-            if resp.status_code == 200:
-                data = json.loads(resp.text)
-            else:
-                data = {}
-        
-        # for now, we only need coords and address, but more is available
-        results = data.get('results', [])
-        if results:
-            result = results[0]
-        else:
-            result = {}
-
-        latlon = result.get('geometry', {}).get('location', {})
-        location = (latlon.get('lat'), latlon.get('lng'))
-
-        street_address = city = state = zip_code = None
-        number = route = ''
-        acomps = result.get('address_components', [])
-        for comp in acomps:
-            if 'street_number' in comp['types']:
-                number = comp['long_name']
-            if 'route' in comp['types']:
-                route = comp['long_name']
-            if 'locality' in comp['types']:
-                city = comp['long_name']
-            if 'administrative_area_level_1' in comp['types']:
-                state = comp['short_name']
-            if 'postal_code' in comp['types']:
-                zip_code = comp['long_name']
-        if number or route:
-            street_address = number + ' ' + route
-        
-        if query_type == 'address' and not (city and state and zip_code) and \
-                location != (None, None):
-            # missing some data, try to get it from coords
-            loc_data = get_geo(location)
-            if not city:
-                city = loc_data.city
-            if not state:
-                state = loc_data.state
-            if not zip_code:
-                zip_code = loc_data.zip_code
-        
-        address_data = (
-            street_address,
-            city,
-            state,
-            zip_code,
-        )
-        location_data = (location, address_data)
-        if data:
-            cache.set(cache_key, location_data, 86400)
-    
+    if query_type != 'address':
+        query = round_location(query)
+
+    def lookup():
+        return loci.geostore.lookup(
+            query, query_type, lambda: _lookup(query, query_type))
+    def refresh():
+        # stale entries are refreshed from the geocoder, not the store
+        return loci.geostore.lookup(
+            query, query_type, lambda: _lookup(query, query_type),
+            refresh=True)
+    (location_data, outcome) = geocode_cache.get_or_lookup(
+        make_key(query, query_type), lookup, refresh)
+
+    loci.metrics.emit(
+        'geocode.cache', 1,
+        result=outcome,
+        query_type=query_type or 'location'
+    )
+    return _place_from(location_data)
+
+
+def _place_from(location_data):
     # get the model here to prevent circular import
     Place = get_model('loci', 'place')
 
+    if location_data is None:
+        location_data = ((None, None), (None, None, None, None))
     (location, (address, city, state, zip_code)) = location_data    
 
     unsaved_place = Place(
@@ -106,7 +107,137 @@ def get_geo(location):
     return _geo_query(location)
 
 
+def geocode_many(addresses, threads=None):
+    """
+    Geocodes many addresses at once. Returns a dictionary mapping each
+    address to an unsaved :class:`Place`, like :func:`geocode` does.
+
+    Addresses that normalize to the same cache key are looked up once,
+    cached results are served first, and the rest are looked up in a
+    pool of ``threads`` threads (``LOCI_GEOCODE_BULK_THREADS``, default
+    4), or one at a time in the calling thread if ``threads`` is 1 or
+    less. Remote requests are still subject to the transport's rate limit
+    (see :mod:`loci.transport`).
+
+    """
+    keys = {}
+    for address in addresses:
+        keys.setdefault(make_key(address, 'address'), address)
+
+    results = {}
+    misses = []
+    for (key, address) in keys.items():
+        (cached, location_data) = geocode_cache.get(key)
+        if cached:
+            results[key] = _place_from(location_data)
+        else:
+            misses.append((key, address))
+
+    if threads is None:
+        threads = BULK_THREADS
+    threads = min(threads, len(misses))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            places = pool.map(
+                _geocode_in_thread, [address for (key, address) in misses])
+        finally:
+            pool.close()
+    else:
+        places = [geocode(address) for (key, address) in misses]
+    for ((key, address), place) in zip(misses, places):
+        results[key] = place
+
+    return dict(
+        (address, results[make_key(address, 'address')])
+        for address in addresses
+    )
+
+
+def _geocode_in_thread(address):
+    try:
+        return geocode(address)
+    finally:
+        # the cache and the geocode store may have opened a connection
+        # in this pool thread; don't leave it open
+        connection.close()
+
+
+def _location_data(place):
+    return (place.location, (place.address, place.city, place.state, place.zip_code))
+
+
+def _store_geolocation(request, geo_query, geolocation):
+    # keep the lookup result with the query so later requests in the
+    # session don't need to look it up again
+    (location, address_data) = _location_data(geolocation)
+    request.session['geolocation'] = geo_query
+    request.session['geolocation_data'] = {
+        'query': geo_query,
+        'location': list(location),
+        'address': list(address_data),
+    }
+
+
+def _session_geolocation(request):
+    """
+    Returns the location stored in the session for the session's query,
+    or ``None`` if there is none.
+
+    """
+    data = request.session.get('geolocation_data')
+    if not data or data.get('query') != request.session.get('geolocation'):
+        return None
+    return _place_from((tuple(data['location']), tuple(data['address'])))
+
+
+_default_locations = {}
+
+
+def default_zip_code(request):
+    try:
+        return get_current_site(request).profile.zip_code
+    except AttributeError:
+        return settings.DEFAULT_ZIP_CODE
+
+
+def default_location(zip_code):
+    """
+    Returns the location of a fallback ZIP code. Each ZIP code is looked
+    up once per process.
+
+    """
+    location_data = _default_locations.get(zip_code)
+    if location_data is None:
+        geolocation = geocode(zip_code)
+        if geolocation.latitude is None:
+            return geolocation
+        location_data = _default_locations[zip_code] = _location_data(
+            geolocation)
+    return _place_from(location_data)
+
+
 def geolocate_request(request, default_dist=None):
+    """
+    Returns an unsaved :class:`Place` for the location a request asks
+    about (the ``geo`` query parameter), the one remembered in its
+    session, or the site's default ZIP code, with a ``nearby_distance``
+    attached.
+
+    The result is memoized on the request, so views and template tags
+    calling this for the same request share one lookup.
+
+    """
+    memo_key = (request.GET.get('geo'), request.GET.get('dist'), default_dist)
+    memo = getattr(request, '_loci_geolocations', None)
+    if memo is None:
+        memo = request._loci_geolocations = {}
+    if memo_key not in memo:
+        memo[memo_key] = _geolocate_request(request, default_dist)
+    return memo[memo_key]
+
+
+def _geolocate_request(request, default_dist=None):
     found = False
     geo_query = request.GET.get('geo')
     try:
@@ -117,28 +248,28 @@ def geolocate_request(request, default_dist=None):
         # if the user has submitted an address, attempt to look it up
         geolocation = geocode(geo_query)
         if geolocation.latitude != None:
-            # geolocation found from address, save the query only
-            # lookup data should be cached, so no need to save it in session
-            request.session['geolocation'] = geo_query
+            _store_geolocation(request, geo_query, geolocation)
             request.session['geodistance'] = found_dist
             found = True
     if not found and request.session.get('geolocation'):
         # there is an existing geo_query in the session
-        geolocation = geocode(request.session['geolocation'])
-        if geolocation.latitude != None:
+        geolocation = _session_geolocation(request)
+        if geolocation is not None:
             found = True
         else:
-            # the query did not find anything, remove it from the session
-            del request.session['geodistance']
-            del request.session['geolocation']
+            geolocation = geocode(request.session['geolocation'])
+            if geolocation.latitude != None:
+                _store_geolocation(
+                    request, request.session['geolocation'], geolocation)
+                found = True
+            else:
+                # the query did not find anything, remove it from the session
+                del request.session['geodistance']
+                del request.session['geolocation']
+                request.session.pop('geolocation_data', None)
     if not found:
         # could not otherwise find location data, fall back to station ZIP code
-        try:
-            zip_code = get_current_site(request).profile.zip_code
-        except AttributeError:
-            zip_code = settings.DEFAULT_ZIP_CODE
-        defloc = geocode(zip_code)
-        geolocation = defloc
+        geolocation = default_location(default_zip_code(request))
     if found:
         geolocation.nearby_distance = found_dist
     else:
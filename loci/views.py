@@ -1,9 +1,53 @@
+from datetime import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_GET
 
 from loci.utils import geolocate_request
 from loci.forms import PlaceForm, GeolocationForm
 from loci.models import Place
+import loci.distance
+import loci.generation
+
+
+PAGE_SIZE = getattr(settings, 'LOCI_PAGE_SIZE', 20)
+
+# origins are snapped to a grid of this many decimal places (2 is
+# about 1km) so that nearby users share cached responses
+API_PRECISION = getattr(settings, 'LOCI_API_PRECISION', 2)
+
+API_MAX_DISTANCE = getattr(settings, 'LOCI_API_MAX_DISTANCE', 160)
+
+API_MAX_RESULTS = getattr(settings, 'LOCI_API_MAX_RESULTS', 100)
+
+API_MAX_AGE = getattr(settings, 'LOCI_API_MAX_AGE', 60)
+
+
+def _parse_page_key(value):
+    """
+    Reads the ``after`` parameter written by :func:`_page_key`, or
+    returns ``None`` if it is missing or malformed.
+
+    """
+    try:
+        (distance, pk) = value.split('_')
+        return (int(distance) if distance else None, int(pk))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _page_key(key):
+    if key is None:
+        return None
+    (distance, pk) = key
+    return '%s_%s' % ('' if distance is None else '%d' % distance, pk)
 
 
 def home(request):
@@ -17,9 +61,124 @@ def home(request):
     else:
         form = PlaceForm()
     
+    after = _parse_page_key(request.GET.get('after'))
+    (places, next_key) = Place.objects.distance_page(
+        request_location,
+        loci.distance.MAX_DISTANCE,
+        after=after,
+        size=PAGE_SIZE,
+        unlocated=True
+    )
+    
     return render(request, "loci/home.html", {
         "request_location": request_location,
         "geo_form": geo_form,
         "form": form,
-        "places": Place.objects.all()
+        "places": places,
+        "first_page": after is None,
+        "next_page": _page_key(next_key),
     })
+
+
+def _api_query(request):
+    """
+    Returns the canonical query string for an API request, with the
+    origin snapped to the grid, or ``None`` if the request is invalid.
+
+    """
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lon'])
+        if 'k' in request.GET:
+            (name, value) = ('k', int(request.GET['k']))
+            valid = 0 < value <= API_MAX_RESULTS
+        else:
+            (name, value) = ('dist', float(request.GET['dist']))
+            valid = 0 < value <= API_MAX_DISTANCE
+    except (KeyError, ValueError):
+        return None
+    if not (valid and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return 'lat=%.*f&lon=%.*f&%s=%s' % (
+        API_PRECISION, latitude, API_PRECISION, longitude, name, '%g' % value)
+
+
+def _api_etag(request):
+    # only called for canonical URLs, so the query string identifies
+    # the response
+    query = request.META.get('QUERY_STRING', '')
+    return '%s-%s' % (
+        loci.generation.current(),
+        hashlib.md5(query.encode('utf-8')).hexdigest()
+    )
+
+
+def _api_last_modified(request):
+    return datetime.utcfromtimestamp(loci.generation.last_modified())
+
+
+def _place_json(place):
+    return json.dumps({
+        'id': place.pk,
+        'name': place.name,
+        'address': place.address,
+        'city': place.city,
+        'state': place.state,
+        'zip_code': place.zip_code,
+        'latitude': place.latitude,
+        'longitude': place.longitude,
+        'distance': place.exact_distance.miles,
+    })
+
+
+def _stream_places(places):
+    yield '{"places": ['
+    for (i, place) in enumerate(places):
+        if i:
+            yield ', '
+        yield _place_json(place)
+    yield ']}'
+
+
+@require_GET
+def places_json(request):
+    """
+    Returns the places within ``dist`` miles of ``lat``, ``lon``, or
+    the ``k`` places nearest to it, nearest first, as JSON.
+
+    Requests whose origin is not on the grid of ``LOCI_API_PRECISION``
+    decimal places, or whose parameters are not in canonical form, are
+    redirected to the canonical URL, so caches see one URL per grid
+    cell. Responses carry ETag and Last-Modified headers from the place
+    generation, and are public for ``LOCI_API_MAX_AGE`` seconds.
+
+    """
+    query = _api_query(request)
+    if query is None:
+        return HttpResponseBadRequest(
+            'lat, lon and dist (at most %s) or k (at most %s) are required.'
+            % (API_MAX_DISTANCE, API_MAX_RESULTS))
+    if query != request.META.get('QUERY_STRING'):
+        response = redirect('%s?%s' % (reverse('loci_places_json'), query))
+        patch_cache_control(response, public=True, max_age=API_MAX_AGE)
+        return response
+    return _places_json(request)
+
+
+# only checked once the URL is known to be canonical, so that other
+# URLs are redirected rather than answered with 304 Not Modified
+@condition(etag_func=_api_etag, last_modified_func=_api_last_modified)
+def _places_json(request):
+    origin = (float(request.GET['lat']), float(request.GET['lon']))
+    if 'k' in request.GET:
+        places = Place.objects.nearest(origin, int(request.GET['k']))
+    else:
+        places = sorted(
+            Place.objects.near(origin, float(request.GET['dist'])),
+            key=lambda place: (place.exact_distance.miles, place.pk)
+        )
+
+    response = StreamingHttpResponse(
+        _stream_places(places), content_type='application/json')
+    patch_cache_control(response, public=True, max_age=API_MAX_AGE)
+    return response